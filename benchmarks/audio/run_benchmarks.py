@@ -0,0 +1,197 @@
+"""Benchmarks the audio encoding on synthetic test signals.
+
+The test signals are generated with ffmpeg (lavfi), so the results only depend on the
+code and the ffmpeg build. Each case runs in its own process, so that the peak memory
+and the bytes written can be measured for that case alone.
+
+Modes:
+    single  every preference on its own (encode_single_preference)
+    all     the whole preference string in one case (encode_all_preferences)
+    tracks  the whole preference string on --tracks copies of the signal (encode_audio_tracks)
+
+Usage (from the repository root):
+    python3 benchmarks/audio/run_benchmarks.py --output results.json
+    python3 benchmarks/audio/run_benchmarks.py --durations 60 --layouts 5.1 --preferences "EOS-AC3, AAC:2.0"
+    python3 benchmarks/audio/run_benchmarks.py --mode tracks --tracks 3
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+DEFAULT_PREFERENCES = "AC3, EAC3, DTS, OPUS, FLAC, AAC, EOS-AC3, EOS-AAC:2.0"
+DEFAULT_LAYOUTS = "7.1, 5.1, stereo"
+DEFAULT_DURATIONS = "60, 600"
+SAMPLE_RATE = 48000
+
+LAYOUT_CHANNELS = {'mono': 1, 'stereo': 2, '5.1': 6, '5.1(side)': 6, '7.1': 8}
+
+
+def generate_source(folder, layout, duration):
+    # One sine tone per channel, and seeded pink noise on the first (or center) channel,
+    # so that the compressor and the encoders have something other than silence to work on
+    channels = LAYOUT_CHANNELS[layout]
+    sources = []
+    for channel in range(channels):
+        sources.append(f"sine=frequency={110 * (channel + 1)}:sample_rate={SAMPLE_RATE}:duration={duration}[s{channel}]")
+    noise_channel = 2 if channels >= 6 else 0
+    sources.append(f"anoisesrc=color=pink:amplitude=0.2:seed=42:sample_rate={SAMPLE_RATE}:duration={duration}[n]")
+    sources.append(f"[s{noise_channel}][n]amix=inputs=2:normalize=0[c{noise_channel}]")
+
+    inputs = ''.join(f"[c{channel}]" if channel == noise_channel else f"[s{channel}]" for channel in range(channels))
+    if channels > 1:
+        sources.append(f"{inputs}join=inputs={channels}:channel_layout={layout}[out]")
+    else:
+        sources.append(f"{inputs}anull[out]")
+
+    # Named like the tracks written by mkvextract: <name>.<track id>.<language>.mkv
+    filename = os.path.join(folder, f"bench_{layout.replace('(', '').replace(')', '')}_{duration}s.1.en.mkv")
+    command = ["ffmpeg", "-y", "-nostats", "-loglevel", "error", "-filter_complex", ';'.join(sources),
+               "-map", "[out]", "-c:a", "flac", filename]
+    subprocess.run(command, check=True)
+    return filename
+
+
+def read_write_bytes():
+    # Bytes written to storage by this process and its finished child processes
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split(':')[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_case(source, preference, eos_engine, mode, tracks):
+    # Runs in a separate process, prints the measurements of a single case as JSON
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    from modules.audio import encode_single_preference, encode_all_preferences, encode_audio_tracks, \
+        parse_preferred_codecs
+    from modules.misc import config
+
+    config['audio']['eos_engine'] = eos_engine
+    preferences = parse_preferred_codecs(preference)
+
+    folder = os.path.dirname(source)
+    audio_files = []
+    if mode == 'tracks':
+        # encode_audio_tracks removes the tracks it has encoded, so it is given copies
+        for track in range(tracks):
+            audio_file = source.replace('.1.en.mkv', f'.{track + 2}.en.mkv')
+            shutil.copyfile(source, audio_file)
+            audio_files.append(audio_file)
+    files_before = set(os.listdir(folder))
+    write_bytes_before = read_write_bytes()
+    start_time = time.perf_counter()
+
+    if mode == 'single':
+        transformation, codec, ch_str = preferences[0]
+        encode_single_preference(source, 0, False, ['eng'], [''], transformation, codec, ch_str, [])
+    elif mode == 'all':
+        encode_all_preferences(source, 0, False, ['eng'], [''], preferences, [])
+    else:
+        encode_audio_tracks(tracks, False, audio_files, ['eng'] * tracks, [''] * tracks, preference)
+
+    wall_time = time.perf_counter() - start_time
+    write_bytes_after = read_write_bytes()
+    new_files = [os.path.join(folder, f) for f in set(os.listdir(folder)) - files_before]
+    output_bytes = sum(os.path.getsize(f) for f in new_files if os.path.isfile(f))
+    for new_file in new_files:
+        os.remove(new_file)
+
+    # ru_maxrss is in kB on Linux
+    peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Bytes written other than the encoded tracks themselves (intermediate WAV files etc.)
+    temp_bytes_written = None
+    if write_bytes_before is not None and write_bytes_after is not None:
+        temp_bytes_written = max(0, write_bytes_after - write_bytes_before - output_bytes)
+    print(json.dumps({
+        'wall_time': round(wall_time, 3),
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+        'temp_bytes_written': temp_bytes_written,
+        'output_bytes': output_bytes,
+    }))
+
+
+def get_ffmpeg_version():
+    result = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True)
+    return result.stdout.splitlines()[0] if result.stdout else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the audio encoding on synthetic test signals.")
+    parser.add_argument("--preferences", type=str, default=DEFAULT_PREFERENCES,
+                        help="Comma-separated preferences, as in PREFERRED_AUDIO_FORMATS.")
+    parser.add_argument("--layouts", type=str, default=DEFAULT_LAYOUTS,
+                        help="Comma-separated channel layouts of the test signals.")
+    parser.add_argument("--durations", type=str, default=DEFAULT_DURATIONS,
+                        help="Comma-separated lengths (seconds) of the test signals.")
+    parser.add_argument("--eos_engine", type=str, default='ffmpeg', choices=['ffmpeg', 'numpy'],
+                        help="Engine used for the EOS transformation.")
+    parser.add_argument("--mode", type=str, default='single', choices=['single', 'all', 'tracks'],
+                        help="Benchmark every preference on its own, or the whole preference string at once.")
+    parser.add_argument("--tracks", type=int, default=2,
+                        help="Number of audio tracks encoded at once in the 'tracks' mode.")
+    parser.add_argument("--output", "-o", type=str, default=None,
+                        help="Write the JSON results to this file instead of stdout.")
+    parser.add_argument("--run_case", nargs=2, metavar=('SOURCE', 'PREFERENCE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case(args.run_case[0], args.run_case[1], args.eos_engine, args.mode, args.tracks)
+        return
+
+    preferences = [p.strip() for p in args.preferences.split(',') if p.strip()]
+    if args.mode != 'single':
+        preferences = [', '.join(preferences)]
+    tracks = args.tracks if args.mode == 'tracks' else 1
+    layouts = [l.strip() for l in args.layouts.split(',') if l.strip()]
+    durations = [int(d) for d in args.durations.split(',') if d.strip()]
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='mkv-auto-bench-')
+    try:
+        for layout in layouts:
+            for duration in durations:
+                source = generate_source(work_dir, layout, duration)
+                for preference in preferences:
+                    command = [sys.executable, os.path.abspath(__file__), "--eos_engine", args.eos_engine,
+                               "--mode", args.mode, "--tracks", str(tracks), "--run_case", source, preference]
+                    process = subprocess.run(command, capture_output=True, text=True)
+                    result = {'preference': preference, 'layout': layout, 'duration': duration, 'tracks': tracks}
+                    if process.returncode != 0:
+                        result['error'] = process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'failed'
+                    else:
+                        result.update(json.loads(process.stdout.strip().splitlines()[-1]))
+                        result['realtime_factor'] = round(duration * tracks / result['wall_time'], 1) \
+                            if result['wall_time'] else None
+                    results.append(result)
+                    print(f"{preference:>14} {layout:>9} {duration:>5}s: "
+                          f"{result.get('realtime_factor', result.get('error'))}"
+                          f"{'x realtime' if 'error' not in result else ''}", file=sys.stderr)
+                os.remove(source)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = json.dumps({'ffmpeg_version': get_ffmpeg_version(), 'eos_engine': args.eos_engine, 'mode': args.mode,
+                         'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,13 @@ from itertools import groupby, zip_longest
 
 from modules.file_operations import *
 from modules.mkv import *
+from modules.pipeline import *
 from modules.subs import *
 from modules.audio import *
 from modules.misc import *
+from modules.probe import *
+from modules.watcher import *
+from modules.ledger import *
 from modules.logger import *
 
 
@@ -19,6 +23,7 @@ def mkv_auto(args):
     ini_temp_dir = check_config(config, 'general', 'ini_temp_dir')
     remove_samples = check_config(config, 'general', 'remove_samples')
     hide_cursor = check_config(config, 'general', 'hide_cursor')
+    pipeline_mode = check_config(config, 'general', 'pipeline_mode') or args.pipeline
 
     # Create the logger
     logger = setup_logger(args.log_file)
@@ -53,20 +58,28 @@ def mkv_auto(args):
     if args.temp_dir:
         temp_dir = args.temp_dir
 
-    if os.path.exists(temp_dir):
+    # Keep the TEMP folder if the previous run was interrupted, so that it can be resumed
+    resume_jobs = has_unfinished_jobs(temp_dir)
+
+    if os.path.exists(temp_dir) and not resume_jobs:
         try:
             shutil.rmtree(temp_dir)
         except:
             pass
 
     if not move_files:
-        if os.path.exists(temp_dir):
+        if os.path.exists(temp_dir) and not resume_jobs:
             shutil.rmtree(temp_dir)
-        os.mkdir(temp_dir)
+        os.makedirs(temp_dir, exist_ok=True)
+
+    init_audio_cache(temp_dir)
+    init_ocr_image_cache(temp_dir)
+    init_ocr_track_cache(temp_dir)
+    init_job_ledger(temp_dir)
 
     total_files = count_files(input_dir)
 
-    if total_files == 0:
+    if total_files == 0 and not resume_jobs:
         if not args.silent:
             print_no_timestamp(logger, f"No media files found in input directory.\n")
         exit(0)
@@ -87,13 +100,16 @@ def mkv_auto(args):
         if hide_cursor:
             hide_the_cursor()
 
+        # Counts the moved/copied files of this run
+        file_counter = [0]
         if move_files:
             remaining_files = wait_for_stable_files(input_dir)
             while remaining_files:
                 total_files_input += count_files(input_dir)
                 files_in_temp = count_files(temp_dir)
                 all_files = remaining_files + files_in_temp
-                done_info = move_directory_contents(logger, input_dir, temp_dir, total_files=all_files)
+                done_info = move_directory_contents(logger, input_dir, temp_dir, file_counter=file_counter,
+                                                    total_files=all_files)
                 remaining_files = wait_for_stable_files(input_dir)
                 if done_info['skipped_files'] > 0:
                     break
@@ -101,8 +117,11 @@ def mkv_auto(args):
         else:
             remaining_files = wait_for_stable_files(input_dir)
             total_files_input += count_files(input_dir)
-            done_info = copy_directory_contents(logger, input_dir, temp_dir, total_files=remaining_files)
+            done_info = copy_directory_contents(logger, input_dir, temp_dir, file_counter=file_counter,
+                                                total_files=remaining_files)
             actual_total_file_sizes += done_info[f'actual_{method}_file_sizes']
+            ingest_methods = ', '.join(f"{count} {ingest_method_names.get(ingest_method, ingest_method)}"
+                                       for ingest_method, count in done_info['ingest_methods'].items())
 
         desc = "Moving file" if move_files else "Copying file"
         total_files_temp = count_files(temp_dir)
@@ -114,14 +133,17 @@ def mkv_auto(args):
         if done_info['skipped_files'] == 0:
             custom_print(logger, f"{GREY}[INFO]{RESET} "
                                  f"Successfully {method} {actual_total_file_sizes:.2f} GB to TEMP.")
+        if not move_files and done_info['ingest_methods']:
+            custom_print(logger, f"{GREY}[INFO]{RESET} Files {ingest_methods}, "
+                                 f"{done_info['ingest_bytes_copied']:.2f} GB of data copied.")
         elif done_info['skipped_files'] > 0:
             custom_print(logger, f"{GREY}[INFO]{RESET} "
                                  f"Successfully {method} {actual_total_file_sizes:.2f} GB to TEMP.")
             custom_print(logger,
                          f"{GREY}[INFO]{RESET} {done_info['skipped_files']} {print_multi_or_single(done_info['skipped_files'], 'file')} "
-                         f"had to be skipped due to insufficient storage.")
+                         f"will be processed when there is enough space in TEMP.")
             custom_print(logger,
-                         f"{GREY}[INFO]{RESET} {done_info['required_space_gib']:.2f} GB would be needed in total (350% of {done_info['actual_file_sizes']:.2f} GB)")
+                         f"{GREY}[INFO]{RESET} {done_info['required_space_gib']:.2f} GB would be needed in total (estimated peak usage for {done_info['actual_file_sizes']:.2f} GB of files)")
             custom_print(logger, f"{GREY}[INFO]{RESET} Only {done_info['available_space_gib']:.2f} GB was available in TEMP.")
 
         extract_archives(logger, temp_dir)
@@ -193,11 +215,24 @@ def mkv_auto(args):
                         custom_print(logger, f"{RED}[ERROR]{RESET} Remove this file from the input folder and try again.\n")
                         exit(1)
 
+            resumed_files = finish_resumed_files(logger, debug, filenames_mkv_only, dirpath, all_dirnames, output_dir)
+            if resumed_files:
+                filenames_mkv_only = [f for f in filenames_mkv_only if f not in resumed_files]
+                filenames = [f for f in filenames if f not in resumed_files]
+                if not filenames_mkv_only:
+                    if filenames_covers:
+                        move_files_to_output_process(logger, debug, filenames_covers, dirpath, all_dirnames, output_dir)
+                    print_no_timestamp(logger, '')
+                    if hide_cursor:
+                        show_the_cursor()
+                    continue
+
             ram_info = get_ram_usage()
+            cpu_usage = get_cpu_usage()
             max_workers = get_worker_thread_count()
 
             custom_print(logger, f"{GREY}[INFO]{RESET} "
-                                 f"CPU {GREY}{get_block_gradient(psutil.cpu_percent(interval=0.5))}{RESET} {psutil.cpu_percent(interval=0.5):.0f}% "
+                                 f"CPU {GREY}{get_block_gradient(cpu_usage)}{RESET} {cpu_usage:.0f}% "
                                  f"RAM {GREY}{get_block_gradient(ram_info['percent_ram'])}{RESET} {ram_info['percent_ram']}%")
             custom_print(logger, f"{GREY}[INFO]{RESET} Using {max_workers} {print_multi_or_single(max_workers, 'worker')} based on system load.")
 
@@ -208,88 +243,98 @@ def mkv_auto(args):
 
             start_time = time.time()
 
-            errored_ocr_list = []
-            all_subtitle_files = []
-            all_downloaded_subs = []
-            subtitle_files_to_process = []
-
-            need_processing_audio, need_processing_subs, all_missing_subs_langs = trim_audio_in_mkv_files(logger, debug, filenames_mkv_only, dirpath)
-            audio_tracks_to_be_merged, subtitle_tracks_to_be_merged = generate_audio_tracks_in_mkv_files(logger, debug, filenames_mkv_only, dirpath, need_processing_audio)
-
-            if any(need_processing_subs):
-                if any(file.endswith(('.srt', '.ass', '.sub', '.idx', '.sup')) for file in filenames) and download_missing_subs.lower() != 'override':
-                    total_external_subs, all_missing_subs_langs = process_external_subs(
-                        logger, debug, dirpath, filenames_mkv_only, all_missing_subs_langs)
-
-                if download_missing_subs.lower() != 'override':
-                    all_subtitle_files = extract_subs_in_mkv_process(logger, debug, filenames_mkv_only, dirpath)
+            if pipeline_mode:
+                has_external_subs = any(file.endswith(('.srt', '.ass', '.sub', '.idx', '.sup')) for file in filenames)
+                filenames_mkv_only, errored_ocr_list = process_files_pipelined(
+                    logger, debug, filenames_mkv_only, dirpath, all_dirnames, output_dir, has_external_subs)
+                if filenames_covers:
+                    move_files_to_output_process(logger, debug, filenames_covers, dirpath, all_dirnames, output_dir)
+            else:
+                errored_ocr_list = []
+                all_subtitle_files = []
+                all_downloaded_subs = []
+                subtitle_files_to_process = []
 
-                if any(sub for sub in total_external_subs):
-                    all_subtitle_files = merge_subtitles_with_priority(all_subtitle_files, total_external_subs)
+                need_processing_audio, need_processing_subs, all_missing_subs_langs = trim_audio_in_mkv_files(logger, debug, filenames_mkv_only, dirpath)
+                demux_tracks_process(logger, debug, filenames_mkv_only, dirpath, need_processing_audio, need_processing_subs)
+                audio_tracks_to_be_merged, subtitle_tracks_to_be_merged = generate_audio_tracks_in_mkv_files(logger, debug, filenames_mkv_only, dirpath, need_processing_audio)
 
-                if not all(sub == ['none'] or sub == [''] or sub == [] for sub in all_missing_subs_langs) and download_missing_subs.lower() != 'false':
-                    all_downloaded_subs = fetch_missing_subtitles_process(logger, debug, filenames_mkv_only, dirpath, total_external_subs,
-                                                                          all_missing_subs_langs)
+                if any(need_processing_subs):
+                    if any(file.endswith(('.srt', '.ass', '.sub', '.idx', '.sup')) for file in filenames) and download_missing_subs.lower() != 'override':
+                        total_external_subs, all_missing_subs_langs = process_external_subs(
+                            logger, debug, dirpath, filenames_mkv_only, all_missing_subs_langs)
 
-                    all_subtitle_files = [[*(a or []), *(b or [])] for a, b in zip_longest(all_subtitle_files, all_downloaded_subs, fillvalue=[])]
+                    if download_missing_subs.lower() != 'override':
+                        all_subtitle_files = extract_subs_in_mkv_process(logger, debug, filenames_mkv_only, dirpath)
 
-                    if download_missing_subs.lower() == 'override':
-                        subtitle_files_to_process = all_subtitle_files
-                        subtitle_tracks_to_be_merged = get_subtitle_tracks_metadata_for_repack(logger, all_subtitle_files)
+                    if any(sub for sub in total_external_subs):
+                        all_subtitle_files = merge_subtitles_with_priority(all_subtitle_files, total_external_subs)
 
-                downloaded_or_external_subtitle_files = [[*(a or []), *(b or [])] for a, b in zip_longest(all_downloaded_subs, total_external_subs, fillvalue=[])]
-                if downloaded_or_external_subtitle_files:
-                    # Filter the nested lists to only include .srt files
-                    subtitle_files = [[f for f in sublist if f.endswith('.srt')] for sublist in downloaded_or_external_subtitle_files]
-                    if any(sub for sub in subtitle_files):
-                        resync_sub_process(logger, debug, filenames_mkv_only, dirpath, subtitle_files)
-
-                if all_subtitle_files and download_missing_subs.lower() != 'override':
-                    (subtitle_tracks_to_be_merged, subtitle_files_to_process,
-                     all_missing_subs_langs, errored_ocr_list, main_audio_track_langs) = convert_to_srt_process(logger, debug, filenames_mkv_only, dirpath, all_subtitle_files, False)
-
-                if (not all(sub == ['none'] or sub == [''] or sub == [] for sub in all_missing_subs_langs)
-                        and any(sub for sub in errored_ocr_list)):
-
-                    custom_print_no_newline(logger, f"{GREY}[SUBTITLES]{RESET} Limiting simultaneous OCR workers to 1.")
-
-                    a, new_subtitle_files_to_process, all_missing_subs_langs, b, c = convert_to_srt_process(logger, debug,
-                                                                                                            filenames_mkv_only,
-                                                                                                            dirpath,
-                                                                                                            errored_ocr_list,
-                                                                                                            True)
-                    if (download_missing_subs.lower() != 'false' and
-                            not all(sub == ['none'] or sub == [''] or sub == [] for sub in all_missing_subs_langs)):
-                        all_downloaded_subs = fetch_missing_subtitles_process(logger, debug,
-                                                                              filenames_mkv_only, dirpath,
-                                                                              total_external_subs,
+                    if not all(sub == ['none'] or sub == [''] or sub == [] for sub in all_missing_subs_langs) and download_missing_subs.lower() != 'false':
+                        all_downloaded_subs = fetch_missing_subtitles_process(logger, debug, filenames_mkv_only, dirpath, total_external_subs,
                                                                               all_missing_subs_langs)
 
-                    all_subtitle_files = [[*(a or []), *(b or [])] for a, b in zip_longest(subtitle_files_to_process, all_downloaded_subs, fillvalue=[])]
-                    all_subtitle_files = [[*(a or []), *(b or [])] for a, b in zip_longest(all_subtitle_files, new_subtitle_files_to_process, fillvalue=[])]
+                        all_subtitle_files = [[*(a or []), *(b or [])] for a, b in zip_longest(all_subtitle_files, all_downloaded_subs, fillvalue=[])]
 
-                    subtitle_files_to_process = [[*(a or []), *(b or [])] for a, b in zip_longest(all_downloaded_subs, subtitle_files_to_process, fillvalue=[])]
-                    subtitle_files_to_process = [[*(a or []), *(b or [])] for a, b in zip_longest(subtitle_files_to_process, new_subtitle_files_to_process, fillvalue=[])]
+                        if download_missing_subs.lower() == 'override':
+                            subtitle_files_to_process = all_subtitle_files
+                            subtitle_tracks_to_be_merged = get_subtitle_tracks_metadata_for_repack(logger, all_subtitle_files)
 
-                    if all_downloaded_subs:
+                    downloaded_or_external_subtitle_files = [[*(a or []), *(b or [])] for a, b in zip_longest(all_downloaded_subs, total_external_subs, fillvalue=[])]
+                    if downloaded_or_external_subtitle_files:
                         # Filter the nested lists to only include .srt files
-                        subtitle_files = [[f for f in sublist if f.endswith('.srt')] for sublist in all_downloaded_subs]
+                        subtitle_files = [[f for f in sublist if f.endswith('.srt')] for sublist in downloaded_or_external_subtitle_files]
                         if any(sub for sub in subtitle_files):
                             resync_sub_process(logger, debug, filenames_mkv_only, dirpath, subtitle_files)
 
-                    subtitle_tracks_to_be_merged = get_subtitle_tracks_metadata_for_repack(logger, all_subtitle_files)
+                    if all_subtitle_files and download_missing_subs.lower() != 'override':
+                        (subtitle_tracks_to_be_merged, subtitle_files_to_process,
+                         all_missing_subs_langs, errored_ocr_list, main_audio_track_langs) = convert_to_srt_process(logger, debug, filenames_mkv_only, dirpath, all_subtitle_files, False)
+
+                    if (not all(sub == ['none'] or sub == [''] or sub == [] for sub in all_missing_subs_langs)
+                            and any(sub for sub in errored_ocr_list)):
 
-                if subtitle_files_to_process and any(sub for sub in subtitle_files_to_process):
-                    remove_sdh_process(logger, debug, subtitle_files_to_process)
+                        custom_print_no_newline(logger, f"{GREY}[SUBTITLES]{RESET} Limiting simultaneous OCR workers to 1.")
 
-            if (any(any(value for value in d.values()) for d in audio_tracks_to_be_merged) or
-                    any(any(value for value in d.values()) for d in subtitle_tracks_to_be_merged) or
-                    remove_all_subtitles):
-                repack_mkv_tracks_process(logger, debug, filenames_mkv_only, dirpath, audio_tracks_to_be_merged, subtitle_tracks_to_be_merged)
+                        a, new_subtitle_files_to_process, all_missing_subs_langs, b, c = convert_to_srt_process(logger, debug,
+                                                                                                                filenames_mkv_only,
+                                                                                                                dirpath,
+                                                                                                                errored_ocr_list,
+                                                                                                                True)
+                        if (download_missing_subs.lower() != 'false' and
+                                not all(sub == ['none'] or sub == [''] or sub == [] for sub in all_missing_subs_langs)):
+                            all_downloaded_subs = fetch_missing_subtitles_process(logger, debug,
+                                                                                  filenames_mkv_only, dirpath,
+                                                                                  total_external_subs,
+                                                                                  all_missing_subs_langs)
 
-            filenames_mkv_only = remove_clutter_process(logger, debug, filenames_mkv_only, dirpath)
-            all_filenames = filenames_mkv_only + filenames_covers
-            move_files_to_output_process(logger, debug, all_filenames, dirpath, all_dirnames, output_dir)
+                        all_subtitle_files = [[*(a or []), *(b or [])] for a, b in zip_longest(subtitle_files_to_process, all_downloaded_subs, fillvalue=[])]
+                        all_subtitle_files = [[*(a or []), *(b or [])] for a, b in zip_longest(all_subtitle_files, new_subtitle_files_to_process, fillvalue=[])]
+
+                        subtitle_files_to_process = [[*(a or []), *(b or [])] for a, b in zip_longest(all_downloaded_subs, subtitle_files_to_process, fillvalue=[])]
+                        subtitle_files_to_process = [[*(a or []), *(b or [])] for a, b in zip_longest(subtitle_files_to_process, new_subtitle_files_to_process, fillvalue=[])]
+
+                        if all_downloaded_subs:
+                            # Filter the nested lists to only include .srt files
+                            subtitle_files = [[f for f in sublist if f.endswith('.srt')] for sublist in all_downloaded_subs]
+                            if any(sub for sub in subtitle_files):
+                                resync_sub_process(logger, debug, filenames_mkv_only, dirpath, subtitle_files)
+
+                        subtitle_tracks_to_be_merged = get_subtitle_tracks_metadata_for_repack(logger, all_subtitle_files)
+
+                    if subtitle_files_to_process and any(sub for sub in subtitle_files_to_process):
+                        remove_sdh_process(logger, debug, subtitle_files_to_process)
+
+                if (any(any(value for value in d.values()) for d in audio_tracks_to_be_merged) or
+                        any(any(value for value in d.values()) for d in subtitle_tracks_to_be_merged) or
+                        remove_all_subtitles):
+                    repack_mkv_tracks_process(logger, debug, filenames_mkv_only, dirpath, audio_tracks_to_be_merged, subtitle_tracks_to_be_merged)
+                else:
+                    remux_planned_tracks_process(logger, debug, filenames_mkv_only, dirpath)
+
+                filenames_mkv_only = remove_clutter_process(logger, debug, filenames_mkv_only, dirpath)
+                all_filenames = filenames_mkv_only + filenames_covers
+                move_files_to_output_process(logger, debug, all_filenames, dirpath, all_dirnames, output_dir)
 
             end_time = time.time()
             processing_time = end_time - start_time
@@ -299,6 +344,28 @@ def mkv_auto(args):
             print_no_timestamp(logger, f"{GREY}[INFO]{RESET} {len(filenames_mkv_only)} {print_multi_or_single(len(filenames_mkv_only), 'file')} "
                                        f"{'successfully ' if not any(sub for sub in errored_ocr_list) else ''}processed.")
             print_no_timestamp(logger, f"{GREY}[INFO]{RESET} Processing took {format_time(int(processing_time))} to complete.\n")
+
+            save_ocr_image_cache()
+            if debug:
+                probe_stats = get_probe_cache_stats()
+                print(f"{GREY}[UTC {get_timestamp()}] [DEBUG]{RESET} Probe cache: {probe_stats['hits']} hits, "
+                      f"{probe_stats['misses']} misses, {probe_stats['invalidations']} invalidations, "
+                      f"{probe_stats['entries']} entries.\n")
+                audio_cache_stats = get_audio_cache_stats()
+                print(f"{GREY}[UTC {get_timestamp()}] [DEBUG]{RESET} Audio cache: {audio_cache_stats['hits']} hits, "
+                      f"{audio_cache_stats['misses']} misses, {audio_cache_stats['evictions']} evictions.\n")
+                ocr_track_cache_stats = get_ocr_track_cache_stats()
+                print(f"{GREY}[UTC {get_timestamp()}] [DEBUG]{RESET} OCR track cache: {ocr_track_cache_stats['hits']} hits, "
+                      f"{ocr_track_cache_stats['misses']} misses, {ocr_track_cache_stats['evictions']} evictions.\n")
+                for device_stats in get_io_device_stats():
+                    print(f"{GREY}[UTC {get_timestamp()}] [DEBUG]{RESET} I/O device {device_stats['device']}: "
+                          f"{device_stats['capacity']} {print_multi_or_single(device_stats['capacity'], 'slot')}, "
+                          f"{device_stats['busy_percent']:.0f}% busy.")
+                for display_stats in get_xvfb_stats():
+                    print(f"{GREY}[UTC {get_timestamp()}] [DEBUG]{RESET} Xvfb display :{display_stats['display']}: "
+                          f"{display_stats['jobs']} {print_multi_or_single(display_stats['jobs'], 'job')}, "
+                          f"{display_stats['restarts']} {print_multi_or_single(display_stats['restarts'], 'restart')}, "
+                          f"{display_stats['utilisation']:.0f}% busy.")
             if hide_cursor:
                 show_the_cursor()
 
@@ -330,6 +397,46 @@ def mkv_auto(args):
     exit(0)
 
 
+def run_mkv_auto(args):
+    # Files that did not fit in TEMP are processed in another pass,
+    # as soon as the files of the previous pass have left TEMP
+    reset_ingest_admission()
+    # Watch mode calls this for every batch, in the same process
+    clear_probe_cache()
+    prune_known_stable_files()
+    while True:
+        start_ingest_pass()
+        try:
+            mkv_auto(args)
+        except SystemExit as e:
+            if e.code not in (0, None) or not has_deferred_files():
+                raise
+
+
+def watch_input_folder(args):
+    input_dir = check_config(config, 'general', 'input_folder')
+    if args.docker:
+        input_dir = 'files/input'
+    if args.input_dir:
+        input_dir = args.input_dir
+
+    quiet_period = float(check_config(config, 'general', 'watch_quiet_period'))
+    watcher = InputWatcher(input_dir, quiet_period)
+    user_config_mtime = get_user_config_mtime()
+
+    while True:
+        watcher.wait_for_files(retry_after=max(5.0, quiet_period))
+
+        # Restart with the same arguments to pick up changes to the user config
+        if get_user_config_mtime() != user_config_mtime:
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+        try:
+            run_mkv_auto(args)
+        except SystemExit:
+            pass
+
+
 def main():
     # Create the main parser
     parser = argparse.ArgumentParser(description="A tool that aims to remove unnecessary clutter "
@@ -352,18 +459,25 @@ def main():
                         help="print debugging information such as track selection, codecs, prefs etc. (default: False)")
     parser.add_argument("--service", action="store_true", default=False, required=False,
                         help="disables debug pause if enabled (default: False)")
+    parser.add_argument("--pipeline", action="store_true", default=False, required=False,
+                        help="let each file flow through the processing stages independently (default: False)")
+    parser.add_argument("--watch", action="store_true", default=False, required=False,
+                        help="keep running and process new files as soon as they arrive in the input folder (default: False)")
     parser.add_argument("--log_file", dest="log_file", type=str, required=False, default='mkv-auto.log',
                         help="log file location (default: './mkv-auto.log')")
 
-    parser.set_defaults(func=mkv_auto)
+    parser.set_defaults(func=run_mkv_auto)
     args = parser.parse_args()
 
+    if args.watch:
+        watch_input_folder(args)
+
     # Call the function associated with the active sub-parser
     args.func(args)
 
     # Run mkv_auto function if no argument is given
     if len(sys.argv) < 2:
-        mkv_auto(args)
+        run_mkv_auto(args)
 
 
 # Call the main() function if this file is directly executed
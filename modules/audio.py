@@ -5,25 +5,36 @@ import concurrent.futures
 from tqdm import tqdm
 import re
 import uuid
+import threading
 from datetime import datetime
 
 from modules.misc import *
+from modules.probe import *
+from modules.io_limits import *
+from modules.demux import *
+from modules.audio_cache import *
+from modules.eos import *
 
 
-# Function to extract a single audio track
-def extract_audio_track(debug, filename, track, language, name):
+def get_extracted_audio_filename(filename, track, language):
     base, _, _ = filename.rpartition('.')
     try:
         audio_language = pycountry.languages.get(alpha_3=language).alpha_2
     except:
         audio_language = language[:-1]
-    audio_filename = f"{base}.{track}.{audio_language}.mkv"
+    return f"{base}.{track}.{audio_language}.mkv"
+
+
+# Function to extract a single audio track
+def extract_audio_track(debug, filename, track, language, name):
+    audio_filename = get_extracted_audio_filename(filename, track, language)
     command = ["mkvextract", filename, "tracks", f"{track}:{audio_filename}"]
 
     if debug:
         print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
 
-    result = subprocess.run(command, capture_output=True, text=True)
+    with io_slot(filename):
+        result = subprocess.run(command, capture_output=True, text=True)
     if result.returncode != 0:
         raise Exception("Error executing mkvextract command: " + result.stderr)
 
@@ -38,6 +49,22 @@ def extract_audio_tracks_in_mkv(internal_threads, debug, filename, track_numbers
     if debug:
         print()
 
+    audio_filenames = [get_extracted_audio_filename(filename, track, language)
+                       for track, language in zip(track_numbers, audio_languages)]
+
+    # Already written by the demux stage
+    if is_demuxed(filename, 'audio', audio_filenames):
+        return audio_filenames, list(audio_languages), list(audio_names), ['mkv'] * len(track_numbers)
+
+    # mkvextract can write all tracks while reading the file once, which is only
+    # slower if the tracks are written to other devices than the source file
+    if is_same_device([filename] + audio_filenames):
+        result = run_mkvextract(debug, filename, list(zip(track_numbers, audio_filenames)))
+        if result.returncode != 0:
+            raise Exception("Error executing mkvextract command: " + result.stderr)
+
+        return audio_filenames, list(audio_languages), list(audio_names), ['mkv'] * len(track_numbers)
+
     # Use ThreadPoolExecutor to handle multithreading
     with concurrent.futures.ThreadPoolExecutor(max_workers=internal_threads) as executor:
         # Create a mapping of futures to their inputs for ordering
@@ -122,43 +149,77 @@ def channels_to_int(ch):
 
 def detect_source_channels_and_layout(debug, file):
     try:
-        # Use ffprobe to extract audio stream data in JSON format
-        command_probe = [
-            'ffprobe', '-i', file, '-show_streams', '-select_streams', 'a', '-print_format', 'json'
-        ]
-        result = subprocess.run(command_probe, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        audio_info = json.loads(result.stdout)
-
-        if 'streams' not in audio_info or not audio_info['streams']:
-            return None, None  # No audio streams found
-
         # Assume the first audio stream is the relevant one
-        audio_stream = audio_info['streams'][0]
-        channel_layout = audio_stream.get('channel_layout', '')
-        channels = audio_stream.get('channels', 0)
-
-        # Map codec layout strings to the desired format
-        channel_map = {
-            '7.1': (8, '7.1'),
-            '5.1(side)': (6, '5.1(side)'),
-            '5.1': (6, '5.1'),
-            'stereo': (2, 'stereo'),
-            '2.0': (2, 'stereo'),
-            'mono': (1, 'mono'),
-            '1.0': (1, 'mono')
-        }
-
-        for layout, (num_channels, label) in channel_map.items():
-            if layout in channel_layout:
-                return num_channels, label
-
-        return channels, None  # Default if no match found
+        return MediaProbe(file).get_audio_channels_and_layout()
 
     except (subprocess.SubprocessError, json.JSONDecodeError) as e:
         print(f"Error processing file: {e}")
         return None, None
 
 
+# Serializes the loudness analysis of each source track, so that it only runs once
+loudness_locks = defaultdict(threading.Lock)
+loudness_locks_lock = threading.Lock()
+
+
+def measure_loudness(debug, file):
+    # First pass of the EOS gain staging: measures the integrated loudness (LUFS) and the
+    # true peak (dBTP) of the track. Stored with the probe data, so that all preferences
+    # using the same source track (and resumed runs) reuse the measurement.
+    with loudness_locks_lock:
+        file_lock = loudness_locks[os.path.abspath(file)]
+
+    with file_lock:
+        loudness = get_cached_probe(file, 'loudness')
+        if loudness is not None:
+            return loudness
+
+        command = ["ffmpeg", "-nostats", "-i", file, "-map", "0:a:0",
+                   "-af", "loudnorm=print_format=json", "-f", "null", "-"]
+        if debug:
+            print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
+        result = subprocess.run(command, capture_output=True, text=True)
+
+        # The measurement is the last JSON object in the output
+        loudness = {}
+        json_start = result.stderr.rfind('{')
+        if result.returncode == 0 and json_start != -1:
+            try:
+                measured = json.loads(result.stderr[json_start:result.stderr.rfind('}') + 1])
+                loudness = {'integrated': float(measured['input_i']), 'true_peak': float(measured['input_tp'])}
+            except (json.JSONDecodeError, KeyError, ValueError):
+                loudness = {}
+        store_cached_probe(file, 'loudness', loudness)
+        return loudness
+
+
+def get_eos_volume(debug, file, transformation, source_channels):
+    # Gain applied before the EOS compressor. Without EOS_TARGET_LOUDNESS, stereo sources are
+    # lowered to make the compressor not be too aggressive. Otherwise, the gain brings the
+    # measured loudness to the target, without pushing the peaks above 0 dBFS.
+    if transformation != 'EOS':
+        return 1.0
+
+    target_loudness = check_config(config, 'audio', 'eos_target_loudness')
+    if target_loudness:
+        loudness = measure_loudness(debug, file)
+        if loudness and loudness['integrated'] > -70:
+            gain_db = float(target_loudness) - loudness['integrated']
+            gain_db = min(gain_db, -loudness['true_peak'])
+            gain_db = max(-12.0, min(12.0, gain_db))
+            return round(10 ** (gain_db / 20), 4)
+
+    return 0.8 if source_channels <= 2 else 1.0
+
+
+def get_eos_staging(transformation, source_channels):
+    # Describes the EOS gain staging for the audio cache key, without measuring the track
+    target_loudness = check_config(config, 'audio', 'eos_target_loudness')
+    if transformation == 'EOS' and target_loudness:
+        return f"{float(target_loudness):g} LUFS"
+    return 0.8 if transformation == 'EOS' and source_channels <= 2 else 1.0
+
+
 def get_pan_filter(source_channels, layout):
     if layout in ('5.1', '5.1(side)'):
         # Channels: FL, FR, FC, LFE, BL, BR
@@ -218,13 +279,31 @@ def get_pan_filter(source_channels, layout):
         return None
 
 
-def encode_single_preference(file, index, debug, languages, track_names, transformation, codec, ch_str,
-                             custom_ffmpeg_options):
-    base_and_lang_with_id, _, extension = file.rpartition('.')
-    base_with_id, _, lang = base_and_lang_with_id.rpartition('.')
-    base, _, original_track_id = base_with_id.rpartition('.')
+def run_piped_encode(debug, decode_cmd, encode_cmd):
+    # Runs the decoder and the encoder at the same time, connected by a pipe
+    if debug:
+        print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(decode_cmd)} | {' '.join(encode_cmd)}{RESET}")
+
+    decode_process = subprocess.Popen(decode_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    encode_process = subprocess.Popen(encode_cmd, stdin=decode_process.stdout,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Let the decoder get SIGPIPE if the encoder exits early
+    decode_process.stdout.close()
+    encode_stdout, encode_stderr = encode_process.communicate()
+    decode_stderr = decode_process.stderr.read().decode('utf-8', errors='replace')
+    decode_process.stderr.close()
+    decode_process.wait()
+
+    if decode_process.returncode != 0:
+        raise subprocess.CalledProcessError(decode_process.returncode, decode_cmd, stderr=decode_stderr)
+    if encode_process.returncode != 0:
+        print('')
+        print(f"{GREY}[UTC {get_timestamp()}] {RED}[ERROR]{RESET} {encode_stderr}")
+        print(f"{RESET}")
+        raise subprocess.CalledProcessError(encode_process.returncode, encode_cmd, stderr=encode_stderr)
 
-    source_channels, source_layout = detect_source_channels_and_layout(debug, file)
+
+def get_chosen_channels_and_layout(codec, ch_str, source_channels, source_layout):
     chosen_channels = channels_to_int(ch_str) if ch_str else None
     if chosen_channels is None and source_channels is not None:
         chosen_channels = source_channels
@@ -246,60 +325,44 @@ def encode_single_preference(file, index, debug, languages, track_names, transfo
     elif chosen_channels == 1:
         chosen_layout = 'Mono'
 
-    unique_id = str(uuid.uuid4())
-    track_name = track_names[index].replace(" (Original)", "")
+    return chosen_channels, chosen_layout
 
+
+def is_copy_preference(transformation, codec):
     # If original no transformation or empty, just copy
-    if codec == 'ORIG' and transformation is None or codec == '':
-        final_out_ext = extension
-        final_out = f"{base}.{unique_id}.{lang}.{final_out_ext}"
-        command = ["ffmpeg", "-i", file, "-c:a", "copy"] + custom_ffmpeg_options + [final_out]
-        if debug:
-            print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
-        subprocess.run(command, capture_output=True, text=True, check=True)
+    return codec == 'ORIG' and transformation is None or codec == ''
 
-        pref_audio_formats = check_config(config, 'audio', 'pref_audio_formats')
-        audio_preferences = parse_preferred_codecs(pref_audio_formats)
 
-        if track_name:
-            if track_name == 'Original':
-                track_name = f"{track_name}"
-            elif not track_name.endswith(' (Original)'):
-                if len(audio_preferences) == 1:
-                    if len(audio_preferences) == 1 and "ORIG" in audio_preferences:
-                        pass
-                else:
-                    track_name = f"{track_name} (Original)"
-            else:
-                track_name = f"{track_name}"
-        else:
+def get_copy_track_name(track_name):
+    pref_audio_formats = check_config(config, 'audio', 'pref_audio_formats')
+    audio_preferences = parse_preferred_codecs(pref_audio_formats)
+
+    if track_name:
+        if track_name == 'Original':
+            track_name = f"{track_name}"
+        elif not track_name.endswith(' (Original)'):
             if len(audio_preferences) == 1:
                 if len(audio_preferences) == 1 and "ORIG" in audio_preferences:
                     pass
             else:
-                track_name = "Original"
-        return final_out_ext, languages[index], track_name, unique_id
-
-    # Unique temp wav
-    temp_wav = f"{base}.{unique_id}.{lang}.temp.wav"
-
-    # Decode to WAV
-    decode_cmd = ["ffmpeg", "-i", file, "-c:a", "pcm_s16le", "-f", "wav"]
-    # If the source is Stereo, and the transformation is EOS, decrease
-    # the overall volume to make the EOS compressor not be too aggressive
-    if source_channels <= 2 and transformation == "EOS":
-        decode_cmd += ['-af', 'volume=0.8']
-    if debug:
-        print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(decode_cmd)}{RESET}")
-    subprocess.run(decode_cmd + [temp_wav], capture_output=True, text=True, check=True)
+                track_name = f"{track_name} (Original)"
+        else:
+            track_name = f"{track_name}"
+    else:
+        if len(audio_preferences) == 1:
+            if len(audio_preferences) == 1 and "ORIG" in audio_preferences:
+                pass
+        else:
+            track_name = "Original"
+    return track_name
 
-    final_codec = codec.lower()
-    if final_codec in ('orig', 'eos'):
-        final_codec = extension
 
-    final_out_ext = final_codec if final_codec != 'orig' else extension
-    final_out = f"{base}.{unique_id}.{lang}.{final_out_ext}"
+def get_encode_options(transformation, codec, source_channels, chosen_layout, track_name):
+    # Returns the codec options, the audio filter (if any), the channel
+    # options and the track name of the encoded track
     ffmpeg_final_opts = []
+    audio_filter = None
+    channel_opts = []
     track_name_final = ''
 
     # Codec settings
@@ -366,12 +429,11 @@ def encode_single_preference(file, index, debug, languages, track_names, transfo
         pan_filter = get_pan_filter(source_channels, chosen_layout)
 
         if pan_filter:
-            eos_filter = f'[0:a]{compand_filter},{pan_filter}'
+            audio_filter = f'{compand_filter},{pan_filter}'
         else:
             # If no pan filter for this layout, just apply compand and limiter
-            eos_filter = f'[0:a]{compand_filter}'
+            audio_filter = compand_filter
 
-        ffmpeg_final_opts += ["-filter_complex", eos_filter]
         chosen_layout_name = chosen_layout
         if chosen_layout == "5.1(side)":
             chosen_layout_name = "5.1"
@@ -381,29 +443,248 @@ def encode_single_preference(file, index, debug, languages, track_names, transfo
             track_name_final = f"Even-Out-Sound {chosen_layout_name}"
     else:
         if chosen_layout == '5.1':
-            ffmpeg_final_opts += ['-af', 'channelmap=0|1|2|3|4|5:5.1']
+            audio_filter = 'channelmap=0|1|2|3|4|5:5.1'
         elif chosen_layout == '5.1(side)':
-            ffmpeg_final_opts += ['-af', 'channelmap=0|1|2|3|4|5:5.1(side)']
+            audio_filter = 'channelmap=0|1|2|3|4|5:5.1(side)'
         elif chosen_layout == '7.1':
-            ffmpeg_final_opts += ['-af', 'channelmap=0|1|2|3|4|5|6|7:7.1']
+            audio_filter = 'channelmap=0|1|2|3|4|5|6|7:7.1'
         elif chosen_layout == 'Stereo':
-            ffmpeg_final_opts += ['-ac', '2']  # Use automatic downmixing
+            channel_opts = ['-ac', '2']  # Use automatic downmixing
         elif chosen_layout == 'Mono':
-            ffmpeg_final_opts += ['-ac', '1']  # Use automatic downmixing
+            channel_opts = ['-ac', '1']  # Use automatic downmixing
+
+    return ffmpeg_final_opts, audio_filter, channel_opts, track_name_final
+
 
-    final_cmd = ["ffmpeg", "-i", temp_wav] + ffmpeg_final_opts + custom_ffmpeg_options + [final_out]
+def get_encoded_audio_filename(file, codec, unique_id):
+    base_and_lang_with_id, _, extension = file.rpartition('.')
+    base_with_id, _, lang = base_and_lang_with_id.rpartition('.')
+    base, _, original_track_id = base_with_id.rpartition('.')
+
+    final_codec = codec.lower()
+    if final_codec in ('orig', 'eos', ''):
+        final_codec = extension
+
+    final_out_ext = final_codec if final_codec != 'orig' else extension
+    return f"{base}.{unique_id}.{lang}.{final_out_ext}", final_out_ext
+
+
+def get_eos_engine(transformation, audio_filter, source_channels, source_layout):
+    # 'numpy' if the EOS filters should be computed in-process, otherwise 'ffmpeg'
+    if transformation != 'EOS' or check_config(config, 'audio', 'eos_engine') != 'numpy':
+        return 'ffmpeg'
+    if not is_numpy_eos_supported(audio_filter, source_channels, source_layout):
+        return 'ffmpeg'
+    return 'numpy'
+
+
+def get_encode_settings(transformation, codec, ch_str, staging, chosen_layout, ffmpeg_final_opts,
+                        audio_filter, channel_opts, custom_ffmpeg_options, engine):
+    # Everything that affects the encoded output, used as part of the audio cache key
+    return {'preference': [transformation, codec, ch_str], 'layout': chosen_layout, 'staging': staging,
+            'filter': audio_filter, 'options': ffmpeg_final_opts + channel_opts + custom_ffmpeg_options,
+            'engine': engine}
+
+
+def encode_single_preference(file, index, debug, languages, track_names, transformation, codec, ch_str,
+                             custom_ffmpeg_options):
+    base_and_lang_with_id, _, extension = file.rpartition('.')
+    base_with_id, _, lang = base_and_lang_with_id.rpartition('.')
+    base, _, original_track_id = base_with_id.rpartition('.')
+
+    source_channels, source_layout = detect_source_channels_and_layout(debug, file)
+    chosen_channels, chosen_layout = get_chosen_channels_and_layout(codec, ch_str, source_channels, source_layout)
+
+    unique_id = str(uuid.uuid4())
+    track_name = track_names[index].replace(" (Original)", "")
+
+    if is_copy_preference(transformation, codec):
+        final_out, final_out_ext = get_encoded_audio_filename(file, '', unique_id)
+        command = ["ffmpeg", "-i", file, "-c:a", "copy"] + custom_ffmpeg_options + [final_out]
+        if debug:
+            print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
+        subprocess.run(command, capture_output=True, text=True, check=True)
+
+        return final_out_ext, languages[index], get_copy_track_name(track_name), unique_id
+
+    final_out, final_out_ext = get_encoded_audio_filename(file, codec, unique_id)
+    ffmpeg_final_opts, audio_filter, channel_opts, track_name_final = get_encode_options(
+        transformation, codec, source_channels, chosen_layout, track_name)
+
+    eos_engine = get_eos_engine(transformation, audio_filter, source_channels, source_layout)
+    cache_key = get_audio_cache_key(get_source_fingerprint(file), get_encode_settings(
+        transformation, codec, ch_str, get_eos_staging(transformation, source_channels), chosen_layout,
+        ffmpeg_final_opts, audio_filter, channel_opts, custom_ffmpeg_options, eos_engine))
+    if fetch_cached_audio(cache_key, final_out):
+        return final_out_ext, languages[index], track_name_final, unique_id
+
+    volume = get_eos_volume(debug, file, transformation, source_channels)
+    volume_filters = ['-af', f'volume={volume:g}'] if volume != 1.0 else []
+
+    if eos_engine == 'numpy':
+        run_numpy_eos(debug, file, volume_filters, audio_filter, source_channels, source_layout,
+                      ffmpeg_final_opts + channel_opts + custom_ffmpeg_options, final_out)
+        store_cached_audio(cache_key, final_out)
+        return final_out_ext, languages[index], track_name_final, unique_id
+
+    keep_temp_wav = check_config(config, 'audio', 'keep_temp_wav')
+
+    # Decode to 16-bit PCM, either to a temp WAV or streamed directly to the encoder
+    # EOS gain staging is applied here, before the compressor
+    decode_cmd = ["ffmpeg", "-i", file, "-c:a", "pcm_s16le"] + volume_filters
+
+    if keep_temp_wav:
+        # Unique temp wav
+        temp_wav = f"{base}.{unique_id}.{lang}.temp.wav"
+        decode_cmd += ["-f", "wav"]
+        if debug:
+            print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(decode_cmd)}{RESET}")
+        subprocess.run(decode_cmd + [temp_wav], capture_output=True, text=True, check=True)
+        encode_input = ["-i", temp_wav]
+    else:
+        # NUT keeps the channel layout and has no 4 GB size limit, unlike WAV
+        decode_cmd = decode_cmd[:1] + ["-nostats", "-loglevel", "error"] + decode_cmd[1:] + ["-f", "nut", "pipe:1"]
+        encode_input = ["-f", "nut", "-i", "pipe:0"]
+
+    filter_opts = []
+    if transformation == 'EOS':
+        filter_opts += ["-filter_complex", f'[0:a]{audio_filter}']
+    elif audio_filter:
+        filter_opts += ['-af', audio_filter]
+
+    final_cmd = (["ffmpeg"] + encode_input + ffmpeg_final_opts + filter_opts + channel_opts +
+                 custom_ffmpeg_options + [final_out])
+
+    if keep_temp_wav:
+        if debug:
+            print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(final_cmd)}{RESET}")
+        result = subprocess.run(final_cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            print('')
+            print(f"{GREY}[UTC {get_timestamp()}] {RED}[ERROR]{RESET} {result.stderr}")
+            print(f"{RESET}")
+        result.check_returncode()
+
+        os.remove(temp_wav)
+    else:
+        run_piped_encode(debug, decode_cmd, final_cmd)
+
+    store_cached_audio(cache_key, final_out)
+
+    return final_out_ext, languages[index], track_name_final, unique_id
+
+
+def run_ffmpeg_outputs(debug, command):
+    # Returns False (after printing the error) if ffmpeg failed
     if debug:
-        print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(final_cmd)}{RESET}")
-    result = subprocess.run(final_cmd, capture_output=True, text=True)
+        print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
+    result = subprocess.run(command, capture_output=True, text=True)
     if result.returncode != 0:
         print('')
         print(f"{GREY}[UTC {get_timestamp()}] {RED}[ERROR]{RESET} {result.stderr}")
         print(f"{RESET}")
-    result.check_returncode()
+        return False
+    return True
 
-    os.remove(temp_wav)
 
-    return final_out_ext, languages[index], track_name_final, unique_id
+def encode_all_preferences(file, index, debug, languages, track_names, preferences, custom_ffmpeg_options):
+    # Decodes the source track once, and writes every requested format from the same
+    # ffmpeg process using asplit. Returns one result per preference, in order
+    # (None for formats that could not be made).
+    source_channels, source_layout = detect_source_channels_and_layout(debug, file)
+    track_name = track_names[index].replace(" (Original)", "")
+
+    source_fingerprint = None
+    if any(not is_copy_preference(transformation, codec) for transformation, codec, ch_str in preferences):
+        source_fingerprint = get_source_fingerprint(file)
+
+    filter_parts = []
+    copy_args = []
+    copy_outputs = []
+    output_args = []
+    encoded_outputs = []
+    results = [None] * len(preferences)
+    for pref_index, (transformation, codec, ch_str) in enumerate(preferences):
+        unique_id = str(uuid.uuid4())
+
+        if is_copy_preference(transformation, codec):
+            final_out, final_out_ext = get_encoded_audio_filename(file, '', unique_id)
+            copy_args += ["-map", "0:a", "-c:a", "copy"] + custom_ffmpeg_options + [final_out]
+            copy_outputs.append((pref_index, None, final_out))
+            results[pref_index] = (final_out_ext, languages[index], get_copy_track_name(track_name), unique_id)
+            continue
+
+        chosen_channels, chosen_layout = get_chosen_channels_and_layout(codec, ch_str, source_channels, source_layout)
+        final_out, final_out_ext = get_encoded_audio_filename(file, codec, unique_id)
+        ffmpeg_final_opts, audio_filter, channel_opts, track_name_final = get_encode_options(
+            transformation, codec, source_channels, chosen_layout, track_name)
+
+        eos_engine = get_eos_engine(transformation, audio_filter, source_channels, source_layout)
+        if eos_engine == 'numpy':
+            # The EOS engine runs in its own pipeline, outside of the shared ffmpeg process
+            results[pref_index] = encode_single_preference_or_none(file, index, debug, languages, track_names,
+                                                                   preferences[pref_index], custom_ffmpeg_options)
+            continue
+        results[pref_index] = (final_out_ext, languages[index], track_name_final, unique_id)
+
+        cache_key = get_audio_cache_key(source_fingerprint, get_encode_settings(
+            transformation, codec, ch_str, get_eos_staging(transformation, source_channels), chosen_layout,
+            ffmpeg_final_opts, audio_filter, channel_opts, custom_ffmpeg_options, eos_engine))
+        if fetch_cached_audio(cache_key, final_out):
+            continue
+
+        volume = get_eos_volume(debug, file, transformation, source_channels)
+
+        # Same processing as the separate decode to 16-bit PCM followed by the encode
+        chain = []
+        if volume != 1.0:
+            chain.append(f'volume={volume:g}')
+        chain.append('aformat=sample_fmts=s16')
+        if audio_filter:
+            chain.append(audio_filter)
+        filter_parts.append(f"[s{pref_index}]{','.join(chain)}[o{pref_index}]")
+
+        output_args += (["-map", f"[o{pref_index}]"] + ffmpeg_final_opts + channel_opts +
+                         custom_ffmpeg_options + [final_out])
+        encoded_outputs.append((pref_index, cache_key, final_out))
+
+    failed_outputs = []
+
+    # The copies are made by a separate command, so that they do not depend on the encoders
+    if copy_outputs and not run_ffmpeg_outputs(debug, ["ffmpeg", "-i", file] + copy_args):
+        failed_outputs += copy_outputs
+
+    if encoded_outputs:
+        filter_parts.insert(0, "[0:a]asplit=" + str(len(encoded_outputs)) +
+                            ''.join(f"[s{pref_index}]" for pref_index, cache_key, final_out in encoded_outputs))
+        command = ["ffmpeg", "-i", file, "-filter_complex", ';'.join(filter_parts)] + output_args
+        if run_ffmpeg_outputs(debug, command):
+            for pref_index, cache_key, final_out in encoded_outputs:
+                store_cached_audio(cache_key, final_out)
+        else:
+            failed_outputs += encoded_outputs
+
+    # If the shared command failed, every format is made on its own, so that
+    # one failing encoder only loses its own format (as with KEEP_TEMP_WAV)
+    for pref_index, cache_key, final_out in failed_outputs:
+        if os.path.exists(final_out):
+            os.remove(final_out)
+        results[pref_index] = encode_single_preference_or_none(file, index, debug, languages, track_names,
+                                                               preferences[pref_index], custom_ffmpeg_options)
+
+    return results
+
+
+def encode_single_preference_or_none(file, index, debug, languages, track_names, preference, custom_ffmpeg_options):
+    transformation, codec, ch_str = preference
+    try:
+        return encode_single_preference(file, index, debug, languages, track_names,
+                                        transformation, codec, ch_str, custom_ffmpeg_options)
+    except Exception as e:
+        if debug:
+            print(f"Error processing preference {preference}: {e}")
+            raise
+        return None
 
 
 def encode_audio_tracks(internal_threads, debug, audio_files, languages, track_names, preferred_codec_string):
@@ -412,6 +693,7 @@ def encode_audio_tracks(internal_threads, debug, audio_files, languages, track_n
 
     preferences = parse_preferred_codecs(preferred_codec_string)
     custom_ffmpeg_options = []
+    keep_temp_wav = check_config(config, 'audio', 'keep_temp_wav')
 
     if debug:
         print(f"{GREY}[UTC {get_timestamp()}] [AUDIO DEBUG] {RESET}Audio format preferences:\n\n{GREEN}{preferences}{RESET}\n")
@@ -420,12 +702,20 @@ def encode_audio_tracks(internal_threads, debug, audio_files, languages, track_n
     futures_map = {}
     with concurrent.futures.ThreadPoolExecutor(max_workers=internal_threads) as executor:
         for track_index, file in enumerate(audio_files):
-            for pref_index, (transformation, codec, ch_str) in enumerate(preferences):
+            if keep_temp_wav:
+                # One decode per preference, so that every step can be inspected
+                for pref_index, (transformation, codec, ch_str) in enumerate(preferences):
+                    future = executor.submit(
+                        encode_single_preference, file, track_index, debug, languages, track_names,
+                        transformation, codec, ch_str, custom_ffmpeg_options
+                    )
+                    futures_map[future] = (track_index, pref_index)
+            else:
                 future = executor.submit(
-                    encode_single_preference, file, track_index, debug, languages, track_names,
-                    transformation, codec, ch_str, custom_ffmpeg_options
+                    encode_all_preferences, file, track_index, debug, languages, track_names,
+                    preferences, custom_ffmpeg_options
                 )
-                futures_map[future] = (track_index, pref_index)
+                futures_map[future] = (track_index, None)
 
         # Collect results
         results_map = {}
@@ -434,7 +724,12 @@ def encode_audio_tracks(internal_threads, debug, audio_files, languages, track_n
             try:
                 res = future.result()
                 # Store result keyed by (track_idx, pref_idx) so we can restore order
-                results_map[(track_idx, pref_idx)] = res
+                if pref_idx is None:
+                    for index, pref_res in enumerate(res):
+                        if pref_res is not None:
+                            results_map[(track_idx, index)] = pref_res
+                else:
+                    results_map[(track_idx, pref_idx)] = res
             except Exception as e:
                 if debug:
                     print(f"Error processing track {track_idx}, preference {pref_idx}: {e}")
@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+import subprocess
+
+from modules.misc import *
+from modules.probe import *
+from modules.content_cache import ContentCache
+
+
+# Content-addressed cache of encoded audio tracks, so that reprocessing the same
+# release (re-download, upgrade or a retry) does not encode the audio again.
+# Entries are hard-linked in and out of the cache, and evicted by last use.
+audio_cache = None
+ffmpeg_version = None
+
+# Number of bytes read from the start and the end of a source track when hashing it
+AUDIO_CACHE_SAMPLE_SIZE = 8 * 1024 * 1024
+
+
+def init_audio_cache(temp_dir):
+    global audio_cache
+
+    max_size_gb = float(check_config(config, 'audio', 'audio_cache_size') or 0)
+    if max_size_gb <= 0:
+        audio_cache = None
+        return
+
+    # Kept next to the TEMP folder by default, as hard links only work within one filesystem
+    cache_dir = check_config(config, 'audio', 'audio_cache_dir')
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(temp_dir.rstrip('/'))), '.audio_cache')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        audio_cache = None
+        return
+    audio_cache = ContentCache(cache_dir, max_size_gb * 1024 ** 3, link=True)
+
+
+def get_ffmpeg_version():
+    global ffmpeg_version
+    if ffmpeg_version is None:
+        try:
+            result = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True)
+            ffmpeg_version = result.stdout.splitlines()[0] if result.stdout else ''
+        except OSError:
+            ffmpeg_version = ''
+    return ffmpeg_version
+
+
+def get_source_fingerprint(file):
+    # Size, the first and last few MB of the track and its stream parameters (codec,
+    # channels, sample rate etc.), which is enough to tell extracted tracks apart
+    # without reading a multi-GB lossless track in full. None if the cache is disabled.
+    if not audio_cache:
+        return None
+    try:
+        size = os.path.getsize(file)
+    except OSError:
+        return None
+    digest = hashlib.sha1(str(size).encode('utf-8'))
+    with open(file, 'rb') as f:
+        digest.update(f.read(AUDIO_CACHE_SAMPLE_SIZE))
+        if size > AUDIO_CACHE_SAMPLE_SIZE * 2:
+            f.seek(-AUDIO_CACHE_SAMPLE_SIZE, os.SEEK_END)
+            digest.update(f.read(AUDIO_CACHE_SAMPLE_SIZE))
+
+    stream_keys = ('codec_name', 'profile', 'channels', 'channel_layout', 'sample_rate', 'bits_per_raw_sample')
+    streams = [{key: stream.get(key) for key in stream_keys} for stream in MediaProbe(file).get_streams('audio')]
+    digest.update(json.dumps(streams, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_audio_cache_key(source_fingerprint, encode_settings):
+    # encode_settings holds everything that changes the output: the preference
+    # tuple, the filters (compand/pan, channelmap, volume) and the codec options
+    if not source_fingerprint:
+        return None
+    data = json.dumps([source_fingerprint, encode_settings, get_ffmpeg_version()], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def fetch_cached_audio(key, final_out):
+    # Returns True if the encoded track was found, and linked to final_out
+    if not audio_cache or not key:
+        return False
+    return audio_cache.fetch(key, final_out.rpartition('.')[2], final_out)
+
+
+def store_cached_audio(key, final_out):
+    if audio_cache and key:
+        audio_cache.store(key, final_out.rpartition('.')[2], final_out)
+
+
+def get_audio_cache_reserve(directory):
+    # Bytes the cache may still grow by on the filesystem of directory, which
+    # the files admitted to TEMP can not count on
+    return audio_cache.get_reserve(directory) if audio_cache else 0
+
+
+def get_audio_cache_stats():
+    return audio_cache.get_stats() if audio_cache else {'hits': 0, 'misses': 0, 'evictions': 0}
@@ -0,0 +1,31 @@
+import re
+
+
+# Shared by the eos-filter-tweaker and the numpy EOS engine (modules/eos.py)
+def parse_compand_filter(compand_str):
+    """
+    Extract the 'points=' portion from the compand string and return a list of (x, y) floats.
+    """
+    # Example: "points=-110/-110|-100/-105|...:gain=4"
+    # We'll find the substring that starts with "points=" and goes until the next ':' or end of string
+    points_pattern = r'points=([^:]+)'  # capture everything after 'points=' until next ':'
+    match = re.search(points_pattern, compand_str)
+    if not match:
+        return []
+
+    points_str = match.group(1)
+    # points_str looks like: "-110/-110|-100/-105|-90/-95|..."
+
+    # Now split by '|'
+    pairs = points_str.split('|')
+    xy = []
+    for pair in pairs:
+        if '/' in pair:
+            x_str, y_str = pair.split('/')
+            try:
+                x_val = float(x_str)
+                y_val = float(y_str)
+                xy.append((x_val, y_val))
+            except ValueError:
+                pass
+    return xy
@@ -0,0 +1,151 @@
+import os
+import time
+import threading
+
+from modules.misc import *
+from modules.probe import *
+
+
+def read_pressure(resource):
+    # Returns the "some avg10" value from /proc/pressure (PSI), or None if unavailable
+    try:
+        with open(f'/proc/pressure/{resource}', 'r') as f:
+            for line in f:
+                if line.startswith('some'):
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition('=')
+                        if key == 'avg10':
+                            return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def get_file_size_mb(filename):
+    try:
+        return os.path.getsize(filename) / (1024 ** 2)
+    except OSError:
+        return 0.0
+
+
+def get_media_duration(filename):
+    return MediaProbe(filename).get_duration()
+
+
+class AdaptiveLimiter:
+    """AIMD controller for the number of in-flight jobs in one stage.
+
+    The limit grows by one job per window while the measured throughput keeps
+    up, and is cut when throughput drops or the system is under pressure.
+    """
+
+    decrease_factor = 0.75
+    # Throughput must not drop more than this after an increase
+    throughput_tolerance = 0.9
+    # PSI "some avg10" thresholds (percent of time stalled)
+    cpu_pressure_limit = 40.0
+    io_pressure_limit = 30.0
+
+    def __init__(self, logger, header, initial, maximum, unit='MB/s'):
+        self.logger = logger
+        self.header = header
+        self.unit = unit
+        self.maximum = max(1, maximum)
+        self.limit = min(max(1, initial), self.maximum)
+        self.adaptive = check_config(config, 'general', 'adaptive_concurrency')
+        self.max_cpu_usage = int(check_config(config, 'general', 'max_cpu_usage'))
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        # Started by the first submit, so that setup time is not counted
+        self._window_start = None
+        self._window_work = 0.0
+        self._window_jobs = 0
+        self._last_throughput = None
+        self._last_action = None
+
+        self._log(f"start with {self.limit} {print_multi_or_single(self.limit, 'job')} "
+                  f"(max {self.maximum}, adaptive: {self.adaptive})")
+
+    def _log(self, message):
+        log_debug(self.logger, f"[ADAPTIVE] {self.header}: {message}")
+
+    def submit(self, executor, fn, *args, work=0.0):
+        # The executor should be created with max_workers=limiter.maximum,
+        # the limiter then decides how many of those threads may run at once
+        with self._cond:
+            if self._window_start is None:
+                self._window_start = time.monotonic()
+        return executor.submit(self._run, fn, work, *args)
+
+    def _run(self, fn, work, *args):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        try:
+            return fn(*args)
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                # Jobs without work (nothing to process in this stage) would only lower the throughput
+                if work > 0:
+                    self._window_work += work
+                    self._window_jobs += 1
+                    if self.adaptive:
+                        self._adjust()
+                self._cond.notify_all()
+
+    def _adjust(self):
+        # Evaluate once per "round" of jobs at the current limit
+        if self._window_jobs < self.limit:
+            return
+
+        now = time.monotonic()
+        elapsed = max(now - self._window_start, 0.001)
+        throughput = self._window_work / elapsed
+        saturated = self._peak_in_flight >= self.limit
+
+        cpu_pressure = read_pressure('cpu')
+        io_pressure = read_pressure('io')
+        cpu_usage = get_cpu_usage()
+
+        old_limit = self.limit
+        if cpu_pressure is not None and cpu_pressure > self.cpu_pressure_limit:
+            reason = f"cpu pressure {cpu_pressure:.1f}%"
+            self.limit = max(1, int(self.limit * self.decrease_factor))
+        elif io_pressure is not None and io_pressure > self.io_pressure_limit:
+            reason = f"io pressure {io_pressure:.1f}%"
+            self.limit = max(1, int(self.limit * self.decrease_factor))
+        elif cpu_usage > self.max_cpu_usage:
+            reason = f"cpu usage {cpu_usage:.0f}% > {self.max_cpu_usage}%"
+            self.limit = max(1, int(self.limit * self.decrease_factor))
+        elif (self._last_action == 'increase' and self._last_throughput
+              and throughput < self._last_throughput * self.throughput_tolerance):
+            reason = f"throughput dropped from {self._last_throughput:.1f} {self.unit}"
+            self.limit = max(1, int(self.limit * self.decrease_factor))
+        elif saturated and self.limit < self.maximum:
+            reason = "throughput holding"
+            self.limit += 1
+        else:
+            reason = "no change"
+
+        if self.limit > old_limit:
+            self._last_action = 'increase'
+        elif self.limit < old_limit:
+            self._last_action = 'decrease'
+        else:
+            self._last_action = None
+
+        cpu_pressure_print = f"{cpu_pressure:.1f}%" if cpu_pressure is not None else "n/a"
+        io_pressure_print = f"{io_pressure:.1f}%" if io_pressure is not None else "n/a"
+        self._log(f"{old_limit} -> {self.limit} jobs, {throughput:.2f} {self.unit}, "
+                  f"cpu {cpu_usage:.0f}%, cpu psi {cpu_pressure_print}, io psi {io_pressure_print} ({reason})")
+
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_work = 0.0
+        self._window_jobs = 0
+        self._peak_in_flight = self._in_flight
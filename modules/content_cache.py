@@ -0,0 +1,109 @@
+import os
+import shutil
+import threading
+
+
+class ContentCache:
+    """Content-addressed cache of files, evicted by last use.
+
+    Entries are stored as <key[:2]>/<key>.<extension>, written to a .tmp file
+    first and renamed into place. The modification time of an entry marks when
+    it was last used. Entries are hard-linked in and out if link is set, and
+    copied otherwise (for files that are changed in place later on).
+    """
+
+    def __init__(self, cache_dir, max_size, link=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.link = link
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get_path(self, key, extension):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{extension}")
+
+    def copy(self, source, destination):
+        if self.link:
+            try:
+                os.link(source, destination)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(source, destination)
+
+    def fetch(self, key, extension, destination):
+        # Returns True if the entry was found, and linked or copied to destination
+        cache_path = self.get_path(key, extension)
+        try:
+            self.copy(cache_path, destination)
+            os.utime(cache_path)
+        except OSError:
+            with self.lock:
+                self.stats['misses'] += 1
+            return False
+
+        with self.lock:
+            self.stats['hits'] += 1
+        return True
+
+    def store(self, key, extension, source):
+        cache_path = self.get_path(key, extension)
+        temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            self.copy(source, temp_path)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+
+        self.evict()
+
+    def get_entries(self):
+        # (last use, size, path) of every entry
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get_reserve(self, directory):
+        # Bytes the cache may still grow by on the filesystem of directory
+        try:
+            if os.stat(self.cache_dir).st_dev != os.stat(directory).st_dev:
+                return 0
+        except OSError:
+            return 0
+        with self.lock:
+            total_size = sum(size for mtime, size, path in self.get_entries())
+        return max(0, self.max_size - total_size)
+
+    def evict(self):
+        # Removes the least recently used entries until the cache is below max_size
+        with self.lock:
+            entries = self.get_entries()
+            total_size = sum(size for mtime, size, path in entries)
+
+            for mtime, size, path in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_size -= size
+                self.stats['evictions'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
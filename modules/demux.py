@@ -0,0 +1,47 @@
+import os
+import subprocess
+import threading
+
+from modules.misc import *
+from modules.io_limits import *
+
+
+# Tracks written by the demux stage, keyed by the absolute path of the MKV file:
+# {'audio': {track id: path}, 'subtitles': {track id: path}}
+demux_manifests = {}
+demux_manifests_lock = threading.Lock()
+
+
+def set_demux_manifest(filename, manifest):
+    with demux_manifests_lock:
+        demux_manifests[os.path.abspath(filename)] = manifest
+
+
+def get_demux_manifest(filename):
+    with demux_manifests_lock:
+        return demux_manifests.get(os.path.abspath(filename))
+
+
+def clear_demux_manifest(filename):
+    with demux_manifests_lock:
+        demux_manifests.pop(os.path.abspath(filename), None)
+
+
+def is_demuxed(filename, kind, output_files):
+    # True if all output files were already written by the demux stage
+    manifest = get_demux_manifest(filename)
+    if not manifest or not output_files:
+        return False
+    demuxed_files = set(manifest.get(kind, {}).values())
+    return all(output_file in demuxed_files and os.path.isfile(output_file) for output_file in output_files)
+
+
+def run_mkvextract(debug, filename, track_files):
+    # Writes all tracks with one read of the file, track_files is a list of (track id, output file)
+    command = ["mkvextract", filename, "tracks"] + [f"{track}:{output_file}" for track, output_file in track_files]
+
+    if debug:
+        print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
+
+    with io_slot(filename):
+        return subprocess.run(command, capture_output=True, text=True)
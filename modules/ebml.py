@@ -0,0 +1,387 @@
+import os
+import mmap
+import struct
+
+
+# Matroska element IDs (including the length marker bits)
+EBML_HEADER = 0x1A45DFA3
+EBML_DOCTYPE = 0x4282
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+INFO_TITLE = 0x7BA9
+INFO_DURATION = 0x4489
+INFO_TIMESTAMP_SCALE = 0x2AD7B1
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_UID = 0x73C5
+TRACK_TYPE = 0x83
+TRACK_FLAG_ENABLED = 0xB9
+TRACK_FLAG_DEFAULT = 0x88
+TRACK_FLAG_FORCED = 0x55AA
+TRACK_FLAG_HEARING_IMPAIRED = 0x55AB
+TRACK_FLAG_VISUAL_IMPAIRED = 0x55AC
+TRACK_FLAG_TEXT_DESCRIPTIONS = 0x55AD
+TRACK_FLAG_ORIGINAL = 0x55AE
+TRACK_FLAG_COMMENTARY = 0x55AF
+TRACK_NAME = 0x536E
+TRACK_LANGUAGE = 0x22B59C
+TRACK_LANGUAGE_BCP47 = 0x22B59D
+TRACK_CODEC_ID = 0x86
+TRACK_DEFAULT_DURATION = 0x23E383
+TRACK_VIDEO = 0xE0
+VIDEO_PIXEL_WIDTH = 0xB0
+VIDEO_PIXEL_HEIGHT = 0xBA
+VIDEO_DISPLAY_WIDTH = 0x54B0
+VIDEO_DISPLAY_HEIGHT = 0x54BA
+TRACK_AUDIO = 0xE1
+AUDIO_SAMPLING_FREQUENCY = 0xB5
+AUDIO_CHANNELS = 0x9F
+AUDIO_BIT_DEPTH = 0x6264
+CLUSTER = 0x1F43B675
+
+TRACK_TYPES = {1: 'video', 2: 'audio', 17: 'subtitles'}
+
+# Codec names as reported by mkvmerge -J. DTS and TrueHD are left out, as mkvmerge
+# names them after the extensions found in the audio frames (such as 'DTS-HD Master
+# Audio' or 'TrueHD Atmos'), so files with these tracks are identified by mkvmerge.
+CODEC_NAMES = {
+    'V_MPEG4/ISO/AVC': 'AVC/H.264/MPEG-4p10',
+    'V_MPEGH/ISO/HEVC': 'HEVC/H.265/MPEG-H',
+    'V_MPEG1': 'MPEG-1/2',
+    'V_MPEG2': 'MPEG-1/2',
+    'V_AV1': 'AV1',
+    'V_VP8': 'VP8',
+    'V_VP9': 'VP9',
+    'A_AC3': 'AC-3',
+    'A_EAC3': 'E-AC-3',
+    'A_FLAC': 'FLAC',
+    'A_OPUS': 'Opus',
+    'A_VORBIS': 'Vorbis',
+    'A_MPEG/L2': 'MP2',
+    'A_MPEG/L3': 'MP3',
+    'S_TEXT/UTF8': 'SubRip/SRT',
+    'S_TEXT/ASS': 'SubStationAlpha',
+    'S_TEXT/SSA': 'SubStationAlpha',
+    'S_TEXT/WEBVTT': 'WebVTT',
+    'S_HDMV/PGS': 'HDMV PGS',
+    'S_HDMV/TEXTST': 'HDMV TextST',
+    'S_VOBSUB': 'VobSub',
+    'S_DVBSUB': 'DVBSUB',
+}
+
+CODEC_PREFIXES = {
+    'V_MPEG4/ISO/': 'MPEG-4p2',
+    'A_AAC': 'AAC',
+    'A_PCM/': 'PCM',
+}
+
+
+class EbmlError(Exception):
+    """Raised when the file contains something the header reader does not support."""
+
+
+def read_vint(data, pos, keep_marker):
+    if pos >= len(data):
+        raise EbmlError("Unexpected end of data")
+    first = data[pos]
+    if first == 0:
+        raise EbmlError(f"Invalid variable length integer at offset {pos}")
+
+    length = 1
+    mask = 0x80
+    while not first & mask:
+        mask >>= 1
+        length += 1
+    if pos + length > len(data):
+        raise EbmlError("Unexpected end of data")
+
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    return value, length, pos + length
+
+
+def read_element_header(data, pos):
+    element_id, id_length, pos = read_vint(data, pos, True)
+    if id_length > 4:
+        raise EbmlError(f"Invalid element ID at offset {pos}")
+    size, size_length, pos = read_vint(data, pos, False)
+    # All data bits set means "unknown size"
+    if size == (1 << (7 * size_length)) - 1:
+        size = None
+    return element_id, size, pos
+
+
+def iter_elements(data, start, end):
+    pos = start
+    while pos < end:
+        element_id, size, pos = read_element_header(data, pos)
+        if size is None:
+            if element_id != CLUSTER:
+                raise EbmlError(f"Unknown-size element 0x{element_id:X}")
+            yield element_id, pos, None
+            return
+        if pos + size > end:
+            raise EbmlError(f"Element 0x{element_id:X} exceeds its parent")
+        yield element_id, pos, size
+        pos += size
+
+
+def read_uint(data, pos, size):
+    return int.from_bytes(data[pos:pos + size], 'big')
+
+
+def read_float(data, pos, size):
+    if size == 0:
+        return 0.0
+    if size == 4:
+        return struct.unpack('>f', data[pos:pos + 4])[0]
+    if size == 8:
+        return struct.unpack('>d', data[pos:pos + 8])[0]
+    raise EbmlError(f"Invalid float size {size}")
+
+
+def read_string(data, pos, size):
+    return bytes(data[pos:pos + size]).rstrip(b'\x00').decode('utf-8', errors='replace')
+
+
+def get_codec_name(codec_id):
+    if codec_id in CODEC_NAMES:
+        return CODEC_NAMES[codec_id]
+    for prefix, name in CODEC_PREFIXES.items():
+        if codec_id.startswith(prefix):
+            return name
+    raise EbmlError(f"Unsupported codec ID '{codec_id}'")
+
+
+def parse_info(data, start, end):
+    info = {'timestamp_scale': 1000000}
+    for element_id, pos, size in iter_elements(data, start, end):
+        if element_id == INFO_TITLE:
+            info['title'] = read_string(data, pos, size)
+        elif element_id == INFO_DURATION:
+            info['duration'] = read_float(data, pos, size)
+        elif element_id == INFO_TIMESTAMP_SCALE:
+            info['timestamp_scale'] = read_uint(data, pos, size)
+    return info
+
+
+def parse_track_entry(data, start, end):
+    # Defaults as specified by Matroska
+    entry = {'enabled': 1, 'default': 1, 'forced': 0}
+    flags = {
+        TRACK_FLAG_HEARING_IMPAIRED: 'flag_hearing_impaired',
+        TRACK_FLAG_VISUAL_IMPAIRED: 'flag_visual_impaired',
+        TRACK_FLAG_TEXT_DESCRIPTIONS: 'flag_text_descriptions',
+        TRACK_FLAG_ORIGINAL: 'flag_original',
+        TRACK_FLAG_COMMENTARY: 'flag_commentary',
+    }
+
+    for element_id, pos, size in iter_elements(data, start, end):
+        if element_id == TRACK_NUMBER:
+            entry['number'] = read_uint(data, pos, size)
+        elif element_id == TRACK_UID:
+            entry['uid'] = read_uint(data, pos, size)
+        elif element_id == TRACK_TYPE:
+            entry['type'] = read_uint(data, pos, size)
+        elif element_id == TRACK_FLAG_ENABLED:
+            entry['enabled'] = read_uint(data, pos, size)
+        elif element_id == TRACK_FLAG_DEFAULT:
+            entry['default'] = read_uint(data, pos, size)
+        elif element_id == TRACK_FLAG_FORCED:
+            entry['forced'] = read_uint(data, pos, size)
+        elif element_id in flags:
+            entry[flags[element_id]] = read_uint(data, pos, size)
+        elif element_id == TRACK_NAME:
+            entry['name'] = read_string(data, pos, size)
+        elif element_id == TRACK_LANGUAGE:
+            entry['language'] = read_string(data, pos, size)
+        elif element_id == TRACK_LANGUAGE_BCP47:
+            entry['language_ietf'] = read_string(data, pos, size)
+        elif element_id == TRACK_CODEC_ID:
+            entry['codec_id'] = read_string(data, pos, size)
+        elif element_id == TRACK_DEFAULT_DURATION:
+            entry['default_duration'] = read_uint(data, pos, size)
+        elif element_id == TRACK_VIDEO:
+            for child_id, child_pos, child_size in iter_elements(data, pos, pos + size):
+                if child_id == VIDEO_PIXEL_WIDTH:
+                    entry['pixel_width'] = read_uint(data, child_pos, child_size)
+                elif child_id == VIDEO_PIXEL_HEIGHT:
+                    entry['pixel_height'] = read_uint(data, child_pos, child_size)
+                elif child_id == VIDEO_DISPLAY_WIDTH:
+                    entry['display_width'] = read_uint(data, child_pos, child_size)
+                elif child_id == VIDEO_DISPLAY_HEIGHT:
+                    entry['display_height'] = read_uint(data, child_pos, child_size)
+        elif element_id == TRACK_AUDIO:
+            entry.setdefault('channels', 1)
+            entry.setdefault('sampling_frequency', 8000.0)
+            for child_id, child_pos, child_size in iter_elements(data, pos, pos + size):
+                if child_id == AUDIO_SAMPLING_FREQUENCY:
+                    entry['sampling_frequency'] = read_float(data, child_pos, child_size)
+                elif child_id == AUDIO_CHANNELS:
+                    entry['channels'] = read_uint(data, child_pos, child_size)
+                elif child_id == AUDIO_BIT_DEPTH:
+                    entry['bit_depth'] = read_uint(data, child_pos, child_size)
+    return entry
+
+
+def format_track(track_id, entry):
+    if entry.get('type') not in TRACK_TYPES or 'codec_id' not in entry or 'number' not in entry:
+        raise EbmlError(f"Unsupported track entry {entry}")
+    # mkvmerge derives the ISO 639-2 code from the BCP 47 tag when only the latter
+    # is present. Leave that (and every other unusual case) to mkvmerge.
+    if 'language' not in entry and 'language_ietf' in entry:
+        raise EbmlError("Track only has a BCP 47 language tag")
+
+    properties = {
+        'codec_id': entry['codec_id'],
+        'default_track': bool(entry['default']),
+        'enabled_track': bool(entry['enabled']),
+        'forced_track': bool(entry['forced']),
+        'language': entry.get('language', 'eng'),
+        'number': entry['number'],
+    }
+    if 'uid' in entry:
+        properties['uid'] = entry['uid']
+    if 'name' in entry:
+        properties['track_name'] = entry['name']
+    if 'language_ietf' in entry:
+        properties['language_ietf'] = entry['language_ietf']
+    if 'default_duration' in entry:
+        properties['default_duration'] = entry['default_duration']
+    for key in ('flag_hearing_impaired', 'flag_visual_impaired', 'flag_text_descriptions',
+                'flag_original', 'flag_commentary'):
+        if key in entry:
+            properties[key] = bool(entry[key])
+    if 'pixel_width' in entry and 'pixel_height' in entry:
+        properties['pixel_dimensions'] = f"{entry['pixel_width']}x{entry['pixel_height']}"
+        display_width = entry.get('display_width', entry['pixel_width'])
+        display_height = entry.get('display_height', entry['pixel_height'])
+        properties['display_dimensions'] = f"{display_width}x{display_height}"
+    if 'channels' in entry:
+        properties['audio_channels'] = entry['channels']
+        properties['audio_sampling_frequency'] = int(entry['sampling_frequency'])
+    if 'bit_depth' in entry:
+        properties['audio_bits_per_sample'] = entry['bit_depth']
+
+    return {
+        'codec': get_codec_name(entry['codec_id']),
+        'id': track_id,
+        'properties': dict(sorted(properties.items())),
+        'type': TRACK_TYPES[entry['type']],
+    }
+
+
+def parse_mkv_header(data, filename):
+    element_id, size, pos = read_element_header(data, 0)
+    if element_id != EBML_HEADER or size is None:
+        raise EbmlError("Not an EBML file")
+
+    doc_type = None
+    for child_id, child_pos, child_size in iter_elements(data, pos, pos + size):
+        if child_id == EBML_DOCTYPE:
+            doc_type = read_string(data, child_pos, child_size)
+    if doc_type not in ('matroska', 'webm'):
+        raise EbmlError(f"Unsupported document type '{doc_type}'")
+
+    # Skip any top level elements (such as Void) before the Segment
+    pos += size
+    while True:
+        element_id, size, pos = read_element_header(data, pos)
+        if element_id == SEGMENT:
+            break
+        if size is None:
+            raise EbmlError("Unknown-size element before the Segment")
+        pos += size
+
+    # A file that is still being copied or written (unknown size, or shorter than
+    # the Segment) is left to mkvmerge, which waits for it to be complete
+    if size is None or pos + size > len(data):
+        raise EbmlError("Incomplete Segment")
+    segment_start = pos
+    segment_end = pos + size
+
+    info = None
+    tracks = None
+    seek_positions = {}
+
+    # Segment Info and Tracks are read directly if they come before the first Cluster,
+    # otherwise the SeekHead is used to jump to them.
+    for element_id, element_pos, element_size in iter_elements(data, segment_start, segment_end):
+        if element_id == CLUSTER:
+            break
+        if element_id == SEEK_HEAD:
+            for seek_id, seek_pos, seek_size in iter_elements(data, element_pos, element_pos + element_size):
+                if seek_id != SEEK:
+                    continue
+                target_id = None
+                target_position = None
+                for child_id, child_pos, child_size in iter_elements(data, seek_pos, seek_pos + seek_size):
+                    if child_id == SEEK_ID:
+                        target_id = read_uint(data, child_pos, child_size)
+                    elif child_id == SEEK_POSITION:
+                        target_position = read_uint(data, child_pos, child_size)
+                if target_id is not None and target_position is not None:
+                    seek_positions.setdefault(target_id, segment_start + target_position)
+        elif element_id == INFO:
+            info = parse_info(data, element_pos, element_pos + element_size)
+        elif element_id == TRACKS:
+            tracks = (element_pos, element_pos + element_size)
+
+    for target_id in (INFO, TRACKS):
+        if (target_id == INFO and info is not None) or (target_id == TRACKS and tracks is not None):
+            continue
+        if target_id not in seek_positions:
+            continue
+        element_id, size, pos = read_element_header(data, seek_positions[target_id])
+        if element_id != target_id or size is None or pos + size > len(data):
+            raise EbmlError(f"Invalid SeekHead entry for 0x{target_id:X}")
+        if target_id == INFO:
+            info = parse_info(data, pos, pos + size)
+        else:
+            tracks = (pos, pos + size)
+
+    if tracks is None:
+        raise EbmlError("No Tracks element found")
+
+    track_list = []
+    for element_id, element_pos, element_size in iter_elements(data, tracks[0], tracks[1]):
+        if element_id == TRACK_ENTRY:
+            entry = parse_track_entry(data, element_pos, element_pos + element_size)
+            track_list.append(format_track(len(track_list), entry))
+
+    container_properties = {}
+    if info:
+        if 'title' in info:
+            container_properties['title'] = info['title']
+        if 'duration' in info:
+            container_properties['duration'] = int(info['duration'] * info['timestamp_scale'])
+
+    return {
+        'container': {
+            'properties': container_properties,
+            'recognized': True,
+            'supported': True,
+            'type': 'Matroska' if doc_type == 'matroska' else 'WebM',
+        },
+        'file_name': filename,
+        'tracks': track_list,
+    }
+
+
+def read_mkv_header_info(filename):
+    # Returns the same structure as mkvmerge -J (limited to the container
+    # and tracks), or None if the file should be identified by mkvmerge instead.
+    try:
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return parse_mkv_header(data, filename)
+    except (EbmlError, OSError, ValueError, IndexError, struct.error):
+        return None
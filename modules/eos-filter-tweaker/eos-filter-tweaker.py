@@ -1,4 +1,6 @@
+import os
 import re
+import sys
 import tkinter as tk
 from tkinter import ttk
 import matplotlib
@@ -45,35 +47,10 @@ compand_filter_original = (
 
 # --------------------------------------------------------------------
 # 2) Parse the string to get the points (dB_in, dB_out).
-#    We'll store them as a list of (x, y).
+#    Shared with the numpy EOS engine, in modules/compand.py.
 # --------------------------------------------------------------------
-def parse_compand_filter(compand_str):
-    """
-    Extract the 'points=' portion from the compand string and return a list of (x, y) floats.
-    """
-    # Example: "points=-110/-110|-100/-105|...:gain=4"
-    # We'll find the substring that starts with "points=" and goes until the next ':' or end of string
-    points_pattern = r'points=([^:]+)'  # capture everything after 'points=' until next ':'
-    match = re.search(points_pattern, compand_str)
-    if not match:
-        return []
-
-    points_str = match.group(1)
-    # points_str looks like: "-110/-110|-100/-105|-90/-95|..."
-
-    # Now split by '|'
-    pairs = points_str.split('|')
-    xy = []
-    for pair in pairs:
-        if '/' in pair:
-            x_str, y_str = pair.split('/')
-            try:
-                x_val = float(x_str)
-                y_val = float(y_str)
-                xy.append((x_val, y_val))
-            except ValueError:
-                pass
-    return xy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from modules.compand import parse_compand_filter
 
 
 # --------------------------------------------------------------------
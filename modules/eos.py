@@ -0,0 +1,321 @@
+import math
+import subprocess
+
+from modules.misc import *
+from modules.probe import *
+from modules.compand import parse_compand_filter
+
+# NumPy is optional, the ffmpeg compand/pan filters are used without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Native ffmpeg channel order of the layouts used by EOS
+CHANNEL_LAYOUTS = {
+    'mono': ['FC'],
+    'stereo': ['FL', 'FR'],
+    '5.1': ['FL', 'FR', 'FC', 'LFE', 'BL', 'BR'],
+    '5.1(side)': ['FL', 'FR', 'FC', 'LFE', 'SL', 'SR'],
+    '7.1': ['FL', 'FR', 'FC', 'LFE', 'BL', 'BR', 'SL', 'SR'],
+}
+DEFAULT_CHANNEL_LAYOUTS = {1: 'mono', 2: 'stereo', 6: '5.1', 8: '7.1'}
+# Used when a channel referenced by the pan filter is missing from the source
+CHANNEL_ALIASES = {'BL': 'SL', 'BR': 'SR', 'SL': 'BL', 'SR': 'BR', 'FL': 'FC', 'FR': 'FC'}
+
+# Number of frames processed at once
+EOS_BLOCK_FRAMES = 256 * 1024
+# The decay filter is computed in chunks, where its scale factor stays below e^50
+EOS_DECAY_SCALE_LIMIT = 50.0
+# Defaults of the ffmpeg compand filter
+COMPAND_DEFAULT_POINTS = '-70/-70|-60/-20|1/0'
+COMPAND_DEFAULTS = {'attacks': 0.0, 'decays': 0.8, 'soft-knee': 0.01, 'gain': 0.0, 'volume': 0.0, 'delay': 0.0}
+
+
+def parse_compand_options(compand_str):
+    # Returns the options of a compand filter string other than the points,
+    # which are parsed by parse_compand_filter (as in the eos-filter-tweaker)
+    params = dict(COMPAND_DEFAULTS)
+    options = compand_str.split('=', 1)[1] if compand_str.startswith('compand=') else compand_str
+    for option in options.split(':'):
+        name, _, value = option.partition('=')
+        if name in ('attacks', 'decays'):
+            # One value per channel is allowed, the first one is used for all channels
+            params[name] = float(value.replace('|', ' ').split()[0])
+        elif name in params:
+            params[name] = float(value)
+    return params
+
+
+def get_compand_segments(points, soft_knee, gain):
+    # The transfer curve as built by the ffmpeg compand filter (af_compand.c): rows of
+    # (x, y, a, b) in the natural log domain, where y is the gain at x. The odd rows are the
+    # quadratic soft knees between the points, the gain at in_log is y + d * (a * d + b),
+    # with d = in_log - x, on the last row whose x is below in_log.
+    segments = np.zeros(((len(points) + 4) * 2, 4), dtype=np.float64)
+    for i, (x, y) in enumerate(points):
+        segments[2 * (i + 1), :2] = (x, y - x)
+    num = len(points)
+    # 0/0 is added if the curve does not end there
+    if num == 0 or segments[2 * num, 0]:
+        num += 1
+    # Tail off point at the start
+    segments[0, :2] = (segments[2, 0] - 2 * soft_knee, segments[2, 1])
+    num += 1
+
+    # Adjacent colinear segments are joined
+    point = segments[::2]
+    i = 2
+    while i < num:
+        g1 = (point[i - 1, 1] - point[i - 2, 1]) * (point[i, 0] - point[i - 1, 0])
+        g2 = (point[i, 1] - point[i - 1, 1]) * (point[i - 1, 0] - point[i - 2, 0])
+        if g1 == g2:
+            num -= 1
+            point[i - 1:num] = point[i:num + 1].copy()
+        else:
+            i += 1
+
+    point[:, 1] += gain
+    point[:, :2] *= math.log(10) / 20
+
+    radius = soft_knee * math.log(10) / 20
+    # The trailing unused rows are degenerate (0/0), as in ffmpeg
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(4, len(segments), 2):
+            p0, p1, p2 = segments[i - 4], segments[i - 2], segments[i]
+            knee = segments[i - 3]
+            p0[2] = 0
+            p0[3] = (p1[1] - p0[1]) / (p1[0] - p0[0])
+            p1[2] = 0
+            p1[3] = (p2[1] - p1[1]) / (p2[0] - p1[0])
+
+            theta = math.atan2(p1[1] - p0[1], p1[0] - p0[0])
+            r = min(radius, math.hypot(p1[0] - p0[0], p1[1] - p0[1]))
+            knee[0] = p1[0] - r * math.cos(theta)
+            knee[1] = p1[1] - r * math.sin(theta)
+
+            theta = math.atan2(p2[1] - p1[1], p2[0] - p1[0])
+            r = min(radius, math.hypot(p2[0] - p1[0], p2[1] - p1[1]) / 2)
+            x = p1[0] + r * math.cos(theta)
+            y = p1[1] + r * math.sin(theta)
+
+            cx = (knee[0] + p1[0] + x) / 3
+            cy = (knee[1] + p1[1] + y) / 3
+
+            p1[0] = x
+            p1[1] = y
+
+            in1 = cx - knee[0]
+            out1 = cy - knee[1]
+            in2 = p1[0] - knee[0]
+            out2 = p1[1] - knee[1]
+            knee[2] = (out2 / in2 - out1 / in1) / (in2 - in1)
+            knee[3] = out1 / in1 - knee[2] * in1
+    segments[-3, :2] = (0, segments[-2, 1])
+    return segments
+
+
+def parse_pan_filter(pan_str):
+    # 'pan=stereo|FL=0.5*FL+0.6*FC|FR=...' -> ('stereo', {'FL': {'FL': 0.5, 'FC': 0.6}, 'FR': {...}})
+    layout, *channels = pan_str.split('=', 1)[1].split('|')
+    gains = {}
+    for channel in channels:
+        out_name, _, expression = channel.partition('=')
+        gains[out_name.strip()] = {}
+        for term in expression.split('+'):
+            gain, _, in_name = term.strip().partition('*')
+            gains[out_name.strip()][in_name.strip()] = float(gain)
+    return layout, gains
+
+
+def get_pan_matrix(pan_gains, in_layout, out_layout):
+    # Channels that are missing from the source are replaced by their closest
+    # channel (e.g. SL for BL), or otherwise treated as silence
+    in_channels = CHANNEL_LAYOUTS[in_layout]
+    out_channels = CHANNEL_LAYOUTS[out_layout]
+    matrix = np.zeros((len(in_channels), len(out_channels)), dtype=np.float32)
+    for out_index, out_name in enumerate(out_channels):
+        for in_name, gain in pan_gains.get(out_name, {}).items():
+            if in_name not in in_channels:
+                in_name = CHANNEL_ALIASES.get(in_name)
+            if in_name in in_channels:
+                matrix[in_channels.index(in_name), out_index] += gain
+    return matrix
+
+
+def get_source_layout(source_channels, source_layout):
+    if source_layout and source_layout.lower() in CHANNEL_LAYOUTS:
+        return source_layout.lower()
+    return DEFAULT_CHANNEL_LAYOUTS.get(source_channels)
+
+
+def is_numpy_eos_supported(audio_filter, source_channels, source_layout):
+    if np is None or not audio_filter:
+        return False
+    if get_source_layout(source_channels, source_layout) is None:
+        return False
+    filters = audio_filter.split(',')
+    if not filters[0].startswith('compand=') or any(not f.startswith('pan=') for f in filters[1:]):
+        return False
+    # Only the instant attack used by EOS can be computed without a per-sample loop
+    options = parse_compand_options(filters[0])
+    return options['attacks'] == 0 and options['delay'] == 0
+
+
+class EosEngine:
+    """The EOS compand and pan filters, computed on blocks of float PCM samples.
+
+    The envelope and the transfer curve (with its soft knees) are those of the
+    ffmpeg compand filter with an instant attack, computed for a whole block at
+    once. The pan filter is applied as one matrix multiply.
+    """
+
+    def __init__(self, audio_filter, source_channels, source_layout, sample_rate):
+        filters = audio_filter.split(',')
+        options = parse_compand_options(filters[0])
+        self.in_layout = get_source_layout(source_channels, source_layout)
+        self.out_layout = self.in_layout
+        self.pan_matrix = None
+        if len(filters) > 1:
+            self.out_layout, pan_gains = parse_pan_filter(filters[1])
+            self.pan_matrix = get_pan_matrix(pan_gains, self.in_layout, self.out_layout)
+
+        self.in_channels = len(CHANNEL_LAYOUTS[self.in_layout])
+        self.out_channels = len(CHANNEL_LAYOUTS[self.out_layout])
+        self.sample_rate = sample_rate
+
+        self.points = parse_compand_filter(filters[0]) or parse_compand_filter(f"points={COMPAND_DEFAULT_POINTS}")
+        self.segments = get_compand_segments(self.points, options['soft-knee'], options['gain'])
+        # The row of each level is found by a search on the running maximum of x, which
+        # gives the same row as the linear scan in ffmpeg, also where x is not increasing
+        self.segment_limits = np.maximum.accumulate(self.segments[1:, 0])
+        self.in_min_lin = math.exp(self.segments[1, 0])
+        self.out_min_lin = math.exp(self.segments[1, 1])
+
+        # The envelope follows a falling level by decay_coeff of the difference per sample
+        decays = options['decays']
+        if decays > 1.0 / sample_rate:
+            self.decay_log = -1.0 / (sample_rate * decays)
+            self.decay_coeff = 1.0 - math.exp(self.decay_log)
+        else:
+            self.decay_log = None
+            self.decay_coeff = 1.0
+        self.volume = np.full(self.in_channels, 10 ** (options['volume'] / 20))
+
+    def get_decay_filter(self, level):
+        # s[n] = r * s[n - 1] + c * level[n] from s[-1] = 0, where r = 1 - c. Computed as
+        # r^n * c * cumsum(level[i] * r^-i), in chunks that keep r^-i within range.
+        frames = level.shape[0]
+        chunk_frames = max(1, int(EOS_DECAY_SCALE_LIMIT / -self.decay_log))
+        output = np.empty_like(level)
+        previous = np.zeros(level.shape[1])
+        for start in range(0, frames, chunk_frames):
+            chunk = level[start:start + chunk_frames]
+            exponent = np.arange(chunk.shape[0], dtype=np.float64)[:, None] * self.decay_log
+            output[start:start + chunk.shape[0]] = np.exp(exponent) * (
+                previous * math.exp(self.decay_log) + self.decay_coeff * np.cumsum(chunk * np.exp(-exponent), axis=0))
+            previous = output[start + chunk.shape[0] - 1]
+        return output
+
+    def get_envelope(self, level):
+        # ffmpeg updates the envelope per sample by v += (level - v) * coeff, where coeff is
+        # 1 (the instant attack) while the level rises, and decay_coeff otherwise. That equals
+        # v[n] = max(level[n], r * v[n - 1] + c * level[n]), which unrolls to
+        # v[n] = s[n] + max(r^(n + 1) * v[-1], r^(n - j) * (level[j] - s[j]) for j <= n),
+        # with s the decay filter. The maximum is a running maximum in the log domain.
+        if self.decay_log is None:
+            self.volume = level[-1]
+            return level
+        decayed = self.get_decay_filter(level)
+        frames = level.shape[0]
+        step = np.arange(frames, dtype=np.float64)[:, None] * self.decay_log
+        with np.errstate(divide='ignore'):
+            start = np.log(self.volume) + self.decay_log
+            peaks = np.log(np.maximum(level - decayed, 0)) - step
+        peaks = np.maximum.accumulate(np.vstack([start[None, :], peaks]), axis=0)[1:]
+        envelope = decayed + np.exp(peaks + step)
+        self.volume = envelope[-1]
+        return envelope
+
+    def get_gain(self, envelope):
+        # Linear gain of the transfer curve, as get_volume() in af_compand.c
+        in_log = np.log(np.maximum(envelope, self.in_min_lin))
+        index = np.searchsorted(self.segment_limits, in_log)
+        x, y, a, b = (self.segments[index, column] for column in range(4))
+        offset = in_log - x
+        gain = np.exp(y + offset * (a * offset + b))
+        return np.where(envelope < self.in_min_lin, self.out_min_lin, gain)
+
+    def process(self, samples):
+        # samples: float32 array of shape (frames, in_channels)
+        gain = self.get_gain(self.get_envelope(np.abs(samples.astype(np.float64))))
+        output = (samples * gain).astype(np.float32)
+        if self.pan_matrix is not None:
+            output = output @ self.pan_matrix
+        return output.astype(np.float32)
+
+
+def get_sample_rate(file):
+    audio_streams = MediaProbe(file).get_streams('audio')
+    try:
+        return int(audio_streams[0]['sample_rate'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return 48000
+
+
+def run_numpy_eos(debug, file, decode_filters, audio_filter, source_channels, source_layout, encode_opts, final_out):
+    # Streams float PCM from an ffmpeg decoder, through the EOS engine, to an ffmpeg encoder
+    sample_rate = get_sample_rate(file)
+    engine = EosEngine(audio_filter, source_channels, source_layout, sample_rate)
+
+    decode_cmd = (["ffmpeg", "-nostats", "-loglevel", "error", "-i", file] + decode_filters +
+                  ["-ac", str(engine.in_channels), "-f", "f32le", "-c:a", "pcm_f32le", "pipe:1"])
+    encode_cmd = (["ffmpeg", "-nostats", "-loglevel", "error", "-f", "f32le", "-ar", str(sample_rate),
+                   "-ac", str(engine.out_channels), "-channel_layout", engine.out_layout, "-i", "pipe:0"] +
+                  encode_opts + [final_out])
+    if debug:
+        print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(decode_cmd)} | [EOS ENGINE] | "
+              f"{' '.join(encode_cmd)}{RESET}")
+
+    decode_process = subprocess.Popen(decode_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    encode_process = subprocess.Popen(encode_cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.PIPE)
+
+    block_size = EOS_BLOCK_FRAMES * engine.in_channels * 4
+    try:
+        while True:
+            data = decode_process.stdout.read(block_size)
+            if not data:
+                break
+            # A read may end in the middle of a frame
+            remainder = len(data) % (engine.in_channels * 4)
+            if remainder:
+                data += decode_process.stdout.read(engine.in_channels * 4 - remainder)
+            samples = np.frombuffer(data, dtype=np.float32).reshape(-1, engine.in_channels)
+            encode_process.stdin.write(engine.process(samples).tobytes())
+    except BrokenPipeError:
+        pass
+    except Exception:
+        decode_process.kill()
+        encode_process.kill()
+        raise
+    finally:
+        decode_process.stdout.close()
+        try:
+            encode_process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    decode_stderr = decode_process.stderr.read().decode('utf-8', errors='replace')
+    encode_stderr = encode_process.stderr.read().decode('utf-8', errors='replace')
+    decode_process.wait()
+    encode_process.wait()
+
+    if decode_process.returncode != 0:
+        raise subprocess.CalledProcessError(decode_process.returncode, decode_cmd, stderr=decode_stderr)
+    if encode_process.returncode != 0:
+        print('')
+        print(f"{GREY}[UTC {get_timestamp()}] {RED}[ERROR]{RESET} {encode_stderr}")
+        print(f"{RESET}")
+        raise subprocess.CalledProcessError(encode_process.returncode, encode_cmd, stderr=encode_stderr)
@@ -7,16 +7,151 @@ from datetime import datetime
 import concurrent.futures
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Lock
+from collections import defaultdict
 from pathvalidate import sanitize_filename
 
 from modules.misc import *
 from modules.logger import *
+from modules.io_limits import *
+from modules.space import *
+from modules.audio_cache import *
+from modules.ocr_cache import *
+from modules.ledger import *
+
+
+# ioctl request for reflinking a file (btrfs, xfs etc.), from <linux/fs.h>
+FICLONE = 0x40049409
+COPY_FILE_RANGE_CHUNK = 64 * 1024 * 1024
+# Files that are only ever replaced (never edited in place, see break_hardlink), and therefore
+# can be hard-linked into TEMP without risking changes to the original files
+LINKABLE_EXTENSIONS = ('.mkv', '.mp4', '.avi', '.m4v', '.webm', '.ts', '.mov')
+ingest_method_names = {'hardlink': 'hard-linked', 'reflink': 'reflinked',
+                       'copy_file_range': 'copied (copy_file_range)', 'copy': 'copied',
+                       'existing': 'already in TEMP'}
+
+
+# Files that did not fit in TEMP are deferred, and admitted in a later pass
+# once the files of the current pass have left the TEMP folder
+ingest_admission = {'admitted': 0, 'deferred': 0, 'admitted_paths': set()}
+ingest_admission_lock = Lock()
+
+
+def reset_ingest_admission():
+    with ingest_admission_lock:
+        ingest_admission['admitted'] = 0
+        ingest_admission['deferred'] = 0
+        ingest_admission['admitted_paths'] = set()
+
+
+def start_ingest_pass():
+    with ingest_admission_lock:
+        ingest_admission['admitted'] = 0
+        ingest_admission['deferred'] = 0
+
+
+def admit_file(path, admitted):
+    with ingest_admission_lock:
+        if admitted:
+            ingest_admission['admitted'] += 1
+            ingest_admission['admitted_paths'].add(os.path.abspath(path))
+        else:
+            ingest_admission['deferred'] += 1
+
+
+def is_file_admitted(path):
+    # Kept originals (KEEP_ORIGINAL) stay in the input folder, and must not be copied again in a later pass
+    with ingest_admission_lock:
+        return os.path.abspath(path) in ingest_admission['admitted_paths']
+
+
+def has_deferred_files():
+    # True if files are waiting for TEMP space, and the last pass made progress
+    with ingest_admission_lock:
+        return ingest_admission['deferred'] > 0 and ingest_admission['admitted'] > 0
 
 
 def copy_file(src, dst):
     shutil.copy2(src, dst)
 
 
+def reflink_file(src, dst):
+    import fcntl
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def copy_file_range_file(src, dst):
+    # Lets the kernel copy the data (server-side on NFS/SMB), without passing it through Python
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        while os.copy_file_range(src_file.fileno(), dst_file.fileno(), COPY_FILE_RANGE_CHUNK) > 0:
+            pass
+
+
+def ingest_file(src, dst, allow_link=True):
+    # Copies src to dst with the cheapest method that works: a hard link, a reflink,
+    # copy_file_range or a regular copy. Returns (method, bytes copied).
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        # Already hard-linked (e.g. TEMP kept for a resumed run)
+        return 'existing', 0
+
+    # Written under a temporary name and renamed onto dst, so that an existing dst
+    # (which may share its data with an original file) is never opened for writing
+    temp_dst = f"{dst}.ingest.tmp"
+    try:
+        method, bytes_copied = ingest_file_to(src, temp_dst, allow_link)
+        os.replace(temp_dst, dst)
+    except BaseException:
+        if os.path.exists(temp_dst):
+            os.remove(temp_dst)
+        raise
+    return method, bytes_copied
+
+
+def ingest_file_to(src, dst, allow_link):
+    file_size = os.path.getsize(src)
+    if os.path.exists(dst):
+        os.remove(dst)
+
+    if allow_link and src.lower().endswith(LINKABLE_EXTENSIONS) and check_config(config, 'general', 'ingest_hardlinks'):
+        try:
+            os.link(src, dst)
+            return 'hardlink', 0
+        except OSError:
+            pass
+
+    try:
+        reflink_file(src, dst)
+        shutil.copymode(src, dst)
+        return 'reflink', 0
+    except (OSError, ImportError):
+        pass
+
+    with io_slot(src, dst):
+        if hasattr(os, 'copy_file_range'):
+            try:
+                copy_file_range_file(src, dst)
+                shutil.copymode(src, dst)
+                return 'copy_file_range', file_size
+            except OSError:
+                pass
+
+        shutil.copy(src, dst)
+        return 'copy', file_size
+
+
+def break_hardlink(filename):
+    # Must be called before editing a file in place (e.g. with mkvpropedit), so that
+    # an original file that was hard-linked into TEMP is never changed
+    try:
+        if os.stat(filename).st_nlink <= 1:
+            return
+    except OSError:
+        return
+    temp_file = f"{filename}.unlink.tmp"
+    ingest_file(filename, temp_file, allow_link=False)
+    os.replace(temp_file, filename)
+
+
 def move_file(src, dst):
     # Create any necessary subdirectories
     os.makedirs(os.path.dirname(dst), exist_ok=True)
@@ -122,17 +257,24 @@ def get_free_space(directory):
     return shutil.disk_usage(directory).free
 
 
-def move_directory_contents(logger, source_directory, destination_directory, file_counter=[0], total_files=0):
+def move_directory_contents(logger, source_directory, destination_directory, file_counter=None, total_files=0):
+    if file_counter is None:
+        file_counter = [0]
     if not os.path.exists(destination_directory):
         os.makedirs(destination_directory)
 
-    initial_available_space = get_free_space(destination_directory)
+    # Space the caches may still take is not available to the admitted files
+    initial_available_space = max(0, get_free_space(destination_directory) -
+                                  get_audio_cache_reserve(destination_directory) -
+                                  get_ocr_track_cache_reserve(destination_directory))
     available_space = initial_available_space
     skipped_files_counter = [0]
     all_required_space = 0.0
+    admitted_required_space = 0.0
     actual_file_sizes = 0.0
     actual_moved_file_sizes = 0.0
     space_lock = Lock()
+    same_device = is_same_device([source_directory, destination_directory])
     file_counter_lock = Lock()
 
     items = []
@@ -154,7 +296,7 @@ def move_directory_contents(logger, source_directory, destination_directory, fil
     items.sort(key=sort_key)
 
     def move_item(rel_path):
-        nonlocal available_space, actual_file_sizes, all_required_space, actual_moved_file_sizes
+        nonlocal available_space, actual_file_sizes, all_required_space, actual_moved_file_sizes, admitted_required_space
         s = os.path.join(source_directory, rel_path)
         d = os.path.join(destination_directory, rel_path)
 
@@ -162,23 +304,39 @@ def move_directory_contents(logger, source_directory, destination_directory, fil
             if not os.path.exists(d):
                 os.makedirs(d)
         else:
+            if os.path.exists(d) or is_job_resumable(d):
+                # Kept for a resumed run, moving over it would replace it. Deferred
+                # until the file in TEMP has been moved to the output folder.
+                with space_lock:
+                    skipped_files_counter[0] += 1
+                admit_file(s, False)
+                return
             file_size = os.path.getsize(s)
-            required_space = file_size * 3.5
+            # Moving within the same filesystem does not use any extra space
+            required_space = estimate_temp_space(s, ingest_is_free=same_device)
 
             with space_lock:
                 all_required_space += required_space
                 actual_file_sizes += file_size
 
-                if initial_available_space >= all_required_space:
+                # Smaller files may still fit after a larger file was deferred
+                has_space = initial_available_space >= admitted_required_space + required_space
+                if has_space:
+                    admitted_required_space += required_space
                     available_space -= file_size
                     actual_moved_file_sizes += file_size
-                    os.makedirs(os.path.dirname(d), exist_ok=True)
-                    shutil.move(s, d)
-                    with file_counter_lock:
-                        file_counter[0] += 1
-                        print_with_progress_files(logger, file_counter[0], total_files, 'INFO', 'Moving file')
                 else:
                     skipped_files_counter[0] += 1
+            admit_file(s, has_space)
+
+            # The move itself is limited per device instead of by the space lock
+            if has_space:
+                os.makedirs(os.path.dirname(d), exist_ok=True)
+                with io_slot(s, d):
+                    shutil.move(s, d)
+                with file_counter_lock:
+                    file_counter[0] += 1
+                    print_with_progress_files(logger, file_counter[0], total_files, 'INFO', 'Moving file')
 
     max_worker_threads = get_worker_thread_count()
     num_workers = max(1, max_worker_threads)
@@ -199,18 +357,26 @@ def move_directory_contents(logger, source_directory, destination_directory, fil
     }
 
 
-def copy_directory_contents(logger, source_directory, destination_directory, file_counter=[0], total_files=0):
+def copy_directory_contents(logger, source_directory, destination_directory, file_counter=None, total_files=0):
+    if file_counter is None:
+        file_counter = [0]
     if not os.path.exists(destination_directory):
         os.makedirs(destination_directory)
 
-    initial_available_space = get_free_space(destination_directory)
+    # Space the caches may still take is not available to the admitted files
+    initial_available_space = max(0, get_free_space(destination_directory) -
+                                  get_audio_cache_reserve(destination_directory) -
+                                  get_ocr_track_cache_reserve(destination_directory))
     available_space = initial_available_space
     skipped_files_counter = [0]
     all_required_space = 0.0
+    admitted_required_space = 0.0
     actual_file_sizes = 0.0
     actual_copied_file_sizes = 0.0
     space_lock = Lock()
     file_counter_lock = Lock()
+    ingest_methods = defaultdict(int)
+    ingest_bytes_copied = [0]
 
     items = []
     for root, dirs, files in os.walk(source_directory):
@@ -231,7 +397,7 @@ def copy_directory_contents(logger, source_directory, destination_directory, fil
     items.sort(key=sort_key)
 
     def copy_item(rel_path):
-        nonlocal available_space, actual_file_sizes, all_required_space, actual_copied_file_sizes
+        nonlocal available_space, actual_file_sizes, all_required_space, actual_copied_file_sizes, admitted_required_space
         s = os.path.join(source_directory, rel_path)
         d = os.path.join(destination_directory, rel_path)
 
@@ -239,23 +405,39 @@ def copy_directory_contents(logger, source_directory, destination_directory, fil
             if not os.path.exists(d):
                 os.makedirs(d)
         else:
+            if is_file_admitted(s):
+                return
+            if os.path.exists(d) or is_job_resumable(d):
+                # Already in TEMP (kept for a resumed run), copying it again would replace it
+                admit_file(s, True)
+                return
             file_size = os.path.getsize(s)
-            required_space = file_size * 3.5
+            required_space = estimate_temp_space(s)
 
             with space_lock:
                 all_required_space += required_space
                 actual_file_sizes += file_size
 
-                if initial_available_space >= all_required_space:
+                # Smaller files may still fit after a larger file was deferred
+                has_space = initial_available_space >= admitted_required_space + required_space
+                if has_space:
+                    admitted_required_space += required_space
                     available_space -= file_size
                     actual_copied_file_sizes += file_size
-                    os.makedirs(os.path.dirname(d), exist_ok=True)
-                    shutil.copy(s, d)
-                    with file_counter_lock:
-                        file_counter[0] += 1
-                        print_with_progress_files(logger, file_counter[0], total_files, 'INFO', 'Copying file')
                 else:
                     skipped_files_counter[0] += 1
+            admit_file(s, has_space)
+
+            # The copy itself is limited per device instead of by the space lock
+            if has_space:
+                os.makedirs(os.path.dirname(d), exist_ok=True)
+                # I/O slots are taken by ingest_file, only for the methods that copy data
+                method, bytes_copied = ingest_file(s, d)
+                with file_counter_lock:
+                    ingest_methods[method] += 1
+                    ingest_bytes_copied[0] += bytes_copied
+                    file_counter[0] += 1
+                    print_with_progress_files(logger, file_counter[0], total_files, 'INFO', 'Copying file')
 
     max_worker_threads = get_worker_thread_count()
     num_workers = max(1, max_worker_threads)
@@ -270,7 +452,9 @@ def copy_directory_contents(logger, source_directory, destination_directory, fil
         "actual_copied_file_sizes": actual_copied_file_sizes / (1024 ** 3),
         "required_space_gib": all_required_space / (1024 ** 3),
         "available_space_gib": available_space / (1024 ** 3),
-        "skipped_files": skipped_files_counter[0]
+        "skipped_files": skipped_files_counter[0],
+        "ingest_methods": dict(ingest_methods),
+        "ingest_bytes_copied": ingest_bytes_copied[0] / (1024 ** 3)
     }
 
 
@@ -369,7 +553,8 @@ def move_file_to_output(logger, debug, input_file_path, output_folder, folder_st
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
     log_debug(logger, f"Moving file '{input_file_path}' to '{output_path}'")
     if os.path.exists(input_file_path):
-        shutil.move(input_file_path, output_path)
+        with io_slot(input_file_path, output_path):
+            shutil.move(input_file_path, output_path)
 
     return {
         "output_folder": new_folders,
@@ -387,8 +572,56 @@ def safe_delete_dir(directory_path):
         pass
 
 
+# Files reported as fully written by the input watcher (--watch),
+# as file path -> (size, mtime_ns) at the time they were reported
+known_stable_files = {}
+known_stable_files_lock = Lock()
+input_watch_active = [False]
+
+
+def set_input_watch_active(active):
+    input_watch_active[0] = active
+
+
+def register_stable_file(file_path):
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return
+    with known_stable_files_lock:
+        known_stable_files[os.path.abspath(file_path)] = (stat.st_size, stat.st_mtime_ns)
+
+
+def prune_known_stable_files():
+    # Forgets files that have been moved away or changed since they were reported,
+    # so that the list does not grow for as long as the watcher is running
+    with known_stable_files_lock:
+        for file_path, known in list(known_stable_files.items()):
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                del known_stable_files[file_path]
+                continue
+            if known != (stat.st_size, stat.st_mtime_ns):
+                del known_stable_files[file_path]
+
+
+def is_known_stable_file(file_path):
+    with known_stable_files_lock:
+        known = known_stable_files.get(os.path.abspath(file_path))
+    if known is None:
+        return False
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return False
+    return known == (stat.st_size, stat.st_mtime_ns)
+
+
 def wait_for_stable_files(path):
     def is_file_stable(file_path):
+        if is_known_stable_file(file_path):
+            return True
         try:
             """Check if a file's size is stable (indicating it is fully copied)."""
             initial_size = os.path.getsize(file_path)
@@ -427,6 +660,11 @@ def wait_for_stable_files(path):
                 if result:
                     stable_files.add(result)
 
+        # The input watcher sees every new file as it arrives,
+        # so there is no need to wait for late arrivals
+        if input_watch_active[0] and all(file in stable_files for file in files):
+            break
+
         # Check again
         time.sleep(2.5)
         files = []
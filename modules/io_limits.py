@@ -0,0 +1,174 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from modules.misc import *
+
+
+def get_existing_path(path):
+    # Files that are about to be written do not exist yet, use their closest existing folder
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def get_device_id(path):
+    return os.stat(get_existing_path(path)).st_dev
+
+
+def is_same_device(paths):
+    return len(set(get_device_id(path) for path in paths)) <= 1
+
+
+def get_block_device_name(st_dev):
+    # Resolves a st_dev number to the name of the whole disk (e.g. "sda", not "sda1"),
+    # as used by /proc/diskstats and /sys/block
+    sys_path = f"/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}"
+    try:
+        real_path = os.path.realpath(sys_path)
+        if not os.path.exists(real_path):
+            return None
+        if os.path.exists(os.path.join(real_path, 'partition')):
+            real_path = os.path.dirname(real_path)
+        return os.path.basename(real_path)
+    except OSError:
+        return None
+
+
+def is_rotational_device(device_name):
+    try:
+        with open(f"/sys/block/{device_name}/queue/rotational", 'r') as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return False
+
+
+def read_diskstats(device_name):
+    # Returns (ios in progress, ms spent doing I/O) for the device, or None
+    try:
+        with open('/proc/diskstats', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 13 and fields[2] == device_name:
+                    return int(fields[11]), int(fields[12])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def parse_io_device_limits(value):
+    # "sda: 1, nvme0n1: 8" -> {'sda': 1, 'nvme0n1': 8}
+    limits = {}
+    for item in value.split(','):
+        name, _, limit = item.partition(':')
+        if name.strip() and limit.strip().isdigit():
+            limits[name.strip()] = max(1, int(limit.strip()))
+    return limits
+
+
+class DeviceBucket:
+    """Token bucket for one block device.
+
+    Each I/O heavy job takes a token for as long as it runs, so that at most
+    'capacity' jobs read or write the device at once. New tokens are held back
+    while /proc/diskstats shows the device as saturated.
+    """
+
+    def __init__(self, st_dev, device_name, capacity):
+        self.st_dev = st_dev
+        self.device_name = device_name
+        self.capacity = capacity
+        self.tokens = capacity
+        self.cond = threading.Condition()
+        self.busy_percent = 0.0
+        self._last_stats = None
+        self._last_stats_time = None
+
+    def _update_busy_percent(self):
+        if not self.device_name:
+            return
+        now = time.monotonic()
+        if self._last_stats_time is not None and now - self._last_stats_time < 1.0:
+            return
+        stats = read_diskstats(self.device_name)
+        if stats is None:
+            return
+        if self._last_stats is not None:
+            elapsed_ms = (now - self._last_stats_time) * 1000
+            self.busy_percent = min(100.0, (stats[1] - self._last_stats[1]) / elapsed_ms * 100)
+        self._last_stats = stats
+        self._last_stats_time = now
+
+    def acquire(self):
+        max_busy_percent = int(check_config(config, 'general', 'io_max_busy'))
+        with self.cond:
+            while True:
+                self._update_busy_percent()
+                in_use = self.capacity - self.tokens
+                # A saturated device still gets one job, so that work never stalls
+                if self.tokens > 0 and (in_use == 0 or self.busy_percent < max_busy_percent):
+                    self.tokens -= 1
+                    return
+                self.cond.wait(timeout=1.0)
+
+    def release(self):
+        with self.cond:
+            self.tokens += 1
+            self.cond.notify()
+
+
+io_buckets = {}
+io_buckets_lock = threading.Lock()
+
+
+def get_device_bucket(path):
+    st_dev = get_device_id(path)
+
+    with io_buckets_lock:
+        bucket = io_buckets.get(st_dev)
+        if bucket is None:
+            device_name = get_block_device_name(st_dev)
+            device_limits = parse_io_device_limits(check_config(config, 'general', 'io_device_limits'))
+            if device_name in device_limits:
+                capacity = device_limits[device_name]
+            elif device_name and is_rotational_device(device_name):
+                capacity = int(check_config(config, 'general', 'io_limit_hdd'))
+            else:
+                capacity = int(check_config(config, 'general', 'io_limit_ssd'))
+            bucket = DeviceBucket(st_dev, device_name, max(1, capacity))
+            io_buckets[st_dev] = bucket
+    return bucket
+
+
+@contextmanager
+def io_slot(*paths):
+    # Used around every I/O heavy subprocess or file copy/move. Takes one token
+    # from each device involved, always in the same order to avoid deadlocks.
+    buckets = {}
+    for path in paths:
+        if path:
+            bucket = get_device_bucket(path)
+            buckets[bucket.st_dev] = bucket
+    ordered_buckets = [buckets[st_dev] for st_dev in sorted(buckets)]
+
+    acquired = []
+    try:
+        for bucket in ordered_buckets:
+            bucket.acquire()
+            acquired.append(bucket)
+        yield
+    finally:
+        for bucket in reversed(acquired):
+            bucket.release()
+
+
+def get_io_device_stats():
+    with io_buckets_lock:
+        return [{'device': bucket.device_name or str(bucket.st_dev),
+                 'capacity': bucket.capacity,
+                 'busy_percent': bucket.busy_percent} for bucket in io_buckets.values()]
@@ -0,0 +1,258 @@
+import os
+import json
+import hashlib
+import inspect
+import sqlite3
+import threading
+import functools
+
+
+# Job ledger for the current TEMP folder, so that an interrupted run
+# (crash, OOM, container restart) resumes instead of starting over
+job_ledger = None
+job_ledger_lock = threading.Lock()
+
+
+def get_ledger_path(temp_dir):
+    # Hidden file, so that it is ignored when walking the TEMP folder
+    return os.path.join(temp_dir, '.jobs.sqlite')
+
+
+def get_file_fingerprint(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def is_job_file_unchanged(filename, fingerprint, state):
+    # True if the file is still the one recorded by the ledger. The final clean-up
+    # of a muxed file stores the fingerprint after each of its edits, and a header
+    # edit interrupted halfway (mkvpropedit, in place) keeps the size of the file.
+    current = get_file_fingerprint(filename)
+    if current is None or fingerprint is None:
+        return False
+    if current == fingerprint:
+        return True
+    return state == 'muxed' and current.split(':')[0] == fingerprint.split(':')[0]
+
+
+def has_unfinished_jobs(temp_dir):
+    # True if files from an interrupted run are still waiting in the TEMP folder,
+    # unchanged since the ledger last saw them. Cleaned files only need moving.
+    ledger_path = get_ledger_path(temp_dir)
+    if not os.path.isfile(ledger_path):
+        return False
+    try:
+        conn = sqlite3.connect(ledger_path)
+        try:
+            jobs = conn.execute("SELECT file, fingerprint, state FROM jobs").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return any(state != 'cleaned' and is_job_file_unchanged(file, fingerprint, state)
+               for file, fingerprint, state in jobs)
+
+
+class JobLedger:
+    """SQLite record of the completed stages of each file in the TEMP folder.
+
+    Each stage stores its result and the files it produced. The results are
+    only reused while the MKV file is unchanged since the last completed stage,
+    and all files produced by the stage still exist.
+    """
+
+    def __init__(self, temp_dir):
+        os.makedirs(temp_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(get_ledger_path(temp_dir), check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                          "file TEXT PRIMARY KEY, fingerprint TEXT, state TEXT, source TEXT)")
+        # Ledgers of older runs do not record the path the file was ingested as
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        if 'source' not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN source TEXT")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS stages ("
+                          "file TEXT, stage TEXT, variant TEXT, result TEXT, artifacts TEXT, "
+                          "PRIMARY KEY (file, stage, variant))")
+
+    def get_job(self, filename):
+        with self.lock:
+            return self.conn.execute("SELECT fingerprint, state FROM jobs WHERE file = ?",
+                                     (os.path.abspath(filename),)).fetchone()
+
+    def start_job(self, filename):
+        # Forget earlier results if the file has changed outside of the recorded stages
+        path = os.path.abspath(filename)
+        fingerprint = get_file_fingerprint(filename)
+        with self.lock:
+            job = self.conn.execute("SELECT fingerprint FROM jobs WHERE file = ?", (path,)).fetchone()
+            if job and job[0] == fingerprint:
+                return
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM stages WHERE file = ?", (path,))
+            self.conn.execute("INSERT OR REPLACE INTO jobs (file, fingerprint, state, source) "
+                              "VALUES (?, ?, 'running', ?)", (path, fingerprint, path))
+            self.conn.execute("COMMIT")
+
+    def is_resumable(self, filename):
+        # True if the file, or the file renamed by the clean-up, was muxed by an earlier run
+        path = os.path.abspath(filename)
+        with self.lock:
+            job = self.conn.execute("SELECT 1 FROM jobs WHERE (file = ? OR source = ?) "
+                                    "AND state IN ('muxed', 'cleaned')", (path, path)).fetchone()
+        return job is not None
+
+    def get_stage_result(self, filename, stage, variant):
+        # Returns (True, result) if the stage can be skipped, otherwise (False, None)
+        path = os.path.abspath(filename)
+        with self.lock:
+            row = self.conn.execute("SELECT result, artifacts FROM stages WHERE file = ? AND stage = ? AND variant = ?",
+                                    (path, stage, variant)).fetchone()
+        if row is None:
+            return False, None
+        if not all(os.path.exists(artifact) for artifact in json.loads(row[1])):
+            return False, None
+        return True, json.loads(row[0])
+
+    def complete_stage(self, filename, stage, variant, result, artifacts, state='running'):
+        path = os.path.abspath(filename)
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.execute("INSERT OR REPLACE INTO stages (file, stage, variant, result, artifacts) "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              (path, stage, variant, json.dumps(result), json.dumps(artifacts)))
+            # The stage may have rewritten the file, so store its current fingerprint
+            self.conn.execute("UPDATE jobs SET fingerprint = ?, state = CASE WHEN state = 'muxed' THEN state ELSE ? END "
+                              "WHERE file = ?", (get_file_fingerprint(filename), state, path))
+            self.conn.execute("COMMIT")
+
+    def update_fingerprint(self, filename):
+        # Called after each edit of the final clean-up, so that a resumed run accepts the edited file
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET fingerprint = ? WHERE file = ?",
+                              (get_file_fingerprint(filename), os.path.abspath(filename)))
+
+    def mark_cleaned(self, filename, new_filename):
+        # Called after the final clean-up of a muxed file, which edits (and may rename) the file
+        path = os.path.abspath(filename)
+        new_path = os.path.abspath(new_filename)
+        with self.lock:
+            self.conn.execute("BEGIN")
+            if new_path != path:
+                self.conn.execute("DELETE FROM stages WHERE file = ?", (new_path,))
+                self.conn.execute("DELETE FROM jobs WHERE file = ?", (new_path,))
+                self.conn.execute("UPDATE stages SET file = ? WHERE file = ?", (new_path, path))
+            self.conn.execute("UPDATE jobs SET file = ?, fingerprint = ?, state = 'cleaned' WHERE file = ?",
+                              (new_path, get_file_fingerprint(new_filename), path))
+            self.conn.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def init_job_ledger(temp_dir):
+    global job_ledger
+    with job_ledger_lock:
+        if job_ledger is not None:
+            job_ledger.close()
+        job_ledger = JobLedger(temp_dir)
+    return job_ledger
+
+
+def find_artifacts(result, dirpath):
+    # All files referenced by a stage result, which must still exist for the result to be reused
+    artifacts = []
+    if isinstance(result, str):
+        for path in (result, os.path.join(dirpath, result)):
+            if os.path.isfile(path):
+                artifacts.append(os.path.abspath(path))
+                break
+    elif isinstance(result, (list, tuple)):
+        for item in result:
+            artifacts += find_artifacts(item, dirpath)
+    elif isinstance(result, dict):
+        for item in result.values():
+            artifacts += find_artifacts(item, dirpath)
+    return artifacts
+
+
+# Worker arguments that do not change the result of a stage
+RESOURCE_ARGUMENTS = ('internal_threads', 'max_threads', 'memory_per_thread', 'max_mem_allowed')
+
+
+def get_stage_variant(arg_names, args):
+    relevant_args = [arg for name, arg in zip(arg_names, args) if name not in RESOURCE_ARGUMENTS]
+    return hashlib.sha1(json.dumps(relevant_args, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def ledger_stage(stage, muxes=False, get_artifacts=None):
+    """Records the result of a stage worker, and reuses it when resuming an interrupted run.
+
+    The worker must take (debug, input_file, dirpath, ...) as its first arguments.
+    Stages that remux the MKV file (muxes=True) mark the job as muxed. Files produced
+    by the stage are found in its result, or by get_artifacts(filename, result).
+    """
+    def decorator(worker):
+        # Names of the arguments after (debug, input_file, dirpath)
+        arg_names = list(inspect.signature(worker).parameters)[3:]
+
+        @functools.wraps(worker)
+        def wrapper(debug, input_file, dirpath, *args):
+            ledger = job_ledger
+            if ledger is None:
+                return worker(debug, input_file, dirpath, *args)
+
+            filename = os.path.join(dirpath, input_file)
+            variant = get_stage_variant(arg_names, args)
+            ledger.start_job(filename)
+            found, result = ledger.get_stage_result(filename, stage, variant)
+            if found:
+                return result
+
+            result = worker(debug, input_file, dirpath, *args)
+            artifacts = find_artifacts(result, dirpath)
+            if get_artifacts:
+                artifacts += get_artifacts(filename, result)
+            ledger.complete_stage(filename, stage, variant, result, artifacts, 'muxed' if muxes else 'running')
+            return result
+        return wrapper
+    return decorator
+
+
+def get_job_resume_state(filename):
+    # 'muxed' if the file only needs the final clean-up and moving when resuming, 'cleaned'
+    # if it only needs moving, None if it is processed from the start (also when the
+    # file was replaced, e.g. by copying the original into the TEMP folder again)
+    ledger = job_ledger
+    if ledger is None:
+        return None
+    job = ledger.get_job(filename)
+    if job is None or job[1] not in ('muxed', 'cleaned'):
+        return None
+    if not is_job_file_unchanged(filename, job[0], job[1]):
+        return None
+    return job[1]
+
+
+def is_job_resumable(filename):
+    # Inputs of resumable jobs must not be copied or moved into the TEMP folder again
+    ledger = job_ledger
+    return ledger is not None and ledger.is_resumable(filename)
+
+
+def update_job_fingerprint(filename):
+    ledger = job_ledger
+    if ledger is not None:
+        ledger.update_fingerprint(filename)
+
+
+def mark_job_cleaned(filename, new_filename):
+    ledger = job_ledger
+    if ledger is not None:
+        ledger.mark_cleaned(filename, new_filename)
@@ -1271,6 +1271,14 @@ variables_defaults = configparser.ConfigParser()
 if os.path.isfile('defaults.ini'):
     variables_defaults.read('defaults.ini')
 
+def get_user_config_mtime():
+    # Used by the --watch daemon to notice changes to the user config
+    for path in ('user.ini', 'files/user.ini'):
+        if os.path.isfile(path):
+            return os.path.getmtime(path)
+    return None
+
+
 # Load user-specific configurations if available
 if os.path.isfile('user.ini'):
     variables_user.read('user.ini')
@@ -1297,6 +1305,14 @@ config = {
         'max_ram_usage': get_config('general', 'MAX_RAM_USAGE', variables_defaults),
         'debug': get_config('general', 'DEBUG', variables_defaults).lower() == "true",
         'hide_cursor': get_config('general', 'HIDE_CURSOR', variables_defaults).lower() == "true",
+        'pipeline_mode': get_config('general', 'PIPELINE_MODE', variables_defaults).lower() == "true",
+        'adaptive_concurrency': get_config('general', 'ADAPTIVE_CONCURRENCY', variables_defaults).lower() == "true",
+        'io_limit_hdd': get_config('general', 'IO_LIMIT_HDD', variables_defaults),
+        'io_limit_ssd': get_config('general', 'IO_LIMIT_SSD', variables_defaults),
+        'io_device_limits': get_config('general', 'IO_DEVICE_LIMITS', variables_defaults),
+        'io_max_busy': get_config('general', 'IO_MAX_BUSY', variables_defaults),
+        'watch_quiet_period': get_config('general', 'WATCH_QUIET_PERIOD', variables_defaults),
+        'ingest_hardlinks': get_config('general', 'INGEST_HARDLINKS', variables_defaults).lower() == "true",
         'keep_original_file_structure': get_config('general', 'KEEP_ORIGINAL_FILE_STRUCTURE', variables_defaults),
         'remove_all_title_names': get_config('general', 'REMOVE_ALL_TITLE_NAMES', variables_defaults).lower() == "true",
         'make_season_folders': get_config('general', 'MAKE_SEASON_FOLDERS', variables_defaults).lower() == "true"
@@ -1304,13 +1320,23 @@ config = {
     'audio': {
         'pref_audio_langs': [item.strip() for item in get_config('audio', 'PREFERRED_AUDIO_LANG', variables_defaults).split(',')],
         'pref_audio_formats': get_config('audio', 'PREFERRED_AUDIO_FORMATS', variables_defaults),
-        'remove_commentary': get_config('audio', 'REMOVE_COMMENTARY_TRACK', variables_defaults).lower() == "true"
+        'remove_commentary': get_config('audio', 'REMOVE_COMMENTARY_TRACK', variables_defaults).lower() == "true",
+        'keep_temp_wav': get_config('audio', 'KEEP_TEMP_WAV', variables_defaults).lower() == "true",
+        'eos_target_loudness': get_config('audio', 'EOS_TARGET_LOUDNESS', variables_defaults),
+        'eos_engine': get_config('audio', 'EOS_ENGINE', variables_defaults).lower(),
+        'audio_cache_size': get_config('audio', 'AUDIO_CACHE_SIZE', variables_defaults),
+        'audio_cache_dir': get_config('audio', 'AUDIO_CACHE_DIR', variables_defaults)
     },
     'subtitles': {
         'pref_subs_langs': [item.strip() for item in get_config('subtitles', 'PREFERRED_SUBS_LANG', variables_defaults).split(',')],
         'pref_subs_langs_short': [item.strip()[:-1] for item in get_config('subtitles', 'PREFERRED_SUBS_LANG', variables_defaults).split(',')],
         'pref_subs_ext': [item.strip() for item in get_config('subtitles', 'PREFERRED_SUBS_EXT', variables_defaults).split(',')],
         'ocr_languages': [item.strip() for item in get_config('subtitles', 'OCR_LANGUAGES', variables_defaults).split(',')],
+        'ocr_engine': get_config('subtitles', 'OCR_ENGINE', variables_defaults).lower(),
+        'ocr_image_cache_size': get_config('subtitles', 'OCR_IMAGE_CACHE_SIZE', variables_defaults),
+        'ocr_image_cache_days': get_config('subtitles', 'OCR_IMAGE_CACHE_DAYS', variables_defaults),
+        'ocr_track_cache_size': get_config('subtitles', 'OCR_TRACK_CACHE_SIZE', variables_defaults),
+        'ocr_cache_dir': get_config('subtitles', 'OCR_CACHE_DIR', variables_defaults),
         'always_enable_subs': get_config('subtitles', 'ALWAYS_ENABLE_SUBS', variables_defaults).lower() == "true",
         'always_remove_sdh': get_config('subtitles', 'REMOVE_SDH', variables_defaults).lower() == "true",
         'remove_music': get_config('subtitles', 'REMOVE_MUSIC', variables_defaults).lower() == "true",
@@ -1332,22 +1358,198 @@ config = {
 }
 
 
+def read_cgroup_file(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_cgroup_cpu_limit():
+    # cgroup v2, "max 100000" if unlimited
+    cpu_max = read_cgroup_file('/sys/fs/cgroup/cpu.max')
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+        return None
+
+    # cgroup v1, -1 if unlimited
+    quota = read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def get_cgroup_cpu_usage_seconds():
+    # cgroup v2
+    cpu_stat = read_cgroup_file('/sys/fs/cgroup/cpu.stat')
+    if cpu_stat:
+        for line in cpu_stat.splitlines():
+            key, _, value = line.partition(' ')
+            if key == 'usage_usec':
+                return int(value) / 1000000
+
+    # cgroup v1
+    usage = read_cgroup_file('/sys/fs/cgroup/cpuacct/cpuacct.usage')
+    if usage:
+        return int(usage) / 1000000000
+    return None
+
+
+def get_cgroup_memory_limit():
+    # Returns (limit, usage) in bytes, or None if the memory is not limited
+    for limit_path, usage_path in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        limit = read_cgroup_file(limit_path)
+        usage = read_cgroup_file(usage_path)
+        if limit is None or usage is None:
+            continue
+        if limit == 'max':
+            return None
+        # cgroup v1 reports a huge number when unlimited
+        if int(limit) >= psutil.virtual_memory().total:
+            return None
+        return int(limit), int(usage)
+    return None
+
+
+class ResourceSampler:
+    """Samples CPU, RAM and IO wait in the background, respecting container (cgroup) limits."""
+
+    def __init__(self, interval=1.0, window=5):
+        self.interval = interval
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = []
+        self._thread = None
+
+        try:
+            cpu_count = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpu_count = os.cpu_count() or 1
+        cpu_limit = get_cgroup_cpu_limit()
+        self.cpu_limited = cpu_limit is not None and cpu_limit < cpu_count
+        self.cpu_count = max(1.0, min(float(cpu_count), cpu_limit)) if self.cpu_limited else float(cpu_count)
+
+        self._last_time = None
+        self._last_cgroup_cpu = None
+        self._last_cpu_times = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        # Take the first sample right away, so that there is always something to return
+        self._take_sample()
+        time.sleep(0.1)
+        self._take_sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._take_sample()
+            except Exception:
+                pass
+
+    def _take_sample(self):
+        now = time.monotonic()
+        cpu_times = psutil.cpu_times()
+        cgroup_cpu = get_cgroup_cpu_usage_seconds() if self.cpu_limited else None
+
+        if self._last_time is None:
+            self._last_time = now
+            self._last_cpu_times = cpu_times
+            self._last_cgroup_cpu = cgroup_cpu
+            return
+
+        elapsed = now - self._last_time
+        total_delta = sum(cpu_times) - sum(self._last_cpu_times)
+        idle_delta = cpu_times.idle - self._last_cpu_times.idle
+        iowait_delta = getattr(cpu_times, 'iowait', 0.0) - getattr(self._last_cpu_times, 'iowait', 0.0)
+
+        if cgroup_cpu is not None and self._last_cgroup_cpu is not None and elapsed > 0:
+            # Percent of the CPU quota given to the container
+            cpu_percent = (cgroup_cpu - self._last_cgroup_cpu) / (elapsed * self.cpu_count) * 100
+        elif total_delta > 0:
+            cpu_percent = (total_delta - idle_delta - iowait_delta) / total_delta * 100
+        else:
+            cpu_percent = 0.0
+        iowait_percent = iowait_delta / total_delta * 100 if total_delta > 0 else 0.0
+
+        self._last_time = now
+        self._last_cpu_times = cpu_times
+        self._last_cgroup_cpu = cgroup_cpu
+
+        with self._lock:
+            self._samples.append((min(max(cpu_percent, 0.0), 100.0), max(iowait_percent, 0.0)))
+            self._samples = self._samples[-self.window:]
+
+    def get_cpu_percent(self):
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            return sum(sample[0] for sample in self._samples) / len(self._samples)
+
+    def get_iowait_percent(self):
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            return sum(sample[1] for sample in self._samples) / len(self._samples)
+
+    def get_memory(self):
+        # Returns total, available and used memory in bytes, and the percent used
+        vm = psutil.virtual_memory()
+        cgroup_memory = get_cgroup_memory_limit()
+        if cgroup_memory is None:
+            return vm.total, vm.available, vm.used, vm.percent
+
+        limit, usage = cgroup_memory
+        available = min(max(limit - usage, 0), vm.available)
+        return limit, available, usage, usage / limit * 100
+
+
+RESOURCE_SAMPLER = None
+resource_sampler_lock = threading.Lock()
+
+
+def get_resource_sampler():
+    global RESOURCE_SAMPLER
+    with resource_sampler_lock:
+        if RESOURCE_SAMPLER is None:
+            RESOURCE_SAMPLER = ResourceSampler()
+            RESOURCE_SAMPLER.start()
+    return RESOURCE_SAMPLER
+
+
+def get_cpu_usage():
+    return get_resource_sampler().get_cpu_percent()
+
+
 def get_worker_thread_count():
+    sampler = get_resource_sampler()
     max_cpu_usage = int(check_config(config, 'general', 'max_cpu_usage'))
-    available = max_cpu_usage - psutil.cpu_percent(interval=0.5)
-    max_workers = int(os.cpu_count() * max(available, 0) / 100)
+    available = max_cpu_usage - sampler.get_cpu_percent()
+    max_workers = int(sampler.cpu_count * max(available, 0) / 100)
     if max_workers < 1:
         max_workers = 1
     return max_workers
 
 
 def get_max_ocr_threads():
+    sampler = get_resource_sampler()
+
     # --- CPU constraint ---
     max_cpu_conf = int(check_config(config, 'general', 'max_cpu_usage'))  # e.g. 85 for 85%
-    current_cpu = psutil.cpu_percent(interval=0.5)
+    current_cpu = sampler.get_cpu_percent()
     avail_cpu = max_cpu_conf - current_cpu
     if avail_cpu > 0:
-        cpu_limit = int((os.cpu_count() * avail_cpu / 100) // 1.4)
+        cpu_limit = int((sampler.cpu_count * avail_cpu / 100) // 1.4)
         cpu_limit = max(1, cpu_limit)  # if any CPU headroom exists, allow at least 1 thread
     else:
         cpu_limit = 0  # No available CPU capacity
@@ -1356,10 +1558,10 @@ def get_max_ocr_threads():
     memory_per_thread = 2.0  # Approximate max GB used per thread
     max_ram_conf = int(check_config(config, 'general', 'max_ram_usage'))  # e.g. 85 for 85%
 
-    vm = psutil.virtual_memory()
-    total_mem = vm.total / (1024 ** 3)  # Total memory in GB
+    total, available, used, percent = sampler.get_memory()
+    total_mem = total / (1024 ** 3)  # Total memory in GB
     allowed_mem = (max_ram_conf / 100) * total_mem
-    avail_mem = vm.available / (1024 ** 3)  # Currently available memory in GB
+    avail_mem = available / (1024 ** 3)  # Currently available memory in GB
     usable_mem = min(allowed_mem, avail_mem)
     mem_limit = max(1, int(usable_mem / memory_per_thread))
 
@@ -1368,17 +1570,17 @@ def get_max_ocr_threads():
 
 
 def get_ram_usage():
-    # Retrieve memory details
-    vm = psutil.virtual_memory()
+    # Retrieve memory details (limited to the container if running in one)
+    total, available, used, percent = get_resource_sampler().get_memory()
 
     # Convert bytes to gigabytes (1 GB = 1024^3 bytes)
-    total_gb = vm.total / (1024 ** 3)
-    used_gb = vm.used / (1024 ** 3)
+    total_gb = total / (1024 ** 3)
+    used_gb = used / (1024 ** 3)
 
     return {
         "used_ram": f"{used_gb:.0f}",
         "total_ram": f"{total_gb:.0f}",
-        "percent_ram": f"{vm.percent:.0f}"
+        "percent_ram": f"{percent:.0f}"
     }
 
 
@@ -11,9 +11,14 @@ import concurrent.futures
 import base64
 from collections import defaultdict, Counter
 from itertools import chain
-from pathlib import Path
 
 from modules.misc import *
+from modules.probe import *
+from modules.ebml import *
+from modules.remux import *
+from modules.concurrency import *
+from modules.io_limits import *
+from modules.ledger import *
 from modules.audio import *
 from modules.subs import *
 from modules.file_operations import *
@@ -110,23 +115,43 @@ def simplify_json(data, fields_to_keep):
 
 
 def get_mkv_info(debug, filename, silent):
-    command = ["mkvmerge", "-J", filename]
-    done = False
-    result = None
-    printed = False
-    while not done:
-        result = subprocess.run(command, capture_output=True, text=True)
-        if result.returncode != 0:
-            if not printed and not silent:
-                print(
-                    f"{GREY}[UTC {get_timestamp()}] [INFO]{RESET} Incoming file(s) detected in input folder. Waiting...")
-                printed = True
-            time.sleep(5)
-        if result.returncode == 0:
-            done = True
-
-    # Parse the JSON output and pretty-print it
-    parsed_json = json.loads(result.stdout)
+    parsed_json = get_cached_probe(filename, 'mkvmerge')
+
+    # Track selection only needs the Segment Info and Tracks elements,
+    # which are read directly from the file header when possible. Files
+    # that are still incoming are left to mkvmerge, which waits for them.
+    if parsed_json is None:
+        parsed_json = get_cached_probe(filename, 'ebml')
+    if parsed_json is None:
+        parsed_json = read_mkv_header_info(filename)
+        if parsed_json is not None:
+            store_cached_probe(filename, 'ebml', parsed_json)
+
+    if parsed_json is None:
+        command = ["mkvmerge", "-J", filename]
+        done = False
+        result = None
+        printed = False
+        while not done:
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                if not printed and not silent:
+                    print(
+                        f"{GREY}[UTC {get_timestamp()}] [INFO]{RESET} Incoming file(s) detected in input folder. Waiting...")
+                    printed = True
+                time.sleep(5)
+            if result.returncode == 0:
+                done = True
+
+        # Parse the JSON output and store it for later lookups
+        parsed_json = json.loads(result.stdout)
+        store_cached_probe(filename, 'mkvmerge', parsed_json)
+
+    # Tracks that are planned to be dropped in the final mux are left out
+    remux_plan = get_remux_plan(filename)
+    if remux_plan:
+        parsed_json = remux_plan.apply_to_info(parsed_json)
+
     pretty_json = json.dumps(parsed_json, indent=2)
 
     # Simplifying the JSON
@@ -154,38 +179,15 @@ def get_mkv_info(debug, filename, silent):
 
 
 def get_mkv_video_codec(filename):
-    codec = None
-    parsed_json, _ = get_mkv_info(False, filename, True)
-    if parsed_json:
-        for track in parsed_json['tracks']:
-            if track['type'] == 'video':
-                codec = track['codec']
-    return codec
+    return MediaProbe(filename).get_video_codec()
 
 
 def check_if_subs_in_mkv(filename):
-    parsed_json, _ = get_mkv_info(False, filename, True)
-    if parsed_json:
-        for track in parsed_json['tracks']:
-            if track['type'] == 'subtitles':
-                return True
-        else:
-            return False
+    return MediaProbe(filename).has_subtitles()
 
 
 def has_closed_captions(file_path):
-    # Command to get ffprobe output
-    command = ['ffprobe', file_path]
-
-    # Execute the command and capture the output
-    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    output = result.stdout.decode()
-
-    # Search for "Closed Captions" in the video stream description
-    if "Stream #0:0" in output and "Video:" in output and "Closed Captions" in output:
-        return True
-    else:
-        return False
+    return MediaProbe(file_path).has_closed_captions()
 
 
 def get_all_audio_languages(filename):
@@ -210,60 +212,13 @@ def get_all_subtitle_languages(filename):
     return all_langs
 
 
-def strip_mkv_title_and_track_names(debug, file_path):
-    file_path = Path(file_path)
-
-    # Check if the file exists
-    if not file_path.is_file() or file_path.suffix.lower() != '.mkv':
-        raise ValueError(f"The specified file is not a valid MKV file: {file_path}")
-
-    # Ensure required tools are available
-    for tool in ['mkvpropedit', 'mkvmerge']:
-        if not shutil.which(tool):
-            raise EnvironmentError(f"{tool} is not installed or not in PATH.")
-
-    try:
-        if debug:
-            print(f"{GREY}[UTC {get_timestamp()}] [DEBUG]{RESET} Removing all track names in MKV...")
-
-        # Get track IDs using mkvmerge
-        command = ['mkvmerge', '-i', str(file_path)]
-        if debug:
-            print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        lines = result.stdout.splitlines()
-        track_ids = [int(line.split('Track ID ')[1].split(':')[0]) for line in lines if 'Track ID' in line]
-
-        # Remove track names (mkvpropedit uses 1-based index)
-        for track_id in track_ids:
-            track_index = track_id + 1
-            command = ['mkvpropedit', str(file_path), '--edit', f'track:{track_index}', '--set', 'name=']
-            if debug:
-                print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
-            subprocess.run(
-                command,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
-
-        # Remove the title from the MKV file
-        command = ['mkvpropedit', str(file_path), '--edit', 'info', '--set', 'title=']
-        if debug:
-            print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
-
-        subprocess.run(
-            command,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to process file: {file_path}\n{e.stderr}")
+def get_track_name_edits(filename):
+    # mkvpropedit uses 1-based track indexes
+    parsed_json, _ = get_mkv_info(False, filename, True)
+    edits = []
+    for track_index in range(1, len(parsed_json['tracks']) + 1):
+        edits += ['--edit', f'track:{track_index}', '--set', 'name=']
+    return edits
 
 
 def get_main_audio_track_language(file_info):
@@ -280,11 +235,18 @@ def get_main_audio_track_language(file_info):
                         return main_audio_track_lang
 
 
-def remove_all_mkv_track_tags(debug, filename):
+def remove_all_mkv_track_tags(debug, filename, remove_all_title_names=False):
+    # mkvpropedit edits the file in place
+    break_hardlink(filename)
+
     command = ['mkvpropedit', filename,
                '--edit', 'track:v1', '--set', 'name=',
                '--set', 'flag-default=1', '-e', 'info', '-s', 'title=']
 
+    # Track names are removed in the same pass, as these are header-only edits
+    if remove_all_title_names:
+        command += get_track_name_edits(filename)
+
     if debug:
         print(f"\n{GREY}[UTC {get_timestamp()}] [DEBUG]{RESET} Removing track tags in MKV...")
         print('')
@@ -292,6 +254,7 @@ def remove_all_mkv_track_tags(debug, filename):
         print(f"{RESET}")
 
     result = subprocess.run(command, capture_output=True, text=True)
+    invalidate_probe_cache(filename)
     if result.returncode != 0:
         print('')
         print(f"{GREY}[UTC {get_timestamp()}] {RED}[ERROR]{RESET} {result.stdout}")
@@ -350,7 +313,8 @@ def convert_mp4_to_mkv_with_subtitles(debug, mp4_file):
         print(f"{RESET}")
 
     try:
-        subprocess.run(mkvmerge_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        with io_slot(mp4_file):
+            subprocess.run(mkvmerge_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
     except subprocess.CalledProcessError:
         print(f"Error occurred while merging files into {mkv_file}")
         return None
@@ -365,22 +329,7 @@ def convert_mp4_to_mkv_with_subtitles(debug, mp4_file):
 def mkv_contains_video(file_path, dirpath):
     input_file = os.path.join(dirpath, file_path)
     try:
-        # Run ffprobe command to get stream information
-        command = [
-            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-            '-show_entries', 'stream=index', '-of', 'json', input_file
-        ]
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        # Parse the output
-        probe_data = json.loads(result.stdout)
-
-        # Check if the 'streams' key exists and contains at least one video stream
-        if 'streams' in probe_data and len(probe_data['streams']) > 0:
-            return True
-        else:
-            return False
-
+        return MediaProbe(input_file).has_video()
     except Exception as e:
         print(f"An error occurred: {e}")
         return False
@@ -413,6 +362,7 @@ def remove_cc_hidden_in_file(debug, filename):
     else:
         os.remove(filename)
         shutil.move(temp_filename, filename)
+        invalidate_probe_cache(filename)
 
 
 def trim_audio_in_mkv_files(logger, debug, input_files, dirpath):
@@ -474,8 +424,10 @@ def trim_audio_in_mkv_files_worker(debug, input_file, dirpath):
      track_langs_to_be_converted, track_names_to_be_converted) = get_wanted_audio_tracks(
         debug, file_info, pref_audio_langs, remove_commentary, pref_audio_formats)
 
+    # The unwanted audio tracks are dropped in the final mux
+    # (repack_tracks_in_mkv), instead of rewriting the file here
     if needs_processing_audio:
-        strip_audio_tracks_in_mkv(debug, input_file, wanted_audio_tracks, default_audio_track)
+        plan_audio_tracks(input_file, wanted_audio_tracks, default_audio_track)
 
     file_info, pretty_file_info = get_mkv_info(debug, input_file, False)
 
@@ -496,6 +448,100 @@ def trim_audio_in_mkv_files_worker(debug, input_file, dirpath):
     return needs_processing_audio, needs_processing_subs, missing_subs_langs
 
 
+def demux_tracks_process(logger, debug, input_files, dirpath, need_processing_audio, need_processing_subs):
+    total_files = len(input_files)
+    download_missing_subs = check_config(config, 'subtitles', 'download_missing_subs')
+
+    # The subtitle extraction stage runs for all files if any of them needs it
+    extract_subs = any(need_processing_subs) and download_missing_subs.lower() != 'override'
+    if not any(need_processing_audio) and not extract_subs:
+        return
+
+    header = "MKVEXTRACT"
+    description = "Extract audio and subtitle tracks"
+
+    max_worker_threads = get_worker_thread_count()
+    num_workers = max(1, max_worker_threads)
+
+    # Initialize progress
+    print_with_progress(logger, 0, total_files, header=header, description=description)
+
+    # Demuxing is I/O bound, measured in MB/s of source files
+    limiter = AdaptiveLimiter(logger, header, num_workers, int(get_resource_sampler().cpu_count * 2))
+
+    # Use ThreadPoolExecutor to handle multithreading
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
+        futures = {limiter.submit(executor, demux_tracks_process_worker, debug, input_file, dirpath,
+                                  bool(need_processing_audio[index]), extract_subs,
+                                  work=get_file_size_mb(os.path.join(dirpath, input_file))): index
+                   for index, input_file in enumerate(input_files)}
+
+        for completed_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            print_with_progress(logger, completed_count, total_files, header=header, description=description)
+            try:
+                index = futures[future]
+                manifest = future.result()
+                set_demux_manifest(os.path.join(dirpath, input_files[index]), manifest)
+            except Exception as e:
+                # Fetch the variables that were passed to the thread
+                index = futures[future]
+                input_file = input_files[index]
+
+                # Print the error and traceback
+                custom_print(logger, f"{RED}[ERROR]{RESET} {e}")
+                print_no_timestamp(logger, f"  {BLUE}debug{RESET}: {debug}")
+                print_no_timestamp(logger, f"  {BLUE}input_file{RESET}: {input_file}")
+                print_no_timestamp(logger, f"  {BLUE}dirpath{RESET}: {dirpath}")
+                traceback_str = ''.join(traceback.format_tb(e.__traceback__))
+                print_no_timestamp(logger, f"\n{RED}[TRACEBACK]{RESET}\n{traceback_str}")
+                raise
+
+
+@ledger_stage('demux')
+def demux_tracks_process_worker(debug, input_file, dirpath, needs_processing_audio, extract_subs):
+    # Writes the audio tracks to be converted and the wanted subtitle tracks
+    # with one read of the file. Later stages find them in the manifest.
+    input_file_with_path = os.path.join(dirpath, input_file)
+    manifest = {'audio': {}, 'subtitles': {}}
+
+    pref_audio_langs = check_config(config, 'audio', 'pref_audio_langs')
+    pref_audio_formats = check_config(config, 'audio', 'pref_audio_formats')
+    remove_commentary = check_config(config, 'audio', 'remove_commentary')
+    pref_subs_langs = check_config(config, 'subtitles', 'pref_subs_langs')
+
+    # Get updated file info after mkv tracks reduction
+    file_info, pretty_file_info = get_mkv_info(False, input_file_with_path, True)
+
+    if needs_processing_audio:
+        (wanted_audio_tracks, default_audio_track, needs_processing_audio,
+         pref_audio_formats_found, track_ids_to_be_converted,
+         track_langs_to_be_converted, track_names_to_be_converted) = get_wanted_audio_tracks(
+            False, file_info, pref_audio_langs, remove_commentary, pref_audio_formats)
+        if needs_processing_audio and track_ids_to_be_converted:
+            for track, language in zip(track_ids_to_be_converted, track_langs_to_be_converted):
+                manifest['audio'][str(track)] = get_extracted_audio_filename(input_file_with_path, track, language)
+
+    if extract_subs:
+        (wanted_subs_tracks, a, b, needs_convert,
+         sub_filetypes, subs_track_languages,
+         subs_track_names, e, subs_track_forced, f) = get_wanted_subtitle_tracks(False, file_info, pref_subs_langs)
+        for track, filetype, language, forced, name in zip(wanted_subs_tracks, sub_filetypes, subs_track_languages,
+                                                           subs_track_forced, subs_track_names):
+            manifest['subtitles'][str(track)] = get_extracted_subtitle_filename(
+                input_file_with_path, track, filetype, language, forced, name)
+
+    track_files = [(track, output_file) for kind in ('audio', 'subtitles')
+                   for track, output_file in manifest[kind].items()]
+    if not track_files:
+        return manifest
+
+    result = run_mkvextract(debug, input_file_with_path, track_files)
+    if result.returncode != 0:
+        raise Exception("Error executing mkvextract command: " + result.stdout)
+
+    return manifest
+
+
 def generate_audio_tracks_in_mkv_files(logger, debug, input_files, dirpath, need_processing_audio):
     total_files = len(input_files)
     all_ready_audio_tracks = [None] * total_files
@@ -535,10 +581,16 @@ def generate_audio_tracks_in_mkv_files(logger, debug, input_files, dirpath, need
         # Initialize progress
         print_with_progress(logger, 0, total_files, header=header, description=description)
 
+    # Encoding is CPU bound, measured as realtime factor (seconds of media per second)
+    limiter = AdaptiveLimiter(logger, header, num_workers, int(get_resource_sampler().cpu_count), unit='x realtime')
+
     # Use ThreadPoolExecutor to handle multithreading
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-        futures = {executor.submit(generate_audio_tracks_in_mkv_files_worker, debug, input_file, dirpath,
-                                   internal_threads): index for index, input_file in enumerate(input_files)}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
+        futures = {limiter.submit(executor, generate_audio_tracks_in_mkv_files_worker, debug, input_file, dirpath,
+                                  internal_threads,
+                                  work=get_media_duration(os.path.join(dirpath, input_file))
+                                  if need_processing_audio[index] else 0.0): index
+                   for index, input_file in enumerate(input_files)}
 
         for completed_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
             if not disable_print:
@@ -567,6 +619,21 @@ def generate_audio_tracks_in_mkv_files(logger, debug, input_files, dirpath, need
     return all_ready_audio_tracks, all_ready_subtitle_tracks
 
 
+def get_generated_audio_files(filename, result):
+    # Encoded audio tracks are named the same way as they are looked up in repack_tracks_in_mkv
+    audio_tracks = result[0]
+    base, extension = os.path.splitext(filename)
+    audio_files = []
+    for index, filetype in enumerate(audio_tracks['audio_extensions']):
+        try:
+            audio_language = pycountry.languages.get(alpha_3=audio_tracks['audio_langs'][index]).alpha_2
+        except:
+            audio_language = audio_tracks['audio_langs'][index][:-1]
+        audio_files.append(os.path.abspath(f"{base}.{audio_tracks['audio_ids'][index]}.{audio_language}.{filetype}"))
+    return audio_files
+
+
+@ledger_stage('audio', get_artifacts=get_generated_audio_files)
 def generate_audio_tracks_in_mkv_files_worker(debug, input_file, dirpath, internal_threads):
     input_file = os.path.join(dirpath, input_file)
 
@@ -641,10 +708,14 @@ def extract_subs_in_mkv_process(logger, debug, input_files, dirpath):
         # Initialize progress
         print_with_progress(logger, 0, total_files, header=header, description=description)
 
+    # Extraction is I/O bound, measured in MB/s of source files
+    limiter = AdaptiveLimiter(logger, header, num_workers, int(get_resource_sampler().cpu_count * 2))
+
     # Use ThreadPoolExecutor to handle multithreading
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
         futures = {
-            executor.submit(extract_subs_in_mkv_process_worker, debug, input_file, dirpath, internal_threads): index for
+            limiter.submit(executor, extract_subs_in_mkv_process_worker, debug, input_file, dirpath, internal_threads,
+                           work=get_file_size_mb(os.path.join(dirpath, input_file))): index for
             index, input_file in enumerate(input_files)}
 
         for completed_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
@@ -672,6 +743,7 @@ def extract_subs_in_mkv_process(logger, debug, input_files, dirpath):
     return all_subtitle_files
 
 
+@ledger_stage('extract')
 def extract_subs_in_mkv_process_worker(debug, input_file, dirpath, internal_threads):
     input_file_with_path = os.path.join(dirpath, input_file)
     pref_subs_langs = check_config(config, 'subtitles', 'pref_subs_langs')
@@ -720,6 +792,9 @@ def convert_to_srt_process(logger, debug, input_files, dirpath, subtitle_files_l
     # the OCR process uses multiple Tesseract processes internally.
     # Reduced threads to not overwhelm the system.
     max_worker_threads, memory_per_thread, max_mem_allowed = get_max_ocr_threads()
+    if check_config(config, 'subtitles', 'ocr_engine') == 'tesseract' and is_native_ocr_supported():
+        # Native OCR runs single-threaded tesseract processes, and is not limited by the memory of mono
+        max_worker_threads = max(max_worker_threads, get_worker_thread_count())
 
     if errored_subs:
         max_worker_threads = 1
@@ -779,6 +854,13 @@ def convert_to_srt_process(logger, debug, input_files, dirpath, subtitle_files_l
                 else:
                     print_with_progress(logger, completed_count, total_files, header=header, description=description)
 
+    print_ocr_summary(logger, all_replacements_list, all_errored_subs)
+
+    return (all_ready_subtitle_tracks, subtitle_tracks_to_be_processed,
+            all_missing_subs_langs, all_errored_subs, main_audio_track_langs_list)
+
+
+def print_ocr_summary(logger, all_replacements_list, all_errored_subs):
     all_replacements_list_count = len([item for list in all_replacements_list for item in list])
 
     if all_replacements_list_count:
@@ -794,6 +876,14 @@ def convert_to_srt_process(logger, debug, input_files, dirpath, subtitle_files_l
                 log_debug(logger, replacement)
         log_debug(logger, '')
 
+    ocr_image_cache_stats = pop_ocr_image_cache_stats()
+    ocr_image_lookups = ocr_image_cache_stats['hits'] + ocr_image_cache_stats['misses']
+    if ocr_image_lookups:
+        print()
+        custom_print(logger, f"{GREY}[SUBTITLES]{RESET} {ocr_image_cache_stats['hits']} of {ocr_image_lookups} "
+                             f"subtitle {print_multi_or_single(ocr_image_lookups, 'image')} reused from the OCR cache "
+                             f"({ocr_image_cache_stats['hits'] / ocr_image_lookups * 100:.0f}% hit rate).")
+
     all_errored_subs_count = len([item for list in all_errored_subs for item in list])
     if all_errored_subs_count:
         print()
@@ -809,10 +899,8 @@ def convert_to_srt_process(logger, debug, input_files, dirpath, subtitle_files_l
         for index, sub in enumerate(errored_subs_print):
             log_debug(logger, f"[OCR ERROR] '{sub}'")
 
-    return (all_ready_subtitle_tracks, subtitle_tracks_to_be_processed,
-            all_missing_subs_langs, all_errored_subs, main_audio_track_langs_list)
-
 
+@ledger_stage('ocr')
 def convert_to_srt_process_worker(debug, input_file, dirpath, internal_threads, subtitle_files, memory_per_thread):
     input_file_with_path = os.path.join(dirpath, input_file)
     subtitle_files_to_process = subtitle_files
@@ -959,6 +1047,77 @@ def remove_sdh_process_worker(debug, input_subtitles, internal_threads):
     return all_replacements
 
 
+def get_truly_missing_subs_langs(input_file, missing_subs_langs, total_external_subs):
+    truly_missing_subs_langs = []
+    for lang in missing_subs_langs:
+        if lang != 'none' and lang and lang.lower() != 'und':
+            if any(sub for sub in total_external_subs):
+                input_file_base = re.sub(r'^[^/]+/', '', input_file).replace(".mkv", "")
+                if any(input_file_base in re.sub(r'^[^/]+/', '', sub).replace(".mkv", "") for sublist in
+                       total_external_subs for sub in sublist):
+                    if not any(lang[:-1] in re.sub(r'^[^/]+/', '', sub).replace(".mkv", "") for sublist in
+                               total_external_subs for sub in sublist):
+                        truly_missing_subs_langs.append(lang[:-1])
+            else:
+                truly_missing_subs_langs.append(lang[:-1])
+    return truly_missing_subs_langs
+
+
+def copy_subliminal_config(dirpath):
+    # Copy default or user subliminal config file to dirpath
+    if os.path.exists('subliminal.toml'):
+        shutil.copy('subliminal.toml', os.path.join(dirpath, 'subliminal.toml'))
+    else:
+        shutil.copy('subliminal_defaults.toml', os.path.join(dirpath, 'subliminal.toml'))
+
+
+def print_subliminal_summary(logger, all_truly_missing_subs_langs, all_downloaded_subs, all_failed_downloads,
+                             all_downloaded_subs_simple, all_failed_downloads_simple):
+    success_len = len((set(f"'{item}'" for sublist in all_downloaded_subs for item in sublist)))
+    failed_len = len((set(f"'{item}'" for sublist in all_failed_downloads for item in sublist)))
+    truly_missing_subs_count = len((set(f"'{item}'" for sublist in all_truly_missing_subs_langs for item in sublist)))
+
+    unique_items = set(item for sublist in all_truly_missing_subs_langs for item in sublist)
+
+    colors = [GREY]
+    if len(unique_items) > len(colors):
+        color_cycle = (colors * ((len(unique_items) // len(colors)) + 1))[:len(unique_items)]
+    else:
+        color_cycle = random.sample(colors, len(unique_items))
+    color_map = dict(zip(unique_items, color_cycle))
+
+    unique_vals_print = " ".join(
+        f"{color_map[item]}|{RESET}{item.upper()}{color_map[item]}|{RESET}"
+        for item in unique_items
+    )
+
+    if success_len or failed_len:
+        print()
+        custom_print(logger, f"{GREY}[SUBLIMINAL]{RESET} "
+                             f"Requested {print_multi_or_single(truly_missing_subs_count, 'language')}: {unique_vals_print}")
+        custom_print(logger, f"{GREY}[SUBLIMINAL]{RESET} "
+                             f"{GREEN}{CHECK} {success_len}{RESET}  {RED}{CROSS} {failed_len}{RESET}")
+
+        combined_downloaded = [item for sublist in all_downloaded_subs_simple for item in sublist]
+        combined_failed = [item for sublist in all_failed_downloads_simple for item in sublist]
+
+        if combined_downloaded:
+            downloaded_subs_info = return_media_info_string(combined_downloaded, GREEN)
+            for index, info in enumerate(downloaded_subs_info):
+                if index + 1 == len(downloaded_subs_info) and not combined_failed:
+                    custom_print_no_newline(logger, f"{GREY}[SUBLIMINAL]{RESET} {info}")
+                else:
+                    custom_print(logger, f"{GREY}[SUBLIMINAL]{RESET} {info}")
+
+        if combined_failed:
+            failed_downloads_info = return_media_info_string(combined_failed, RED)
+            for index, info in enumerate(failed_downloads_info):
+                if index + 1 == len(failed_downloads_info):
+                    custom_print_no_newline(logger, f"{GREY}[SUBLIMINAL]{RESET} {info}")
+                else:
+                    custom_print(logger, f"{GREY}[SUBLIMINAL]{RESET} {info}")
+
+
 def fetch_missing_subtitles_process(logger, debug, input_files, dirpath, total_external_subs,
                                     all_missing_subs_langs):
     total_files = len(input_files)
@@ -977,28 +1136,10 @@ def fetch_missing_subtitles_process(logger, debug, input_files, dirpath, total_e
     description = f"Process missing subtitles"
 
     for index, input_file in enumerate(input_files):
-        input_file_with_path = os.path.join(dirpath, input_file)
-        mkv_base, _, mkv_extension = input_file_with_path.rpartition('.')
-
-        truly_missing_subs_langs = []
-        for lang in all_missing_subs_langs[index]:
-            if lang != 'none' and lang and lang.lower() != 'und':
-                if any(sub for sub in total_external_subs):
-                    input_file_base = re.sub(r'^[^/]+/', '', input_files[index]).replace(".mkv", "")
-                    if any(input_file_base in re.sub(r'^[^/]+/', '', sub).replace(".mkv", "") for sublist in
-                           total_external_subs for sub in sublist):
-                        if not any(lang[:-1] in re.sub(r'^[^/]+/', '', sub).replace(".mkv", "") for sublist in
-                                   total_external_subs for sub in sublist):
-                            truly_missing_subs_langs.append(lang[:-1])
-                else:
-                    truly_missing_subs_langs.append(lang[:-1])
-        all_truly_missing_subs_langs.append(truly_missing_subs_langs)
+        all_truly_missing_subs_langs.append(
+            get_truly_missing_subs_langs(input_file, all_missing_subs_langs[index], total_external_subs))
 
-    # Copy default or user subliminal config file to dirpath
-    if os.path.exists('subliminal.toml'):
-        shutil.copy('subliminal.toml', os.path.join(dirpath, 'subliminal.toml'))
-    else:
-        shutil.copy('subliminal_defaults.toml', os.path.join(dirpath, 'subliminal.toml'))
+    copy_subliminal_config(dirpath)
 
     # Calculate number of workers and internal threads
     max_worker_threads = get_worker_thread_count()
@@ -1045,53 +1186,13 @@ def fetch_missing_subtitles_process(logger, debug, input_files, dirpath, total_e
                 print_no_timestamp(logger, f"\n{RED}[TRACEBACK]{RESET}\n{traceback_str}")
                 raise
 
-    success_len = len((set(f"'{item}'" for sublist in all_downloaded_subs for item in sublist)))
-    failed_len = len((set(f"'{item}'" for sublist in all_failed_downloads for item in sublist)))
-    truly_missing_subs_count = len((set(f"'{item}'" for sublist in all_truly_missing_subs_langs for item in sublist)))
-
-    unique_items = set(item for sublist in all_truly_missing_subs_langs for item in sublist)
-
-    colors = [GREY]
-    if len(unique_items) > len(colors):
-        color_cycle = (colors * ((len(unique_items) // len(colors)) + 1))[:len(unique_items)]
-    else:
-        color_cycle = random.sample(colors, len(unique_items))
-    color_map = dict(zip(unique_items, color_cycle))
-
-    unique_vals_print = " ".join(
-        f"{color_map[item]}|{RESET}{item.upper()}{color_map[item]}|{RESET}"
-        for item in unique_items
-    )
-
-    if success_len or failed_len:
-        print()
-        custom_print(logger, f"{GREY}[SUBLIMINAL]{RESET} "
-                             f"Requested {print_multi_or_single(truly_missing_subs_count, 'language')}: {unique_vals_print}")
-        custom_print(logger, f"{GREY}[SUBLIMINAL]{RESET} "
-                             f"{GREEN}{CHECK} {success_len}{RESET}  {RED}{CROSS} {failed_len}{RESET}")
-
-        combined_downloaded = [item for sublist in all_downloaded_subs_simple for item in sublist]
-        combined_failed = [item for sublist in all_failed_downloads_simple for item in sublist]
-
-        if combined_downloaded:
-            downloaded_subs_info = return_media_info_string(combined_downloaded, GREEN)
-            for index, info in enumerate(downloaded_subs_info):
-                if index + 1 == len(downloaded_subs_info) and not combined_failed:
-                    custom_print_no_newline(logger, f"{GREY}[SUBLIMINAL]{RESET} {info}")
-                else:
-                    custom_print(logger, f"{GREY}[SUBLIMINAL]{RESET} {info}")
-
-        if combined_failed:
-            failed_downloads_info = return_media_info_string(combined_failed, RED)
-            for index, info in enumerate(failed_downloads_info):
-                if index + 1 == len(failed_downloads_info):
-                    custom_print_no_newline(logger, f"{GREY}[SUBLIMINAL]{RESET} {info}")
-                else:
-                    custom_print(logger, f"{GREY}[SUBLIMINAL]{RESET} {info}")
+    print_subliminal_summary(logger, all_truly_missing_subs_langs, all_downloaded_subs, all_failed_downloads,
+                             all_downloaded_subs_simple, all_failed_downloads_simple)
 
     return all_downloaded_subs
 
 
+@ledger_stage('download')
 def fetch_missing_subtitles_process_worker(debug, input_file, dirpath, missing_subs_langs, internal_threads):
     a, filename = unflatten_file(input_file, '')
     mkv_base, _, mkv_extension = input_file.rpartition('.')
@@ -1194,6 +1295,7 @@ def resync_sub_process(logger, debug, input_files, dirpath, subtitle_files_to_pr
     return result
 
 
+@ledger_stage('resync')
 def resync_subs_process_worker(debug, input_file, dirpath, subtitle_files_to_process, internal_threads):
     input_file_with_path = os.path.join(dirpath, input_file)
     resync_subtitles = check_config(config, 'subtitles', 'resync_subtitles')
@@ -1242,22 +1344,31 @@ def remove_clutter_process_worker(debug, input_file, dirpath):
     file_tag = check_config(config, 'general', 'file_tag')
     remove_all_title_names = check_config(config, 'general', 'remove_all_title_names')
 
-    remove_all_mkv_track_tags(debug, input_file_with_path)
-    if remove_all_title_names:
-        strip_mkv_title_and_track_names(debug, input_file_with_path)
+    # Probe before the header edits below, so that the
+    # cached probe from remove_clutter_process is reused
+    probe = MediaProbe(input_file_with_path)
+    mkv_video_codec = probe.get_video_codec()
+    closed_captions_found = probe.has_closed_captions()
+
+    remove_all_mkv_track_tags(debug, input_file_with_path, remove_all_title_names)
+    # A resumed run accepts the edited file as muxed
+    update_job_fingerprint(input_file_with_path)
 
-    mkv_video_codec = get_mkv_video_codec(input_file_with_path)
-    if has_closed_captions(input_file_with_path):
+    if closed_captions_found:
         # Will remove hidden CC data as long as
         # video codec is not MPEG2 (DVD)
         if mkv_video_codec != 'MPEG-1/2':
             remove_cc_hidden_in_file(debug, input_file_with_path)
+            update_job_fingerprint(input_file_with_path)
 
     if file_tag.lower() != "default" and not input_file.lower().startswith('snapchat'):
         updated_filename = replace_tags_in_file(input_file, file_tag)
         updated_filename_with_path = os.path.join(dirpath, updated_filename)
         shutil.move(input_file_with_path, updated_filename_with_path)
 
+    # A resumed run must not remux the edited file, nor clean it up again
+    mark_job_cleaned(input_file_with_path, os.path.join(dirpath, updated_filename))
+
     return updated_filename
 
 
@@ -1273,11 +1384,16 @@ def repack_mkv_tracks_process(logger, debug, input_files, dirpath, audio_tracks_
     # Initialize progress
     print_with_progress(logger, 0, total_files, header=header, description=description)
 
+    # Remuxing is I/O bound, measured in MB/s of source files
+    limiter = AdaptiveLimiter(logger, header, num_workers, int(get_resource_sampler().cpu_count * 2))
+
     # Use ThreadPoolExecutor to handle multithreading
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
         futures = {
-            executor.submit(repack_mkv_tracks_process_worker, debug, input_file, dirpath, audio_tracks_list[index],
-                            subtitle_tracks_list[index]): index for index, input_file in enumerate(input_files)}
+            limiter.submit(executor, repack_mkv_tracks_process_worker, debug, input_file, dirpath,
+                           audio_tracks_list[index], subtitle_tracks_list[index],
+                           work=get_file_size_mb(os.path.join(dirpath, input_file))): index
+            for index, input_file in enumerate(input_files)}
 
         for completed_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
             print_with_progress(logger, completed_count, total_files, header=header, description=description)
@@ -1302,12 +1418,70 @@ def repack_mkv_tracks_process(logger, debug, input_files, dirpath, audio_tracks_
                 raise
 
 
+@ledger_stage('repack', muxes=True)
 def repack_mkv_tracks_process_worker(debug, input_file, dirpath, audio_tracks, subtitle_tracks):
     input_file_with_path = os.path.join(dirpath, input_file)
 
     repack_tracks_in_mkv(debug, input_file_with_path, audio_tracks, subtitle_tracks)
 
 
+def remux_planned_tracks_process(logger, debug, input_files, dirpath):
+    # Only used when no tracks are repacked, as the planned
+    # track changes are otherwise applied by repack_tracks_in_mkv
+    input_files = [file for file in input_files if has_pending_remux(os.path.join(dirpath, file))]
+    total_files = len(input_files)
+    if total_files == 0:
+        return
+
+    max_worker_threads = get_worker_thread_count()
+    num_workers = max(1, max_worker_threads)
+
+    header = "MKVMERGE"
+    description = "Filter audio tracks"
+
+    # Initialize progress
+    print_with_progress(logger, 0, total_files, header=header, description=description)
+
+    # Remuxing is I/O bound, measured in MB/s of source files
+    limiter = AdaptiveLimiter(logger, header, num_workers, int(get_resource_sampler().cpu_count * 2))
+
+    # Use ThreadPoolExecutor to handle multithreading
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limiter.maximum) as executor:
+        futures = {limiter.submit(executor, remux_planned_tracks_process_worker, debug, input_file, dirpath,
+                                  work=get_file_size_mb(os.path.join(dirpath, input_file))): index for
+                   index, input_file in enumerate(input_files)}
+
+        for completed_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            print_with_progress(logger, completed_count, total_files, header=header, description=description)
+            try:
+                future.result()
+            except Exception as e:
+                # Fetch the variables that were passed to the thread
+                index = futures[future]
+                input_file = input_files[index]
+
+                # Print the error and traceback
+                custom_print(logger, f"{RED}[ERROR]{RESET} {e}")
+                print_no_timestamp(logger, f"  {BLUE}debug{RESET}: {debug}")
+                print_no_timestamp(logger, f"  {BLUE}input_file{RESET}: {input_file}")
+                print_no_timestamp(logger, f"  {BLUE}dirpath{RESET}: {dirpath}")
+                traceback_str = ''.join(traceback.format_tb(e.__traceback__))
+                print_no_timestamp(logger, f"\n{RED}[TRACEBACK]{RESET}\n{traceback_str}")
+                raise
+
+
+@ledger_stage('remux', muxes=True)
+def remux_planned_tracks_process_worker(debug, input_file, dirpath):
+    input_file_with_path = os.path.join(dirpath, input_file)
+
+    remux_plan = get_remux_plan(input_file_with_path)
+    if remux_plan and remux_plan.needs_remux():
+        strip_audio_tracks_in_mkv(debug, input_file_with_path, remux_plan.audio_tracks,
+                                  remux_plan.default_audio_track)
+    # This is the last mux of the file, as in repack_tracks_in_mkv
+    clear_demux_manifest(input_file_with_path)
+
+
 def process_external_subs(logger, debug, dirpath, input_files, all_missing_subs_langs):
     total_files = len(input_files)
     subtitle_tracks_to_be_processed = [None] * total_files
@@ -1514,6 +1688,23 @@ def process_external_subs_worker(debug, input_file, dirpath, missing_subs_langs)
     return all_sub_files, updated_missing_subs_langs
 
 
+def finish_resumed_files(logger, debug, input_files, dirpath, all_dirnames, output_dir):
+    # Files that were already muxed when the previous run was interrupted
+    # only need to be cleaned up and moved to the output folder
+    muxed_files = [file for file in input_files if get_job_resume_state(os.path.join(dirpath, file)) == 'muxed']
+    cleaned_files = [file for file in input_files if get_job_resume_state(os.path.join(dirpath, file)) == 'cleaned']
+    resumed_files = muxed_files + cleaned_files
+    if not resumed_files:
+        return []
+
+    print()
+    custom_print(logger, f"{GREY}[INFO]{RESET} Resuming {len(resumed_files)} "
+                         f"{print_multi_or_single(len(resumed_files), 'file')} processed before the last run was interrupted.")
+    updated_files = remove_clutter_process(logger, debug, muxed_files, dirpath) if muxed_files else []
+    move_files_to_output_process(logger, debug, updated_files + cleaned_files, dirpath, all_dirnames, output_dir)
+    return resumed_files
+
+
 def move_files_to_output_process(logger, debug, input_files, dirpath, all_dirnames, output_dir):
     total_files = len(input_files)
     normalize_filenames = check_config(config, 'general', 'normalize_filenames')
@@ -1558,6 +1749,10 @@ def move_files_to_output_process(logger, debug, input_files, dirpath, all_dirnam
                 print_no_timestamp(logger, f"\n{RED}[TRACEBACK]{RESET}\n{traceback_str}")
                 raise
 
+    print_integrations_summary(logger, new_radarr_paths, new_sonarr_paths)
+
+
+def print_integrations_summary(logger, new_radarr_paths, new_sonarr_paths):
     new_radarr_paths_len = sum(1 for item in new_radarr_paths if item.strip() != '')
     new_sonarr_paths_len = sum(1 for item in new_sonarr_paths if item.strip() != '')
 
@@ -1639,20 +1834,22 @@ def strip_audio_tracks_in_mkv(debug, filename, audio_tracks, default_audio_track
         print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}")
         print(f"{RESET}")
 
-    result = subprocess.run(command, capture_output=True, text=True)
+    with io_slot(filename):
+        result = subprocess.run(command, capture_output=True, text=True)
     if result.returncode != 0:
         os.remove(temp_filename)
     result.check_returncode()
 
     os.remove(filename)
     shutil.move(temp_filename, filename)
+    clear_remux_plan(filename)
+    invalidate_probe_cache(filename)
 
 
 def check_integrity_of_mkv(filename):
-    command = ["mkvmerge", "--identify", filename]
-
-    result = subprocess.run(command, capture_output=True, text=True)
-    result.check_returncode()
+    probe = MediaProbe(filename)
+    if not probe.is_intact():
+        raise subprocess.CalledProcessError(probe.mkvmerge_returncode, ["mkvmerge", "-J", filename])
 
 
 def repack_tracks_in_mkv(debug, filename, audio_tracks, subtitle_tracks):
@@ -1665,17 +1862,8 @@ def repack_tracks_in_mkv(debug, filename, audio_tracks, subtitle_tracks):
     base, extension = os.path.splitext(filename)
 
     def get_codec_and_channels(filepath):
-        cmd = [
-            "ffprobe", "-v", "quiet", "-select_streams", "a:0",
-            "-show_entries", "stream=codec_name,channels",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            filepath
-        ]
-        res = subprocess.run(cmd, capture_output=True, text=True)
-        lines = res.stdout.strip().splitlines()
-        codec = unify_codec(lines[0].lower() if lines else "unknown")
-        channels = int(lines[1]) if len(lines) > 1 else 0
-        return codec, channels
+        codec, channels = MediaProbe(filepath).get_audio_codec_and_channels()
+        return unify_codec(codec), channels
 
     def unify_codec(acodec):
         if acodec.startswith("dts"):
@@ -1913,18 +2101,24 @@ def repack_tracks_in_mkv(debug, filename, audio_tracks, subtitle_tracks):
                            '--forced-display-flag', forced_str,
                            filelist_str)
 
-    if audio_filetypes:
-        command = ["mkvmerge", "--no-subtitles", "--no-audio", "--output",
-                   temp_filename, filename] + audio_files_list + sub_files_list
+    # Audio tracks planned to be dropped earlier in the pipeline
+    # are removed here, so that the file is only remuxed once
+    remux_plan = get_remux_plan(filename)
+    if remux_plan:
+        source_options = remux_plan.get_source_options(bool(audio_filetypes))
     else:
-        command = ["mkvmerge", "--no-subtitles", "--output", temp_filename, filename] + sub_files_list
+        source_options = ["--no-audio"] if audio_filetypes else []
+
+    command = (["mkvmerge", "--no-subtitles"] + source_options + ["--output", temp_filename, filename] +
+               audio_files_list + sub_files_list)
 
     if debug:
         print('')
         print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}")
         print(f"{RESET}")
 
-    result = subprocess.run(command, capture_output=True, text=True)
+    with io_slot(filename):
+        result = subprocess.run(command, capture_output=True, text=True)
 
     if result.returncode != 0 and not os.path.exists(temp_filename):
         print('')
@@ -1934,6 +2128,9 @@ def repack_tracks_in_mkv(debug, filename, audio_tracks, subtitle_tracks):
 
     os.remove(filename)
     shutil.move(temp_filename, filename)
+    clear_remux_plan(filename)
+    clear_demux_manifest(filename)
+    invalidate_probe_cache(filename)
 
     if audio_filetypes:
         for index, filetype in enumerate(final_audio_filetypes):
@@ -0,0 +1,619 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import pycountry
+from collections import OrderedDict
+
+from modules.misc import *
+
+# NumPy is optional, SubtitleEdit is used for OCR without it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# PGS segment types
+PGS_PALETTE = 0x14
+PGS_OBJECT = 0x15
+PGS_COMPOSITION = 0x16
+PGS_END = 0x80
+
+# Luminance * alpha (both 0-255) above which a pixel is part of the text. The text
+# of image subtitles is bright, the outline around it dark.
+INK_THRESHOLD = 128 * 255
+# Blank border around the text, tesseract does not like text touching the edge
+OCR_PADDING = 10
+# Number of images per tesseract run
+OCR_BATCH_SIZE = 64
+# VobSub events without a stop time are shown until the next event, or at most this long (ms)
+MAX_EVENT_DURATION = 10000
+# Tesseract names some languages differently than ISO 639-2/T
+TESSERACT_LANGUAGES = {'zho': 'chi_sim', 'srp': 'srp_latn'}
+
+tesseract_languages = None
+tesseract_languages_lock = threading.Lock()
+
+# Text recognized from subtitle images, keyed by a hash of the cropped and binarized
+# image. The same lines are often shown again, in the forced and full tracks of a file
+# and in the intros of a season, and are only OCR'd once. Ordered by last use.
+ocr_image_cache = OrderedDict()
+ocr_image_cache_lock = threading.Lock()
+ocr_image_cache_stats = {'hits': 0, 'misses': 0}
+ocr_image_cache_file = None
+
+
+def get_ocr_cache_dir(temp_dir):
+    # Kept next to the TEMP folder by default, as the TEMP folder is cleared between runs
+    cache_dir = check_config(config, 'subtitles', 'ocr_cache_dir')
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(temp_dir.rstrip('/'))), '.ocr_cache')
+    return cache_dir
+
+
+def init_ocr_image_cache(temp_dir):
+    global ocr_image_cache_file
+
+    max_entries = int(check_config(config, 'subtitles', 'ocr_image_cache_size') or 0)
+    if max_entries <= 0:
+        ocr_image_cache_file = None
+        return
+
+    ocr_image_cache_file = os.path.join(get_ocr_cache_dir(temp_dir), 'images.json')
+    if os.path.isfile(ocr_image_cache_file):
+        try:
+            with open(ocr_image_cache_file, 'r', encoding='utf-8') as f:
+                stored_entries = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        oldest = time.time() - float(check_config(config, 'subtitles', 'ocr_image_cache_days') or 0) * 86400
+        with ocr_image_cache_lock:
+            for key, entry in sorted(stored_entries.items(), key=lambda item: item[1]['time']):
+                if entry['time'] >= oldest:
+                    ocr_image_cache[key] = entry
+            evict_ocr_image_cache(max_entries)
+
+
+def evict_ocr_image_cache(max_entries):
+    # Removes the least recently used entries, the lock must be held
+    while len(ocr_image_cache) > max_entries:
+        ocr_image_cache.popitem(last=False)
+
+
+def save_ocr_image_cache():
+    if not ocr_image_cache_file:
+        return
+
+    with ocr_image_cache_lock:
+        data = json.dumps(ocr_image_cache)
+
+    try:
+        os.makedirs(os.path.dirname(ocr_image_cache_file), exist_ok=True)
+        temp_file = f"{ocr_image_cache_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_file, ocr_image_cache_file)
+    except OSError:
+        pass
+
+
+def get_ocr_image_key(bitmap, language):
+    # The image is already cropped and binarized, so an exact hash matches
+    # repeated lines regardless of their position and anti-aliasing
+    digest = hashlib.sha1(f"{language}:{bitmap.shape[0]}x{bitmap.shape[1]}:".encode('utf-8'))
+    digest.update(np.packbits(bitmap).tobytes())
+    return digest.hexdigest()
+
+
+def get_cached_ocr_text(key, pending=False):
+    # Returns the text of an image that was OCR'd before, None if it is unknown.
+    # Images that are already waiting to be OCR'd (pending) are counted as hits.
+    if not ocr_image_cache_file:
+        return None
+    with ocr_image_cache_lock:
+        entry = ocr_image_cache.get(key)
+        if entry is not None:
+            entry['time'] = time.time()
+            ocr_image_cache.move_to_end(key)
+        if entry is not None or pending:
+            ocr_image_cache_stats['hits'] += 1
+        else:
+            ocr_image_cache_stats['misses'] += 1
+    return entry['text'] if entry is not None else None
+
+
+def store_cached_ocr_text(key, text):
+    if not ocr_image_cache_file:
+        return
+    max_entries = int(check_config(config, 'subtitles', 'ocr_image_cache_size') or 0)
+    with ocr_image_cache_lock:
+        ocr_image_cache[key] = {'text': text, 'time': time.time()}
+        ocr_image_cache.move_to_end(key)
+        evict_ocr_image_cache(max_entries)
+
+
+def pop_ocr_image_cache_stats():
+    # Returns the hits and misses since the last call
+    with ocr_image_cache_lock:
+        stats = dict(ocr_image_cache_stats)
+        ocr_image_cache_stats['hits'] = 0
+        ocr_image_cache_stats['misses'] = 0
+    return stats
+
+
+def is_native_ocr_supported():
+    return np is not None and shutil.which('tesseract') is not None
+
+
+def get_tesseract_language(language):
+    # Subtitle tracks are tagged with ISO 639-2/B codes ('ger', 'fre'), tesseract uses ISO 639-2/T
+    global tesseract_languages
+    try:
+        lang = pycountry.languages.get(bibliographic=language) or pycountry.languages.get(alpha_3=language)
+    except (KeyError, LookupError):
+        lang = None
+    code = lang.alpha_3 if lang else language
+    code = TESSERACT_LANGUAGES.get(code, code)
+
+    with tesseract_languages_lock:
+        if tesseract_languages is None:
+            result = subprocess.run(["tesseract", "--list-langs"], capture_output=True, text=True)
+            tesseract_languages = set(line.strip() for line in result.stdout.splitlines()[1:])
+    if code not in tesseract_languages:
+        raise RuntimeError(f"tesseract language '{code}' is not installed")
+    return code
+
+
+def decode_pgs_rle(data, width, height):
+    # Returns the palette index of each pixel, row by row
+    pixels = bytearray(width * height)
+    pos = 0
+    x = 0
+    y = 0
+    while pos < len(data) and y < height:
+        byte = data[pos]
+        pos += 1
+        if byte:
+            if x < width:
+                pixels[y * width + x] = byte
+            x += 1
+            continue
+        flags = data[pos]
+        pos += 1
+        if flags == 0:
+            # End of line
+            x = 0
+            y += 1
+            continue
+        if flags & 0x40:
+            length = ((flags & 0x3F) << 8) | data[pos]
+            pos += 1
+        else:
+            length = flags & 0x3F
+        if flags & 0x80:
+            color = data[pos]
+            pos += 1
+        else:
+            color = 0
+        end = min(x + length, width)
+        if color and end > x:
+            pixels[y * width + x:y * width + end] = bytes([color]) * (end - x)
+        x += length
+    return np.frombuffer(bytes(pixels), dtype=np.uint8).reshape(height, width)
+
+
+def read_pgs_segments(data):
+    pos = 0
+    while pos + 13 <= len(data):
+        if data[pos:pos + 2] != b'PG':
+            raise ValueError("invalid PGS segment")
+        pts = int.from_bytes(data[pos + 2:pos + 6], 'big')
+        segment_type = data[pos + 10]
+        size = int.from_bytes(data[pos + 11:pos + 13], 'big')
+        yield pts // 90, segment_type, data[pos + 13:pos + 13 + size]
+        pos += 13 + size
+
+
+def render_pgs_composition(composition, objects, palette):
+    # Places the objects of a composition on one bitmap, and returns the text pixels
+    placed = []
+    for object_id, x, y, crop in composition:
+        if object_id not in objects:
+            continue
+        width, height, rle = objects[object_id]
+        indices = decode_pgs_rle(rle, width, height)
+        if crop:
+            crop_x, crop_y, crop_width, crop_height = crop
+            indices = indices[crop_y:crop_y + crop_height, crop_x:crop_x + crop_width]
+        ink = palette[indices] > INK_THRESHOLD
+        placed.append((x, y, ink))
+    if not placed:
+        return None
+
+    left = min(x for x, y, ink in placed)
+    top = min(y for x, y, ink in placed)
+    right = max(x + ink.shape[1] for x, y, ink in placed)
+    bottom = max(y + ink.shape[0] for x, y, ink in placed)
+    canvas = np.zeros((bottom - top, right - left), dtype=bool)
+    for x, y, ink in placed:
+        canvas[y - top:y - top + ink.shape[0], x - left:x - left + ink.shape[1]] |= ink
+    return canvas
+
+
+def decode_pgs(filename):
+    # Yields (start ms, end ms, text pixels) for each subtitle event of a .sup file
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    palettes = {}
+    objects = {}
+    composition = []
+    palette_id = 0
+    composition_start = 0
+    event = None
+
+    for pts, segment_type, segment in read_pgs_segments(data):
+        if segment_type == PGS_COMPOSITION:
+            composition_state = segment[7]
+            palette_id = segment[9]
+            num_objects = segment[10]
+            if composition_state & 0x80:
+                # Epoch start, objects and palettes from earlier epochs are not reused
+                palettes = {}
+                objects = {}
+            composition = []
+            pos = 11
+            for _ in range(num_objects):
+                object_id = int.from_bytes(segment[pos:pos + 2], 'big')
+                cropped = segment[pos + 3] & 0x80
+                x = int.from_bytes(segment[pos + 4:pos + 6], 'big')
+                y = int.from_bytes(segment[pos + 6:pos + 8], 'big')
+                crop = None
+                if cropped:
+                    crop = tuple(int.from_bytes(segment[pos + 8 + i:pos + 10 + i], 'big') for i in range(0, 8, 2))
+                    pos += 8
+                composition.append((object_id, x, y, crop))
+                pos += 8
+            composition_start = pts
+        elif segment_type == PGS_PALETTE:
+            # Luminance * alpha of each palette entry
+            palette = palettes.get(segment[0], np.zeros(256, dtype=np.int32))
+            palette = palette.copy()
+            for pos in range(2, len(segment) - 4, 5):
+                palette[segment[pos]] = segment[pos + 1] * segment[pos + 4]
+            palettes[segment[0]] = palette
+        elif segment_type == PGS_OBJECT:
+            object_id = int.from_bytes(segment[0:2], 'big')
+            if segment[3] & 0x80:
+                # First fragment, followed by the size of the object
+                width = int.from_bytes(segment[7:9], 'big')
+                height = int.from_bytes(segment[9:11], 'big')
+                objects[object_id] = (width, height, bytearray(segment[11:]))
+            elif object_id in objects:
+                objects[object_id][2].extend(segment[4:])
+        elif segment_type == PGS_END:
+            # A display set replaces what is shown, an empty one clears the screen
+            if event:
+                yield event[0], composition_start, event[1]
+                event = None
+            if composition:
+                bitmap = render_pgs_composition(composition, objects,
+                                                palettes.get(palette_id, np.zeros(256, dtype=np.int32)))
+                if bitmap is not None and bitmap.any():
+                    event = (composition_start, bitmap)
+
+    if event:
+        yield event[0], event[0] + MAX_EVENT_DURATION, event[1]
+
+
+def read_vobsub_idx(filename):
+    # Returns the frame size, the luminance of the 16 palette colors and the (ms, file position) of each event
+    width, height = 720, 576
+    luminance = [0] * 16
+    timestamps = []
+    with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            key, _, value = line.strip().partition(':')
+            value = value.strip()
+            if key == 'size':
+                width, height = (int(v) for v in value.split('x'))
+            elif key == 'palette':
+                colors = [int(c.strip(), 16) for c in value.split(',') if c.strip()]
+                luminance = [int(0.299 * (c >> 16) + 0.587 * ((c >> 8) & 0xFF) + 0.114 * (c & 0xFF))
+                             for c in colors[:16]] + [0] * (16 - len(colors[:16]))
+            elif key == 'timestamp':
+                time_str, _, filepos = value.partition(',')
+                hours, minutes, seconds, millis = (int(v) for v in time_str.strip().split(':'))
+                position = int(filepos.partition(':')[2].strip(), 16)
+                timestamps.append(((hours * 3600 + minutes * 60 + seconds) * 1000 + millis, position))
+    return width, height, luminance, timestamps
+
+
+def read_vobsub_packet(data, pos):
+    # Collects the subpicture unit that starts at pos, from the MPEG-PS packets it is split over
+    spu = bytearray()
+    spu_size = None
+    while pos + 6 <= len(data):
+        if data[pos:pos + 4] == b'\x00\x00\x01\xba':
+            # Pack header, MPEG-2 or MPEG-1
+            if data[pos + 4] & 0xC0 == 0x40:
+                pos += 14 + (data[pos + 13] & 0x07)
+            else:
+                pos += 12
+            continue
+        if data[pos:pos + 3] != b'\x00\x00\x01':
+            raise ValueError("invalid VobSub packet")
+        stream_id = data[pos + 3]
+        packet_end = pos + 6 + int.from_bytes(data[pos + 4:pos + 6], 'big')
+        if stream_id == 0xBD:
+            # Private stream 1, the PES header is followed by the substream id
+            payload_start = pos + 9 + data[pos + 8] + 1
+            spu += data[payload_start:packet_end]
+            if spu_size is None and len(spu) >= 2:
+                spu_size = int.from_bytes(spu[0:2], 'big')
+            if spu_size is not None and len(spu) >= spu_size:
+                return bytes(spu[:spu_size])
+        pos = packet_end
+    raise ValueError("truncated VobSub packet")
+
+
+def decode_vobsub_rle(spu, offset, width, height, first_line, pixels):
+    # Decodes one field (every other line) of 2-bit pixels
+    pos = offset * 2
+
+    def nibble(position):
+        byte = spu[position >> 1]
+        return byte & 0x0F if position & 1 else byte >> 4
+
+    for y in range(first_line, height, 2):
+        x = 0
+        while x < width:
+            value = nibble(pos)
+            pos += 1
+            if value < 0x4:
+                value = (value << 4) | nibble(pos)
+                pos += 1
+                if value < 0x10:
+                    value = (value << 4) | nibble(pos)
+                    pos += 1
+                    if value < 0x40:
+                        value = (value << 4) | nibble(pos)
+                        pos += 1
+            length = value >> 2
+            # A length of 0 fills the rest of the line
+            end = width if length == 0 else min(width, x + length)
+            if value & 0x3:
+                pixels[y * width + x:y * width + end] = bytes([value & 0x3]) * (end - x)
+            x = end
+        # Lines start on a byte boundary
+        pos += pos & 1
+
+
+def decode_vobsub_spu(spu, luminance):
+    # Returns the start and stop delays (ms) and the text pixels of a subpicture unit
+    colors = [0, 0, 0, 0]
+    alphas = [0, 0, 0, 0]
+    x1 = x2 = y1 = y2 = 0
+    top_field = bottom_field = None
+    start_delay = 0
+    stop_delay = None
+
+    offset = int.from_bytes(spu[2:4], 'big')
+    seen = set()
+    while offset not in seen and offset + 4 <= len(spu):
+        seen.add(offset)
+        # Delays are in units of 1024 / 90000 seconds
+        delay = int.from_bytes(spu[offset:offset + 2], 'big') * 1024 // 90
+        next_offset = int.from_bytes(spu[offset + 2:offset + 4], 'big')
+        pos = offset + 4
+        while pos < len(spu):
+            command = spu[pos]
+            pos += 1
+            if command in (0x00, 0x01):
+                start_delay = delay
+            elif command == 0x02:
+                stop_delay = delay
+            elif command in (0x03, 0x04):
+                # Four nibbles, for pixel values 3, 2, 1 and 0
+                values = [spu[pos + 1] & 0x0F, spu[pos + 1] >> 4, spu[pos] & 0x0F, spu[pos] >> 4]
+                if command == 0x03:
+                    colors = values
+                else:
+                    alphas = values
+                pos += 2
+            elif command == 0x05:
+                x1 = (spu[pos] << 4) | (spu[pos + 1] >> 4)
+                x2 = ((spu[pos + 1] & 0x0F) << 8) | spu[pos + 2]
+                y1 = (spu[pos + 3] << 4) | (spu[pos + 4] >> 4)
+                y2 = ((spu[pos + 4] & 0x0F) << 8) | spu[pos + 5]
+                pos += 6
+            elif command == 0x06:
+                top_field = int.from_bytes(spu[pos:pos + 2], 'big')
+                bottom_field = int.from_bytes(spu[pos + 2:pos + 4], 'big')
+                pos += 4
+            else:
+                # 0xFF ends the sequence, other commands can not be skipped
+                break
+        offset = next_offset
+
+    width = x2 - x1 + 1
+    height = y2 - y1 + 1
+    if top_field is None or width <= 0 or height <= 0:
+        return start_delay, stop_delay, None
+
+    pixels = bytearray(width * height)
+    decode_vobsub_rle(spu, top_field, width, height, 0, pixels)
+    decode_vobsub_rle(spu, bottom_field, width, height, 1, pixels)
+    # Alpha is 0-15
+    ink_values = np.array([luminance[colors[i]] * alphas[i] * 17 for i in range(4)], dtype=np.int32)
+    indices = np.frombuffer(bytes(pixels), dtype=np.uint8).reshape(height, width)
+    return start_delay, stop_delay, ink_values[indices] > INK_THRESHOLD
+
+
+def decode_vobsub(filename):
+    # Yields (start ms, end ms, text pixels) for each subtitle event of a .idx/.sub pair
+    idx_file = filename[:-len('.sub')] + '.idx'
+    width, height, luminance, timestamps = read_vobsub_idx(idx_file)
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    for i, (timestamp, position) in enumerate(timestamps):
+        start_delay, stop_delay, bitmap = decode_vobsub_spu(read_vobsub_packet(data, position), luminance)
+        if bitmap is None or not bitmap.any():
+            continue
+        start = timestamp + start_delay
+        next_start = timestamps[i + 1][0] if i + 1 < len(timestamps) else start + MAX_EVENT_DURATION
+        if stop_delay is not None and stop_delay > start_delay:
+            end = timestamp + stop_delay
+        else:
+            end = min(next_start, start + MAX_EVENT_DURATION)
+        yield start, end, bitmap
+
+
+def crop_ocr_bitmap(bitmap, scale):
+    # Crops the text pixels, and scales them up for tesseract
+    rows = np.flatnonzero(bitmap.any(axis=1))
+    cols = np.flatnonzero(bitmap.any(axis=0))
+    bitmap = bitmap[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    if scale > 1:
+        bitmap = bitmap.repeat(scale, axis=0).repeat(scale, axis=1)
+    return bitmap
+
+
+def write_ocr_image(bitmap, filename):
+    # Writes the text black on white as a PGM image
+    image = np.full((bitmap.shape[0] + 2 * OCR_PADDING, bitmap.shape[1] + 2 * OCR_PADDING), 255, dtype=np.uint8)
+    image[OCR_PADDING:OCR_PADDING + bitmap.shape[0], OCR_PADDING:OCR_PADDING + bitmap.shape[1]][bitmap] = 0
+    with open(filename, 'wb') as f:
+        f.write(b'P5\n%d %d\n255\n' % (image.shape[1], image.shape[0]))
+        f.write(image.tobytes())
+
+
+def run_tesseract(debug, images, language, work_dir):
+    # OCRs a batch of images with one tesseract process, and returns the text of each image
+    list_file = os.path.join(work_dir, 'images.txt')
+    with open(list_file, 'w') as f:
+        f.write('\n'.join(images) + '\n')
+
+    command = ["tesseract", list_file, "stdout", "-l", language, "--psm", "6"]
+    if debug:
+        print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
+
+    # One thread per tesseract process, the subtitle tracks are OCR'd in parallel
+    env = os.environ.copy()
+    env['OMP_THREAD_LIMIT'] = '1'
+    result = subprocess.run(command, capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+
+    # Tesseract ends each page with a form feed
+    pages = result.stdout.split('\f')
+    if len(pages) < len(images):
+        raise RuntimeError("tesseract returned fewer pages than images")
+    texts = []
+    for page in pages[:len(images)]:
+        texts.append('\n'.join(line.strip() for line in page.splitlines() if line.strip()))
+    return texts
+
+
+def format_srt_time(ms):
+    hours, ms = divmod(ms, 3600000)
+    minutes, ms = divmod(ms, 60000)
+    seconds, ms = divmod(ms, 1000)
+    return f"{hours:02}:{minutes:02}:{seconds:02},{ms:03}"
+
+
+def write_srt(events, filename):
+    with open(filename, 'w', encoding='utf-8') as f:
+        for index, (start, end, text) in enumerate(events, 1):
+            f.write(f"{index}\n{format_srt_time(start)} --> {format_srt_time(end)}\n{text}\n\n")
+
+
+def merge_ocr_events(events):
+    # Palette animations (fades) show the same text as several events, these are joined
+    merged = []
+    for start, end, text in events:
+        if not text:
+            continue
+        if merged and merged[-1][2] == text and start - merged[-1][1] <= 100:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]), text)
+        else:
+            merged.append((start, end, text))
+    return merged
+
+
+def run_native_ocr(debug, file, language, output_subtitle):
+    # OCRs a .sup or .sub file with tesseract, without SubtitleEdit. Returns 0 on success.
+    work_dir = None
+    try:
+        tesseract_language = get_tesseract_language(language)
+        if file.endswith('.sup'):
+            decoded_events = decode_pgs(file)
+            scale = 1
+        else:
+            decoded_events = decode_vobsub(file)
+            # DVD subtitles are small, tesseract is more accurate on larger text
+            scale = 2
+
+        work_dir = tempfile.mkdtemp(prefix='ocr_', dir=os.path.dirname(os.path.abspath(file)))
+        events = []
+        batch = []
+        pending_keys = set()
+
+        def ocr_batch():
+            images = [(image, key) for start, end, image, key in batch if image]
+            texts = run_tesseract(debug, [image for image, key in images], tesseract_language, work_dir)
+            recognized = {}
+            for (image, key), text in zip(images, texts):
+                recognized[key] = text
+                store_cached_ocr_text(key, text)
+                os.remove(image)
+            for start, end, image, key in batch:
+                events.append((start, end, recognized[key]))
+            batch.clear()
+            pending_keys.clear()
+
+        for start, end, bitmap in decoded_events:
+            bitmap = crop_ocr_bitmap(bitmap, scale)
+            key = get_ocr_image_key(bitmap, tesseract_language)
+            text = get_cached_ocr_text(key, pending=key in pending_keys)
+            if text is not None:
+                events.append((start, end, text))
+                continue
+            if key in pending_keys:
+                # Same image as an earlier event of this batch
+                batch.append((start, end, None, key))
+                continue
+            image = os.path.join(work_dir, f"{len(events) + len(batch)}.pgm")
+            write_ocr_image(bitmap, image)
+            batch.append((start, end, image, key))
+            pending_keys.add(key)
+            if len(batch) >= OCR_BATCH_SIZE:
+                ocr_batch()
+        if batch:
+            ocr_batch()
+
+        # Events from the cache are added before those of the pending batch
+        events.sort(key=lambda event: event[0])
+        events = merge_ocr_events(events)
+        if not events:
+            raise RuntimeError("no text was recognized")
+        tmp_subtitle = f"{output_subtitle}.tmp"
+        write_srt(events, tmp_subtitle)
+        os.replace(tmp_subtitle, output_subtitle)
+        return 0
+
+    except Exception as e:
+        if debug:
+            print(f"{GREY}[UTC {get_timestamp()}] [OCR DEBUG]{RESET} Native OCR of '{os.path.basename(file)}' "
+                  f"failed ({e}), using SubtitleEdit instead.")
+        return -1
+
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
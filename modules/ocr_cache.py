@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+import threading
+import subprocess
+
+from modules.misc import *
+from modules.ocr import *
+from modules.content_cache import ContentCache
+
+
+# Cache of OCR'd subtitle tracks, keyed by the extracted .sup/.sub bytes, the OCR
+# language and the engine that produced the subtitle, so that reprocessing the same
+# release (or resuming after a crash) does not OCR the tracks again. Entries are
+# copied in and out, as the subtitle is rewritten in place later on.
+ocr_track_cache = None
+ocr_engine_versions = {}
+ocr_engine_versions_lock = threading.Lock()
+
+SUBTITLEEDIT_EXE = 'utilities/SubtitleEdit/SubtitleEdit.exe'
+
+
+def init_ocr_track_cache(temp_dir):
+    global ocr_track_cache
+
+    max_size_mb = float(check_config(config, 'subtitles', 'ocr_track_cache_size') or 0)
+    if max_size_mb <= 0:
+        ocr_track_cache = None
+        return
+
+    cache_dir = os.path.join(get_ocr_cache_dir(temp_dir), 'tracks')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError:
+        ocr_track_cache = None
+        return
+    ocr_track_cache = ContentCache(cache_dir, max_size_mb * 1024 ** 2)
+
+
+def get_ocr_engine_version(ocr_engine):
+    # 'native' (tesseract without SubtitleEdit) or 'subtitleedit', which uses
+    # tesseract as well and is identified by its executable
+    with ocr_engine_versions_lock:
+        if ocr_engine not in ocr_engine_versions:
+            try:
+                result = subprocess.run(["tesseract", "--version"], capture_output=True, text=True)
+                version = (result.stdout or result.stderr).splitlines()[0]
+            except (OSError, IndexError):
+                version = ''
+            if ocr_engine == 'native':
+                version += f" native {INK_THRESHOLD} {OCR_PADDING} psm6"
+            else:
+                try:
+                    stat = os.stat(SUBTITLEEDIT_EXE)
+                    version += f" subtitleedit {stat.st_size} {stat.st_mtime_ns}"
+                except OSError:
+                    version += " subtitleedit"
+            ocr_engine_versions[ocr_engine] = version
+        return ocr_engine_versions[ocr_engine]
+
+
+def get_ocr_track_digest(file):
+    # None if the cache is disabled or the track can not be read
+    if not ocr_track_cache:
+        return None
+    digest = hashlib.sha1()
+    # VobSub tracks are the .sub file and its .idx (palette, timings)
+    track_files = [file]
+    if file.endswith('.sub'):
+        track_files.append(file[:-len('.sub')] + '.idx')
+    try:
+        for track_file in track_files:
+            with open(track_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def get_ocr_track_cache_key(track_digest, language, ocr_engine):
+    if not track_digest:
+        return None
+    data = json.dumps([track_digest, language, ocr_engine, get_ocr_engine_version(ocr_engine)])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def fetch_cached_ocr_track(key, output_subtitle):
+    # Returns True if the track was found, and copied to output_subtitle
+    if not ocr_track_cache or not key:
+        return False
+    return ocr_track_cache.fetch(key, 'srt', output_subtitle)
+
+
+def store_cached_ocr_track(key, output_subtitle):
+    if ocr_track_cache and key:
+        ocr_track_cache.store(key, 'srt', output_subtitle)
+
+
+def get_ocr_track_cache_reserve(directory):
+    return ocr_track_cache.get_reserve(directory) if ocr_track_cache else 0
+
+
+def get_ocr_track_cache_stats():
+    return ocr_track_cache.get_stats() if ocr_track_cache else {'hits': 0, 'misses': 0, 'evictions': 0}
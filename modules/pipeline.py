@@ -0,0 +1,311 @@
+import os
+import threading
+import traceback
+import concurrent.futures
+
+from modules.misc import *
+from modules.mkv import *
+
+
+class PipelineProgress:
+    """Shows the progress of the earliest unfinished stage, using the same headers as the stage barriers."""
+
+    def __init__(self, logger, total_files, stages):
+        self.logger = logger
+        self.total_files = total_files
+        self.stages = stages
+        self.completed = {key: 0 for key, header, description in stages}
+        self.active = {key: False for key, header, description in stages}
+        self.position = 0
+        self.shown = False
+        self.lock = threading.Lock()
+
+    def advance(self, key, did_work):
+        with self.lock:
+            self.completed[key] += 1
+            if did_work:
+                self.active[key] = True
+            self.update()
+
+    def update(self):
+        # Stages always finish in order, as every file passes through them in order.
+        # Stages where none of the files had any work to do are not printed.
+        while self.position < len(self.stages):
+            key, header, description = self.stages[self.position]
+            completed = self.completed[key]
+            if self.active[key]:
+                if not self.shown:
+                    print_with_progress(self.logger, 0, self.total_files, header=header, description=description)
+                    self.shown = True
+                if completed:
+                    print_with_progress(self.logger, completed, self.total_files, header=header, description=description)
+            if completed < self.total_files:
+                return
+            self.position += 1
+            self.shown = False
+
+
+def has_missing_subs_langs(missing_subs_langs):
+    return bool(missing_subs_langs) and missing_subs_langs not in (['none'], [''])
+
+
+def get_pipeline_stages(total_files):
+    pref_audio_formats = check_config(config, 'audio', 'pref_audio_formats')
+    audio_format_preferences = parse_preferred_codecs(pref_audio_formats)
+
+    return [
+        ('trim', "MKVMERGE", "Filter audio tracks"),
+        ('audio', "FFMPEG", f"Process audio {print_multi_or_single(len(audio_format_preferences), 'format')}"),
+        ('external', "SUBTITLES", "Process external subtitles"),
+        ('extract', "MKVEXTRACT", "Extract internal subtitles"),
+        ('download', "SUBTITLES", "Process missing subtitles"),
+        ('resync', "FFSUBSYNC", "Synchronize subtitles"),
+        ('ocr', "SUBTITLES", "Convert subtitles to SRT"),
+        ('sdh', "SUBTITLES", "Remove SDH from subtitles"),
+        ('repack', "MKVMERGE", "Repack tracks into MKV"),
+        ('clutter', "FFMPEG", "Remove hidden CC in video stream"),
+        ('move', "INFO", f"Move {print_multi_or_single(total_files, 'file')} to destination folder"),
+    ]
+
+
+def get_pipeline_stage_slots():
+    # Bounded concurrency per stage, files waiting for a
+    # stage are held back until one of its slots is free
+    normalize_filenames = check_config(config, 'general', 'normalize_filenames')
+    max_worker_threads = max(1, get_worker_thread_count())
+    max_ocr_threads, memory_per_thread, max_mem_allowed = get_max_ocr_threads()
+
+    stage_slots = {
+        'trim': threading.Semaphore(max_worker_threads),
+        'audio': threading.Semaphore(max_worker_threads),
+        'extract': threading.Semaphore(max_worker_threads),
+        # Throttle downloads with Subliminal
+        'download': threading.Semaphore(1),
+        'resync': threading.Semaphore(max_worker_threads),
+        'ocr': threading.Semaphore(max(1, max_ocr_threads)),
+        # Subtitles that failed OCR are retried one at a time with all the memory
+        'ocr_retry': threading.Semaphore(1),
+        'sdh': threading.Semaphore(max_worker_threads),
+        'repack': threading.Semaphore(max_worker_threads),
+        'clutter': threading.Semaphore(max_worker_threads),
+        # Limit workers to not hit TVMAZE rate limiting
+        'move': threading.Semaphore(min(2, max_worker_threads) if normalize_filenames.lower() == 'full'
+                                    else max_worker_threads),
+    }
+    return stage_slots, max_worker_threads, memory_per_thread, max_mem_allowed
+
+
+def process_files_pipelined(logger, debug, input_files, dirpath, all_dirnames, output_dir, has_external_subs):
+    # Every file flows through the stages on its own, instead of each stage
+    # waiting for all the files in the directory to finish the previous one.
+    total_files = len(input_files)
+    stages = get_pipeline_stages(total_files)
+    progress = PipelineProgress(logger, total_files, stages)
+    stage_slots, max_worker_threads, memory_per_thread, max_mem_allowed = get_pipeline_stage_slots()
+
+    files = list(input_files)
+    results = [None] * total_files
+
+    download_missing_subs = check_config(config, 'subtitles', 'download_missing_subs')
+    if download_missing_subs.lower() != 'false':
+        copy_subliminal_config(dirpath)
+
+    # One more file than workers in flight, so that the
+    # next file can start while the slowest one finishes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_worker_threads + 1) as executor:
+        futures = {executor.submit(process_file_pipelined, debug, input_file, dirpath, all_dirnames, output_dir,
+                                   has_external_subs, stage_slots, progress, memory_per_thread,
+                                   max_mem_allowed): index for index, input_file in enumerate(files)}
+
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+                # Keep the caller's list up to date, so that files
+                # that already were moved are not touched on errors
+                input_files.remove(files[index])
+            except Exception as e:
+                for pending in futures:
+                    pending.cancel()
+                if isinstance(e, CorruptedFile):
+                    raise
+
+                # Print the error and traceback
+                custom_print(logger, f"{RED}[ERROR]{RESET} {e}")
+                print_no_timestamp(logger, f"  {BLUE}debug{RESET}: {debug}")
+                print_no_timestamp(logger, f"  {BLUE}input_file{RESET}: {files[index]}")
+                print_no_timestamp(logger, f"  {BLUE}dirpath{RESET}: {dirpath}")
+                traceback_str = ''.join(traceback.format_tb(e.__traceback__))
+                print_no_timestamp(logger, f"\n{RED}[TRACEBACK]{RESET}\n{traceback_str}")
+                raise
+
+    print_subliminal_summary(logger,
+                             [result['truly_missing_subs_langs'] for result in results],
+                             [result['downloaded_subs'] for result in results],
+                             [result['failed_downloads'] for result in results],
+                             [result['downloaded_subs_simple'] for result in results],
+                             [result['failed_downloads_simple'] for result in results])
+    print_ocr_summary(logger, [result['replacements'] for result in results],
+                      [result['errored_subs'] for result in results])
+    print_integrations_summary(logger, [result['new_radarr_path'] for result in results],
+                               [result['new_sonarr_path'] for result in results])
+
+    processed_files = [result['updated_filename'] for result in results]
+    errored_ocr_list = [result['errored_subs'] for result in results]
+    return processed_files, errored_ocr_list
+
+
+def process_file_pipelined(debug, input_file, dirpath, all_dirnames, output_dir, has_external_subs,
+                           stage_slots, progress, memory_per_thread, max_mem_allowed):
+    download_missing_subs = check_config(config, 'subtitles', 'download_missing_subs').lower()
+    remove_all_subtitles = check_config(config, 'subtitles', 'remove_all_subtitles')
+
+    result = {
+        'updated_filename': input_file,
+        'truly_missing_subs_langs': [],
+        'downloaded_subs': [],
+        'failed_downloads': [],
+        'downloaded_subs_simple': [],
+        'failed_downloads_simple': [],
+        'replacements': [],
+        'errored_subs': [],
+        'new_radarr_path': '',
+        'new_sonarr_path': '',
+    }
+    stages_done = set()
+
+    def stage_done(key, did_work):
+        stages_done.add(key)
+        progress.advance(key, did_work)
+
+    def download_subs(missing_subs_langs, external_subs):
+        truly_missing_subs_langs = get_truly_missing_subs_langs(input_file, missing_subs_langs, [external_subs])
+        with stage_slots['download']:
+            (downloaded_subs, failed_downloads,
+             downloaded_subs_simple, failed_downloads_simple) = fetch_missing_subtitles_process_worker(
+                debug, input_file, dirpath, truly_missing_subs_langs, 1)
+        result['truly_missing_subs_langs'] += truly_missing_subs_langs
+        result['downloaded_subs'] += downloaded_subs
+        result['failed_downloads'] += failed_downloads
+        result['downloaded_subs_simple'] += downloaded_subs_simple
+        result['failed_downloads_simple'] += failed_downloads_simple
+        return downloaded_subs
+
+    def resync_subs(subtitle_files):
+        srt_files = [f for f in subtitle_files if f.endswith('.srt')]
+        if srt_files:
+            with stage_slots['resync']:
+                resync_subs_process_worker(debug, input_file, dirpath, srt_files, 1)
+        return bool(srt_files)
+
+    with stage_slots['trim']:
+        try:
+            needs_processing_audio, needs_processing_subs, missing_subs_langs = trim_audio_in_mkv_files_worker(
+                debug, input_file, dirpath)
+        except Exception:
+            raise CorruptedFile
+    stage_done('trim', True)
+
+    # Audio and subtitle tracks are written with one read of the file
+    extract_subs = bool(needs_processing_subs) and download_missing_subs != 'override'
+    if needs_processing_audio or extract_subs:
+        with stage_slots['extract']:
+            manifest = demux_tracks_process_worker(debug, input_file, dirpath, bool(needs_processing_audio),
+                                                   extract_subs)
+        set_demux_manifest(os.path.join(dirpath, input_file), manifest)
+
+    with stage_slots['audio']:
+        audio_tracks, subtitle_tracks = generate_audio_tracks_in_mkv_files_worker(debug, input_file, dirpath, 1)
+    stage_done('audio', bool(needs_processing_audio))
+
+    subtitle_files = []
+    external_subs = []
+    downloaded_subs = []
+    subtitle_files_to_process = []
+
+    if needs_processing_subs:
+        if has_external_subs and download_missing_subs != 'override':
+            external_subs, missing_subs_langs = process_external_subs_worker(debug, input_file, dirpath,
+                                                                             missing_subs_langs)
+            stage_done('external', True)
+
+        if download_missing_subs != 'override':
+            with stage_slots['extract']:
+                subtitle_files = extract_subs_in_mkv_process_worker(debug, input_file, dirpath, 1)
+            stage_done('extract', bool(subtitle_files))
+
+        if external_subs:
+            subtitle_files = merge_subtitles_with_priority([subtitle_files], [external_subs])[0]
+
+        if has_missing_subs_langs(missing_subs_langs) and download_missing_subs != 'false':
+            downloaded_subs = download_subs(missing_subs_langs, external_subs)
+            stage_done('download', True)
+            subtitle_files = [*(subtitle_files or []), *downloaded_subs]
+
+            if download_missing_subs == 'override':
+                subtitle_files_to_process = subtitle_files
+                subtitle_tracks = return_subtitle_metadata_worker(subtitle_files, 1)
+
+        stage_done('resync', resync_subs([*downloaded_subs, *external_subs]))
+
+        if subtitle_files and download_missing_subs != 'override':
+            sub_files = [f for f in subtitle_files if isinstance(f, str) and
+                         f.endswith(('.mkv', '.srt', '.sup', '.ass', '.sub'))]
+            with stage_slots['ocr']:
+                (subtitle_tracks, subtitle_files_to_process, replacements,
+                 errored_subs, missing_subs_langs, main_audio_track_lang) = convert_to_srt_process_worker(
+                    debug, input_file, dirpath, 1, sub_files, memory_per_thread)
+            result['replacements'] += replacements or []
+            result['errored_subs'] = errored_subs or []
+
+            if has_missing_subs_langs(missing_subs_langs) and result['errored_subs']:
+                errored_files = [f for f in result['errored_subs'] if isinstance(f, str) and
+                                 f.endswith(('.mkv', '.srt', '.sup', '.ass', '.sub'))]
+                with stage_slots['ocr_retry']:
+                    (a, new_subtitle_files_to_process, replacements,
+                     errored_subs, missing_subs_langs, b) = convert_to_srt_process_worker(
+                        debug, input_file, dirpath, 1, errored_files, max_mem_allowed)
+                result['replacements'] += replacements or []
+                result['errored_subs'] = errored_subs or []
+
+                if download_missing_subs != 'false' and has_missing_subs_langs(missing_subs_langs):
+                    downloaded_subs = download_subs(missing_subs_langs, external_subs)
+
+                all_subtitle_files = [*(subtitle_files_to_process or []), *downloaded_subs,
+                                      *(new_subtitle_files_to_process or [])]
+                subtitle_files_to_process = [*downloaded_subs, *(subtitle_files_to_process or []),
+                                             *(new_subtitle_files_to_process or [])]
+                resync_subs(downloaded_subs)
+                subtitle_tracks = return_subtitle_metadata_worker(all_subtitle_files, 1)
+            stage_done('ocr', True)
+
+        if subtitle_files_to_process:
+            with stage_slots['sdh']:
+                remove_sdh_process_worker(debug, subtitle_files_to_process, 1)
+            stage_done('sdh', check_config(config, 'subtitles', 'always_remove_sdh'))
+
+    # Stages this file did not pass through still count towards the progress
+    for key in ('external', 'extract', 'download', 'resync', 'ocr', 'sdh'):
+        if key not in stages_done:
+            stage_done(key, False)
+
+    needs_repack = (any(value for value in audio_tracks.values()) or
+                    any(value for value in subtitle_tracks.values()) or remove_all_subtitles)
+    with stage_slots['repack']:
+        if needs_repack:
+            repack_mkv_tracks_process_worker(debug, input_file, dirpath, audio_tracks, subtitle_tracks)
+        else:
+            remux_planned_tracks_process_worker(debug, input_file, dirpath)
+    stage_done('repack', True)
+
+    with stage_slots['clutter']:
+        closed_captions_found = has_closed_captions(os.path.join(dirpath, input_file))
+        result['updated_filename'] = remove_clutter_process_worker(debug, input_file, dirpath)
+    stage_done('clutter', closed_captions_found)
+
+    with stage_slots['move']:
+        result['new_radarr_path'], result['new_sonarr_path'] = move_files_to_output_process_worker(
+            progress.logger, debug, result['updated_filename'], dirpath, all_dirnames, output_dir)
+    stage_done('move', True)
+
+    return result
@@ -0,0 +1,195 @@
+import os
+import json
+import copy
+import threading
+import subprocess
+
+
+# In-memory cache of probe results (mkvmerge -J etc.), keyed by
+# "device:inode:size:mtime_ns" so that renames keep their entry,
+# while any rewrite of the file results in a new key. It is not stored
+# between runs, as the files in TEMP are new copies (new inodes) each run.
+probe_cache = {}
+probe_cache_lock = threading.Lock()
+probe_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def get_probe_cache_key(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def get_cached_probe(filename, kind):
+    key = get_probe_cache_key(filename)
+
+    with probe_cache_lock:
+        entry = probe_cache.get(key) if key else None
+        if entry and kind in entry:
+            probe_cache_stats['hits'] += 1
+            # The file may have been renamed since it was probed
+            entry['path'] = os.path.abspath(filename)
+            return copy.deepcopy(entry[kind])
+        probe_cache_stats['misses'] += 1
+    return None
+
+
+def store_cached_probe(filename, kind, data):
+    key = get_probe_cache_key(filename)
+    if key is None:
+        return
+
+    with probe_cache_lock:
+        entry = probe_cache.setdefault(key, {})
+        entry['path'] = os.path.abspath(filename)
+        entry[kind] = copy.deepcopy(data)
+
+
+def invalidate_probe_cache(filename):
+    # Called by every code path that rewrites or edits a file. Entries are
+    # removed both by their current key and by their last known path,
+    # as the key has usually already changed when this is called.
+    path = os.path.abspath(filename)
+    key = get_probe_cache_key(filename)
+
+    with probe_cache_lock:
+        stale_keys = [k for k, entry in probe_cache.items() if k == key or entry.get('path') == path]
+        for k in stale_keys:
+            del probe_cache[k]
+        probe_cache_stats['invalidations'] += len(stale_keys)
+
+
+def clear_probe_cache():
+    # Called before each run, as the files of earlier runs have left TEMP
+    with probe_cache_lock:
+        probe_cache.clear()
+        for key in probe_cache_stats:
+            probe_cache_stats[key] = 0
+
+
+def get_probe_cache_stats():
+    with probe_cache_lock:
+        stats = dict(probe_cache_stats)
+        stats['entries'] = len(probe_cache)
+    return stats
+
+
+def probe_with_mkvmerge(filename):
+    parsed_json = get_cached_probe(filename, 'mkvmerge')
+    if parsed_json is not None:
+        return 0, parsed_json
+
+    command = ["mkvmerge", "-J", filename]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        return result.returncode, None
+
+    parsed_json = json.loads(result.stdout)
+    store_cached_probe(filename, 'mkvmerge', parsed_json)
+    return result.returncode, parsed_json
+
+
+def probe_with_ffprobe(filename):
+    parsed_json = get_cached_probe(filename, 'ffprobe')
+    if parsed_json is not None:
+        return parsed_json
+
+    command = ['ffprobe', '-v', 'error', '-show_streams', '-show_format', '-of', 'json', filename]
+    result = subprocess.run(command, capture_output=True, text=True)
+    try:
+        parsed_json = json.loads(result.stdout)
+    except json.JSONDecodeError:
+        parsed_json = {}
+
+    if result.returncode == 0:
+        store_cached_probe(filename, 'ffprobe', parsed_json)
+    return parsed_json
+
+
+class MediaProbe:
+    """Probe data of a single file, from at most one mkvmerge -J and one ffprobe call."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mkvmerge_returncode = None
+        self.mkvmerge_info = None
+        self.ffprobe_info = None
+
+    def get_mkvmerge_info(self):
+        if self.mkvmerge_returncode is None:
+            self.mkvmerge_returncode, self.mkvmerge_info = probe_with_mkvmerge(self.filename)
+        return self.mkvmerge_info
+
+    def get_ffprobe_info(self):
+        if self.ffprobe_info is None:
+            self.ffprobe_info = probe_with_ffprobe(self.filename)
+        return self.ffprobe_info
+
+    def get_tracks(self, track_type=None):
+        info = self.get_mkvmerge_info() or {}
+        return [track for track in info.get('tracks', []) if track_type is None or track['type'] == track_type]
+
+    def get_streams(self, codec_type=None):
+        info = self.get_ffprobe_info()
+        return [stream for stream in info.get('streams', []) if codec_type is None or stream.get('codec_type') == codec_type]
+
+    def is_intact(self):
+        self.get_mkvmerge_info()
+        return self.mkvmerge_returncode == 0
+
+    def get_video_codec(self):
+        codec = None
+        for track in self.get_tracks('video'):
+            codec = track['codec']
+        return codec
+
+    def has_video(self):
+        return len(self.get_streams('video')) > 0
+
+    def has_subtitles(self):
+        return len(self.get_tracks('subtitles')) > 0
+
+    def has_closed_captions(self):
+        return any(stream.get('closed_captions') == 1 for stream in self.get_streams('video'))
+
+    def get_duration(self):
+        # Duration in seconds, 0 if unknown
+        try:
+            return float(self.get_ffprobe_info().get('format', {}).get('duration', 0))
+        except (TypeError, ValueError):
+            return 0.0
+
+    def get_audio_channels_and_layout(self, index=0):
+        audio_streams = self.get_streams('audio')
+        if len(audio_streams) <= index:
+            return None, None
+
+        audio_stream = audio_streams[index]
+        channel_layout = audio_stream.get('channel_layout', '')
+        channels = audio_stream.get('channels', 0)
+
+        # Map codec layout strings to the desired format
+        channel_map = {
+            '7.1': (8, '7.1'),
+            '5.1(side)': (6, '5.1(side)'),
+            '5.1': (6, '5.1'),
+            'stereo': (2, 'stereo'),
+            '2.0': (2, 'stereo'),
+            'mono': (1, 'mono'),
+            '1.0': (1, 'mono')
+        }
+
+        for layout, (num_channels, label) in channel_map.items():
+            if layout in channel_layout:
+                return num_channels, label
+
+        return channels, None
+
+    def get_audio_codec_and_channels(self, index=0):
+        audio_streams = self.get_streams('audio')
+        if len(audio_streams) <= index:
+            return "unknown", 0
+        audio_stream = audio_streams[index]
+        return audio_stream.get('codec_name', 'unknown').lower(), int(audio_stream.get('channels', 0))
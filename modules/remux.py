@@ -0,0 +1,75 @@
+import os
+import threading
+
+
+# Pending remux plans, keyed by the absolute path of the MKV file
+remux_plans = {}
+remux_plans_lock = threading.Lock()
+
+
+class RemuxPlan:
+    """Track decisions for one MKV file, applied when the file is remuxed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        # None means that all audio tracks are kept
+        self.audio_tracks = None
+        self.default_audio_track = None
+
+    def needs_remux(self):
+        return self.audio_tracks is not None
+
+    def get_source_options(self, replacing_audio):
+        # mkvmerge options for the original MKV in the final mux
+        if replacing_audio:
+            return ['--no-audio']
+        if self.audio_tracks is None:
+            return []
+        options = ['--atracks', ','.join(map(str, self.audio_tracks))]
+        if self.default_audio_track is not None:
+            options += ['--default-track', f'{self.default_audio_track}:yes']
+        return options
+
+    def apply_to_info(self, parsed_json):
+        # Present the tracks as they will look after the final mux,
+        # while keeping the track IDs of the unmodified source file
+        if self.audio_tracks is None:
+            return parsed_json
+
+        tracks = []
+        for track in parsed_json.get('tracks', []):
+            if track['type'] == 'audio':
+                if track['id'] not in self.audio_tracks:
+                    continue
+                if track['id'] == self.default_audio_track:
+                    track['properties']['default_track'] = True
+            tracks.append(track)
+        parsed_json['tracks'] = tracks
+        return parsed_json
+
+
+def get_remux_plan(filename):
+    with remux_plans_lock:
+        return remux_plans.get(os.path.abspath(filename))
+
+
+def plan_audio_tracks(filename, audio_tracks, default_audio_track):
+    # If no audio tracks has been selected, all are kept (same as before)
+    if len(audio_tracks) == 0:
+        return
+
+    path = os.path.abspath(filename)
+    with remux_plans_lock:
+        plan = remux_plans.setdefault(path, RemuxPlan(path))
+        plan.audio_tracks = list(audio_tracks)
+        plan.default_audio_track = default_audio_track
+
+
+def has_pending_remux(filename):
+    plan = get_remux_plan(filename)
+    return plan is not None and plan.needs_remux()
+
+
+def clear_remux_plan(filename):
+    with remux_plans_lock:
+        remux_plans.pop(os.path.abspath(filename), None)
@@ -0,0 +1,116 @@
+import os
+
+from modules.misc import *
+from modules.probe import *
+from modules.audio import parse_preferred_codecs, channels_to_int
+
+
+# Bitrates (kbit/s) used to estimate the size of encoded audio tracks. Codecs
+# without a fixed bitrate use a rate per channel, lossless codecs a share of PCM.
+ENCODED_BITRATES = {'AC3': 640, 'EAC3': 1024, 'DTS': 1536}
+ENCODED_BITRATES_PER_CHANNEL = {'AAC': 96, 'OPUS': 96}
+LOSSLESS_RATIOS = {'FLAC': 0.6, 'WAV': 1.0}
+# Used for files that can not be probed, such as other containers that are converted first
+FALLBACK_SPACE_FACTOR = 3.5
+SPACE_MARGIN = 1.1
+
+
+def get_track_duration(track, duration):
+    # Seconds, from the statistics tags written by mkvmerge or the file duration
+    tag_duration = track['properties'].get('tag_duration')
+    if tag_duration:
+        try:
+            hours, minutes, seconds = tag_duration.split(':')
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        except ValueError:
+            pass
+    return duration
+
+
+def get_pcm_size(track, duration):
+    # Size of the track as 16-bit PCM
+    properties = track['properties']
+    channels = properties.get('audio_channels', 2)
+    sample_rate = properties.get('audio_sampling_frequency', 48000)
+    return channels * sample_rate * 2 * get_track_duration(track, duration)
+
+
+def get_track_size(track, duration):
+    # Bytes, from the statistics tags written by mkvmerge, or estimated from the bitrate
+    properties = track['properties']
+    try:
+        return int(properties['tag_number_of_bytes'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        return int(properties['tag_bps']) / 8 * get_track_duration(track, duration)
+    except (KeyError, TypeError, ValueError):
+        pass
+    if track['type'] == 'audio':
+        return get_pcm_size(track, duration)
+    return 0
+
+
+def get_encoded_size(track, duration, transformation, codec, ch_str):
+    if codec == 'ORIG' and transformation is None or codec in ('', 'COPY'):
+        return get_track_size(track, duration)
+
+    source_channels = track['properties'].get('audio_channels', 2)
+    chosen_channels = min(source_channels, channels_to_int(ch_str) or source_channels)
+    if codec in ('AC3', 'EAC3', 'DTS'):
+        chosen_channels = min(6, chosen_channels)
+    track_duration = get_track_duration(track, duration)
+
+    if codec in ENCODED_BITRATES:
+        return ENCODED_BITRATES[codec] * 1000 / 8 * track_duration
+    if codec in ENCODED_BITRATES_PER_CHANNEL:
+        return ENCODED_BITRATES_PER_CHANNEL[codec] * chosen_channels * 1000 / 8 * track_duration
+    if codec in LOSSLESS_RATIOS:
+        return LOSSLESS_RATIOS[codec] * get_pcm_size(track, duration) * chosen_channels / max(1, source_channels)
+    # ORIG with a transformation keeps the source codec
+    return get_track_size(track, duration)
+
+
+def estimate_temp_space(filename, ingest_is_free=False):
+    # Predicts the peak TEMP usage (bytes) of processing a file. At the remux, the source file,
+    # the extracted tracks, the encoded audio tracks and the new MKV file all exist at once.
+    file_size = os.path.getsize(filename)
+    source_size = 0 if ingest_is_free else file_size
+
+    if not filename.lower().endswith('.mkv'):
+        if filename.lower().endswith(('.mp4', '.avi', '.m4v', '.webm', '.ts', '.mov')):
+            return file_size * FALLBACK_SPACE_FACTOR
+        return source_size
+
+    probe = MediaProbe(filename)
+    if not probe.is_intact():
+        return file_size * FALLBACK_SPACE_FACTOR
+    duration = probe.get_duration()
+
+    pref_audio_langs = [lang for lang in check_config(config, 'audio', 'pref_audio_langs') if lang]
+    pref_audio_formats = check_config(config, 'audio', 'pref_audio_formats')
+    preferences = parse_preferred_codecs(pref_audio_formats)
+    keep_temp_wav = check_config(config, 'audio', 'keep_temp_wav')
+
+    audio_size = 0
+    extracted_size = 0
+    encoded_size = 0
+    temp_wav_size = 0
+    for track in probe.get_tracks('audio'):
+        track_size = get_track_size(track, duration)
+        audio_size += track_size
+        if pref_audio_langs and track['properties'].get('language') not in pref_audio_langs:
+            continue
+        if any(codec == 'COPY' for transformation, codec, ch_str in preferences):
+            continue
+        extracted_size += track_size
+        for transformation, codec, ch_str in preferences:
+            encoded_size += get_encoded_size(track, duration, transformation, codec, ch_str)
+        if keep_temp_wav:
+            temp_wav_size = max(temp_wav_size, get_pcm_size(track, duration))
+
+    for track in probe.get_tracks('subtitles'):
+        extracted_size += get_track_size(track, duration)
+
+    remuxed_size = max(0, file_size - audio_size) + encoded_size
+    return (source_size + extracted_size + encoded_size + temp_wav_size + remuxed_size) * SPACE_MARGIN
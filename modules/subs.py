@@ -9,7 +9,6 @@ import time
 import csv
 import re
 import concurrent.futures
-import random
 import pycountry
 import concurrent.futures
 import xml.etree.ElementTree as ET
@@ -21,14 +20,24 @@ import concurrent.futures
 from tqdm import tqdm
 import base64
 import signal
+import atexit
+import queue
+import select
+import socket
+import struct
 
 from modules.misc import *
+from modules.io_limits import *
+from modules.demux import *
+from modules.ocr import *
+from modules.ocr_cache import *
 
 # Define a XML lock
 xml_file_lock = threading.Lock()
-# Create an X11 server lock
-x11_lock = threading.Lock()
-reserved_displays = set()
+# Seconds to wait for a new Xvfb display to accept connections
+XVFB_START_TIMEOUT = 10
+# Seconds to wait for a display to answer the X11 connection setup in the health check
+XVFB_PROBE_TIMEOUT = 2
 
 
 def clean_invalid_utf8(input_file, output_file):
@@ -83,35 +92,171 @@ def find_and_replace(input_file, replacement_file, output_file):
     return changes
 
 
-def get_active_xvfb_displays():
-    active_displays = set()
-    try:
-        command = "pgrep Xvfb | xargs -I{} ps -p {} -o args | grep -oP '(?<=:)\d+'"
-        result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, text=True)
-        for line in result.stdout.splitlines():
+class XvfbDisplay:
+    """A long-lived Xvfb server, used by one command at a time."""
+
+    def __init__(self):
+        self.process = None
+        self.number = None
+        self.jobs = 0
+        self.busy_seconds = 0.0
+        self.restarts = 0
+        self.started = time.monotonic()
+        self.start()
+
+    def start(self):
+        # Xvfb picks a free display number itself, and writes it to the pipe once it accepts connections
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                ["Xvfb", "-displayfd", str(write_fd), "-screen", "0", "1024x768x24",
+                 "-ac", "-nolisten", "tcp", "-nolisten", "unix"],
+                pass_fds=(write_fd,),
+                preexec_fn=os.setsid
+            )
+            os.close(write_fd)
+            write_fd = None
+            output = b''
+            deadline = time.monotonic() + XVFB_START_TIMEOUT
+            while not output.endswith(b'\n') and time.monotonic() < deadline:
+                readable, _, _ = select.select([read_fd], [], [], max(0.0, deadline - time.monotonic()))
+                if not readable:
+                    break
+                data = os.read(read_fd, 64)
+                if not data:
+                    break
+                output += data
+            self.number = int(output.strip())
+        except ValueError:
+            self.stop()
+            raise RuntimeError("Xvfb did not start")
+        finally:
+            if write_fd is not None:
+                os.close(write_fd)
+            os.close(read_fd)
+
+    def is_alive(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        # Xvfb only listens on the abstract socket (-nolisten tcp -nolisten unix), the
+        # display is healthy if it accepts a connection setup there
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as x11_socket:
+                x11_socket.settimeout(XVFB_PROBE_TIMEOUT)
+                x11_socket.connect(f"\0/tmp/.X11-unix/X{self.number}")
+                # Little-endian, protocol 11.0, no authorization
+                x11_socket.sendall(b'l\x00' + struct.pack('<HHHH', 11, 0, 0, 0) + b'\x00\x00')
+                # The first byte of the reply is 1 on success
+                return x11_socket.recv(8)[:1] == b'\x01'
+        except OSError:
+            return False
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
             try:
-                display_number = int(line)
-                active_displays.add(display_number)
-            except ValueError:
-                continue
-    except Exception as e:
-        print(f"Error while checking active Xvfb displays: {e}")
-    return active_displays
+                os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
+            except OSError:
+                pass
+            self.process.wait()
 
 
-def find_available_display():
-    while True:
-        with x11_lock:
-            active_displays = get_active_xvfb_displays()
-            display_number = random.randint(50, 9000)
-            if display_number not in reserved_displays and display_number not in active_displays:
-                reserved_displays.add(display_number)
-                return display_number
+class XvfbPool:
+    """Pool of Xvfb displays that are checked out for one command at a time.
 
+    Displays are health-checked when checked out, and restarted if they have
+    crashed, hang or were killed (e.g. by the memory monitor). A new display is
+    started when all displays are in use, or when a restart fails.
+    """
 
-def release_display(display_number):
-    with x11_lock:
-        reserved_displays.remove(display_number)
+    def __init__(self):
+        self.displays = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    def add_display(self):
+        display = XvfbDisplay()
+        with self.lock:
+            self.displays.append(display)
+        return display
+
+    def ensure(self, count):
+        # Starts displays up front, so that the first commands do not wait for them
+        with self.lock:
+            missing = count - len(self.displays)
+        if missing > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=missing) as executor:
+                futures = [executor.submit(self.add_display) for _ in range(missing)]
+            for future in futures:
+                try:
+                    self.idle.put(future.result())
+                except (OSError, RuntimeError):
+                    # Started again on checkout
+                    pass
+
+    def remove_display(self, display):
+        display.stop()
+        with self.lock:
+            if display in self.displays:
+                self.displays.remove(display)
+
+    def checkout(self):
+        try:
+            display = self.idle.get_nowait()
+        except queue.Empty:
+            display = None
+        if display is not None and not display.is_alive():
+            try:
+                display.restart()
+            except (OSError, RuntimeError):
+                # Replaced by a new display below
+                self.remove_display(display)
+                display = None
+        if display is None:
+            display = self.add_display()
+        return display
+
+    def checkin(self, display, busy_seconds):
+        display.jobs += 1
+        display.busy_seconds += busy_seconds
+        self.idle.put(display)
+
+    def get_stats(self):
+        with self.lock:
+            displays = list(self.displays)
+        now = time.monotonic()
+        return [{'display': display.number,
+                 'jobs': display.jobs,
+                 'restarts': display.restarts,
+                 'utilisation': display.busy_seconds / max(now - display.started, 1e-6) * 100}
+                for display in displays]
+
+    def close(self):
+        with self.lock:
+            displays = list(self.displays)
+        for display in displays:
+            display.stop()
+
+
+xvfb_pool = None
+xvfb_pool_lock = threading.Lock()
+
+
+def get_xvfb_pool():
+    global xvfb_pool
+    with xvfb_pool_lock:
+        if xvfb_pool is None:
+            xvfb_pool = XvfbPool()
+            atexit.register(xvfb_pool.close)
+    return xvfb_pool
+
+
+def get_xvfb_stats():
+    return xvfb_pool.get_stats() if xvfb_pool else []
 
 
 def _monitor_memory_usage(xvfb_pid, cmd_pid, limit_bytes):
@@ -149,24 +294,17 @@ def _monitor_memory_usage(xvfb_pid, cmd_pid, limit_bytes):
 
 
 def run_with_xvfb(command, memory_per_thread):
-    time.sleep(random.uniform(0.5, 1.5))
-    display_number = find_available_display()
-
-    xvfb_process = None
+    pool = get_xvfb_pool()
+    display = None
     command_process = None
 
     try:
-        # Start Xvfb
-        xvfb_cmd = ["Xvfb", f":{display_number}", "-screen", "0", "1024x768x24",
-                    "-ac", "-nolisten", "tcp", "-nolisten", "unix"]
-        xvfb_process = subprocess.Popen(
-            xvfb_cmd,
-            preexec_fn=os.setsid
-        )
+        display = pool.checkout()
+        start_time = time.monotonic()
 
         # Set the DISPLAY environment variable
         env = os.environ.copy()
-        env['DISPLAY'] = f":{display_number}"
+        env['DISPLAY'] = f":{display.number}"
 
         # Start the main command
         command_process = subprocess.Popen(
@@ -181,32 +319,24 @@ def run_with_xvfb(command, memory_per_thread):
         # Start a separate thread to watch memory usage
         monitor_thread = threading.Thread(
             target=_monitor_memory_usage,
-            args=(xvfb_process.pid, command_process.pid, memory_per_thread * 1024 ** 3),  # Use dynamic memory limit
+            args=(display.process.pid, command_process.pid, memory_per_thread * 1024 ** 3),  # Use dynamic memory limit
             daemon=True
         )
         monitor_thread.start()
 
         # Capture the command's output
         stdout, stderr = command_process.communicate()
-        return_code = command_process.returncode
-
-        # Stop Xvfb after the command completes
-        if xvfb_process.poll() is None:
-            os.killpg(os.getpgid(xvfb_process.pid), signal.SIGTERM)
-            xvfb_process.wait()
-
-        return return_code
+        return command_process.returncode
 
     except:
         # Clean up on error
-        if xvfb_process and xvfb_process.poll() is None:
-            os.killpg(os.getpgid(xvfb_process.pid), signal.SIGTERM)
         if command_process and command_process.poll() is None:
             os.killpg(os.getpgid(command_process.pid), signal.SIGTERM)
         return -1
 
     finally:
-        release_display(display_number)
+        if display:
+            pool.checkin(display, time.monotonic() - start_time)
 
 
 def remove_sdh_worker(debug, input_file, remove_music, subtitleedit):
@@ -311,6 +441,8 @@ def remove_sdh(max_threads, debug, input_files, remove_music, track_names, exter
     if debug:
         print('\n')
 
+    get_xvfb_pool().ensure(min(max_threads, len(input_files)))
+
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
         tasks = [executor.submit(remove_sdh_worker, debug, input_file, remove_music, subtitleedit)
                  for i, input_file in enumerate(input_files)]
@@ -524,6 +656,31 @@ def extract_subs_in_mkv(max_threads, debug, filename, track_numbers, output_file
     if debug:
         print('\n')
 
+    subtitle_filenames = [get_extracted_subtitle_filename(filename, track, filetype, language, forced, name)
+                          for track, filetype, language, forced, name in
+                          zip(track_numbers, output_filetypes, subs_languages, subs_forced, subs_names)]
+
+    # mkvextract can write all tracks while reading the file once, which is only
+    # slower if the tracks are written to other devices than the source file.
+    # The tracks may also have been written by the demux stage already.
+    if track_numbers and (is_demuxed(filename, 'subtitles', subtitle_filenames) or
+                          is_same_device([filename] + subtitle_filenames)):
+        if not is_demuxed(filename, 'subtitles', subtitle_filenames):
+            result = run_mkvextract(debug, filename, list(zip(track_numbers, subtitle_filenames)))
+            if result.returncode != 0:
+                print('')
+                print(f"{GREY}[UTC {get_timestamp()}] {RED}[ERROR]{RESET} {result.stdout}")
+                print(f"{RESET}")
+            result.check_returncode()
+
+        results = []
+        for subtitle_filename, filetype in zip(subtitle_filenames, output_filetypes):
+            if filetype == 'srt' and not is_valid_srt(subtitle_filename):
+                results.append(None)
+            else:
+                results.append(subtitle_filename)
+        return results
+
     results = [None] * len(track_numbers)  # Pre-allocate a list for the results in order
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
         # Create a dictionary to store futures with their respective indices
@@ -541,7 +698,7 @@ def extract_subs_in_mkv(max_threads, debug, filename, track_numbers, output_file
     return results
 
 
-def extract_subtitle(debug, filename, track, output_filetype, language, forced, name):
+def get_extracted_subtitle_filename(filename, track, output_filetype, language, forced, name):
     if output_filetype in ('sup', 'sub', 'ass'):
         if not name:
             cleartext_name = 'Original'
@@ -552,13 +709,18 @@ def extract_subtitle(debug, filename, track, output_filetype, language, forced,
     base, _, _ = filename.rpartition('.')
     b64_name = base64.b64encode(cleartext_name.encode("utf-8")).decode("utf-8")
 
-    subtitle_filename = f"{base}_{forced}_'{b64_name}'_{track}_{language}.{output_filetype}"
+    return f"{base}_{forced}_'{b64_name}'_{track}_{language}.{output_filetype}"
+
+
+def extract_subtitle(debug, filename, track, output_filetype, language, forced, name):
+    subtitle_filename = get_extracted_subtitle_filename(filename, track, output_filetype, language, forced, name)
     command = ["mkvextract", filename, "tracks", f"{track}:{subtitle_filename}"]
 
     if debug:
         print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
 
-    result = subprocess.run(command, capture_output=True, text=True)
+    with io_slot(filename):
+        result = subprocess.run(command, capture_output=True, text=True)
     if result.returncode != 0:
         print('')
         print(f"{GREY}[UTC {get_timestamp()}] {RED}[ERROR]{RESET} {result.stdout}")
@@ -583,6 +745,59 @@ def get_output_subtitle_string(filename, track_numbers, output_filetypes, subs_l
     return subtitle_filenames
 
 
+class SubtitleEditPool:
+    """Pool of SubtitleEdit sandboxes, each a private copy of the install.
+
+    Sandboxes are copied once and then leased to one OCR job at a time, with
+    the OCR language patched in their Settings.xml. A sandbox is thrown away
+    if its job failed, as SubtitleEdit may have left it in a bad state.
+    """
+
+    def __init__(self, subtitleedit_dir):
+        self.subtitleedit_dir = subtitleedit_dir
+        self.root_dir = tempfile.mkdtemp(prefix='SubtitleEdit_')
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def create_sandbox(self):
+        with self.lock:
+            self.created += 1
+            sandbox_dir = os.path.join(self.root_dir, str(self.created), 'SubtitleEdit')
+        shutil.copytree(self.subtitleedit_dir, sandbox_dir)
+        return sandbox_dir
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.create_sandbox()
+
+    def release(self, sandbox_dir, discard=False):
+        if discard:
+            shutil.rmtree(os.path.dirname(sandbox_dir), ignore_errors=True)
+        else:
+            self.idle.put(sandbox_dir)
+
+    def close(self):
+        shutil.rmtree(self.root_dir, ignore_errors=True)
+
+
+subtitleedit_pools = {}
+subtitleedit_pools_lock = threading.Lock()
+
+
+def get_subtitleedit_pool(subtitleedit_dir):
+    # One pool per install, kept for the lifetime of the process
+    with subtitleedit_pools_lock:
+        pool = subtitleedit_pools.get(subtitleedit_dir)
+        if pool is None:
+            pool = SubtitleEditPool(subtitleedit_dir)
+            subtitleedit_pools[subtitleedit_dir] = pool
+            atexit.register(pool.close)
+    return pool
+
+
 def ocr_subtitles(max_threads, memory_per_thread, debug, subtitle_files, main_audio_track_lang):
     subtitleedit_dir = 'utilities/SubtitleEdit'
     all_replacements = []
@@ -594,6 +809,9 @@ def ocr_subtitles(max_threads, memory_per_thread, debug, subtitle_files, main_au
     # Prepare to track the results in the order they were submitted
     results = [None] * len(subtitle_files)  # Placeholder list for results
 
+    if check_config(config, 'subtitles', 'ocr_engine') != 'tesseract' or not is_native_ocr_supported():
+        get_xvfb_pool().ensure(min(max_threads, len(subtitle_files)))
+
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
         # Submit all tasks and store futures in a dictionary with their index
         future_to_index = {
@@ -673,16 +891,11 @@ def ocr_subtitles(max_threads, memory_per_thread, debug, subtitle_files, main_au
 def ocr_subtitle_worker(memory_per_thread, debug, file, main_audio_track_lang, subtitleedit_dir):
     ocr_languages = check_config(config, 'subtitles', 'ocr_languages')
     replacements = []
-    # Create a temporary directory for this thread's SubtitleEdit instance
-    temp_dir = tempfile.mkdtemp(prefix='SubtitleEdit_')
+    ocr_engine = check_config(config, 'subtitles', 'ocr_engine')
+    result_code = 0
+    subtitleedit_pool = get_subtitleedit_pool(subtitleedit_dir)
+    local_subtitleedit_dir = None
     try:
-        # Copy the SubtitleEdit directory to the temporary directory
-        local_subtitleedit_dir = os.path.join(temp_dir, 'SubtitleEdit')
-        shutil.copytree(subtitleedit_dir, local_subtitleedit_dir)
-
-        subtitleedit_exe = os.path.join(local_subtitleedit_dir, 'SubtitleEdit.exe')
-        subtitleedit_settings = os.path.join(local_subtitleedit_dir, 'Settings.xml')
-
         base_lang_id_name_forced, _, original_extension = file.rpartition('.')
         base_id_name_forced, _, language = base_lang_id_name_forced.rpartition('_')
         base_name_forced, _, track_id = base_id_name_forced.rpartition('_')
@@ -708,16 +921,46 @@ def ocr_subtitle_worker(memory_per_thread, debug, file, main_audio_track_lang, s
                         original_extension = 'SKIP'
                     return original_subtitle, final_subtitle, language, track_id, name, forced, replacements, original_extension
 
-            update_tesseract_lang_xml(debug, language, subtitleedit_settings)
+            output_subtitle = f"{base}_{forced}_'{name_encoded}'_{track_id}_{language}.srt"
 
-            command = ["mono", subtitleedit_exe, "/convert", file, "srt", "/SplitLongLines", "/encoding:utf-8"]
+            result_code = -1
+            from_cache = False
+            # Cached subtitles are keyed by the engine that produced them, as native OCR
+            # falls back to SubtitleEdit
+            track_digest = get_ocr_track_digest(file)
+            if ocr_engine == 'tesseract' and is_native_ocr_supported():
+                ocr_cache_key = get_ocr_track_cache_key(track_digest, language, 'native')
+                from_cache = fetch_cached_ocr_track(ocr_cache_key, output_subtitle)
+                result_code = 0 if from_cache else run_native_ocr(debug, file, language, output_subtitle)
 
-            if debug:
-                print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
+            if result_code != 0:
+                ocr_cache_key = get_ocr_track_cache_key(track_digest, language, 'subtitleedit')
+                from_cache = fetch_cached_ocr_track(ocr_cache_key, output_subtitle)
+                if from_cache:
+                    result_code = 0
 
-            result_code = run_with_xvfb(command, memory_per_thread)
+            if from_cache and debug:
+                print(f"{GREY}[UTC {get_timestamp()}] [OCR DEBUG]{RESET} Reused the cached OCR of "
+                      f"'{os.path.basename(file)}'.")
+
+            if result_code != 0:
+                # Lease a SubtitleEdit sandbox for this job
+                local_subtitleedit_dir = subtitleedit_pool.acquire()
+                subtitleedit_exe = os.path.join(local_subtitleedit_dir, 'SubtitleEdit.exe')
+                subtitleedit_settings = os.path.join(local_subtitleedit_dir, 'Settings.xml')
+
+                update_tesseract_lang_xml(debug, language, subtitleedit_settings)
+
+                command = ["mono", subtitleedit_exe, "/convert", file, "srt", "/SplitLongLines", "/encoding:utf-8"]
+
+                if debug:
+                    print(f"{GREY}[UTC {get_timestamp()}] {YELLOW}{' '.join(command)}{RESET}")
+
+                result_code = run_with_xvfb(command, memory_per_thread)
+
+            if result_code == 0 and not from_cache and is_valid_srt(output_subtitle):
+                store_cached_ocr_track(ocr_cache_key, output_subtitle)
 
-            output_subtitle = f"{base}_{forced}_'{name_encoded}'_{track_id}_{language}.srt"
             subtitle_tmp = f"{base}_{forced}_'{name_encoded}'_{track_id}_{language}_tmp.srt"
 
             if name:
@@ -801,8 +1044,8 @@ def ocr_subtitle_worker(memory_per_thread, debug, file, main_audio_track_lang, s
             original_subtitle = f"{base}_{forced}_'{name_b64}'_{track_id}_{language}.{original_extension}"
             os.rename(file, original_subtitle)
     finally:
-        # Clean up the temporary directory
-        shutil.rmtree(temp_dir)
+        if local_subtitleedit_dir:
+            subtitleedit_pool.release(local_subtitleedit_dir, discard=result_code != 0)
 
     return original_subtitle, final_subtitle, language, track_id, name, forced, replacements, original_extension
 
@@ -0,0 +1,227 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from modules.misc import *
+from modules.file_operations import *
+
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal ctypes binding for the Linux inotify API."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {}
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # The folder may already be gone again
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise OSError(err, os.strerror(err))
+        self.watches[wd] = path
+        return wd
+
+    def read_events(self, timeout):
+        # Returns a list of (mask, full path) tuples, waiting at most 'timeout' seconds
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if mask & IN_Q_OVERFLOW:
+                events.append((mask, None))
+                continue
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            events.append((mask, os.path.join(folder, os.fsdecode(name)) if name else folder))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InputWatcher:
+    """Watches the input folder, and reports files as stable when they are done being written.
+
+    A file is stable as soon as it is closed after writing or moved into the
+    folder, or when no events have been seen for it during the quiet period.
+    Falls back to polling file sizes if inotify is not available.
+    """
+
+    def __init__(self, path, quiet_period):
+        self.path = os.path.abspath(path)
+        self.quiet_period = quiet_period
+        # File path -> time of last activity
+        self.pending = {}
+        self.stable = set()
+        self.has_new_files = False
+        self.last_run = 0.0
+        self.poll_sizes = {}
+
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError):
+            self.inotify = None
+
+        if self.inotify:
+            self.add_watches(self.path)
+            set_input_watch_active(True)
+        # Files already present at startup need the quiet period, as they may still be written to
+        self.scan(self.path, stable=False)
+
+    def add_watches(self, folder):
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            self.inotify.add_watch(dirpath)
+
+    def scan(self, folder, stable):
+        for dirpath, dirnames, filenames in os.walk(folder):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    file_path = os.path.join(dirpath, filename)
+                    if stable:
+                        self.mark_stable(file_path)
+                    else:
+                        self.pending[file_path] = time.monotonic()
+
+    def mark_stable(self, file_path):
+        self.pending.pop(file_path, None)
+        if file_path not in self.stable:
+            self.stable.add(file_path)
+            self.has_new_files = True
+        register_stable_file(file_path)
+
+    def forget(self, path):
+        for file_path in [f for f in self.pending if f == path or f.startswith(path + os.sep)]:
+            del self.pending[file_path]
+        for file_path in [f for f in self.stable if f == path or f.startswith(path + os.sep)]:
+            self.stable.discard(file_path)
+
+    def handle_event(self, mask, path):
+        if path is None:
+            # The event queue overflowed, rescan everything
+            self.add_watches(self.path)
+            self.scan(self.path, stable=False)
+            return
+        if os.path.basename(path).startswith('.'):
+            return
+
+        if mask & IN_ISDIR:
+            if mask & IN_CREATE:
+                self.add_watches(path)
+                self.scan(path, stable=False)
+            elif mask & IN_MOVED_TO:
+                # A folder moved in from the same filesystem is already complete
+                self.add_watches(path)
+                self.scan(path, stable=True)
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                self.forget(path)
+            return
+
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.mark_stable(path)
+        elif mask & (IN_CREATE | IN_MODIFY):
+            self.stable.discard(path)
+            self.pending[path] = time.monotonic()
+        elif mask & (IN_MOVED_FROM | IN_DELETE):
+            self.forget(path)
+
+    def poll(self):
+        # Used without inotify: a file is stable once its size is unchanged for the quiet period
+        now = time.monotonic()
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                file_path = os.path.join(dirpath, filename)
+                try:
+                    size = os.path.getsize(file_path)
+                except OSError:
+                    continue
+                if self.poll_sizes.get(file_path) != size:
+                    self.poll_sizes[file_path] = size
+                    self.stable.discard(file_path)
+                    self.pending[file_path] = now
+
+    def check_quiet_files(self):
+        now = time.monotonic()
+        for file_path, last_activity in list(self.pending.items()):
+            if not os.path.exists(file_path):
+                del self.pending[file_path]
+            elif now - last_activity >= self.quiet_period:
+                self.mark_stable(file_path)
+
+    def prune(self):
+        self.stable = {f for f in self.stable if os.path.exists(f)}
+        self.poll_sizes = {f: s for f, s in self.poll_sizes.items() if os.path.exists(f)}
+
+    def wait_for_files(self, retry_after):
+        # Blocks until new files are stable, or until files left over from
+        # the previous run (e.g. due to lack of space) should be retried
+        while True:
+            self.prune()
+            self.check_quiet_files()
+            if self.has_new_files:
+                break
+            if self.stable and time.monotonic() - self.last_run >= retry_after:
+                break
+
+            timeout = self.quiet_period if self.pending else retry_after
+            if self.inotify:
+                for mask, path in self.inotify.read_events(min(timeout, 1.0)):
+                    self.handle_event(mask, path)
+            else:
+                time.sleep(min(timeout, 1.0))
+                self.poll()
+
+        self.has_new_files = False
+        self.last_run = time.monotonic()
+        return sorted(self.stable)
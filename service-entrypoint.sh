@@ -7,25 +7,30 @@ log_file="/mkv-auto/logs/mkv-auto.log"
 touch "$log_file"
 chmod 666 "$log_file"
 
-# Main loop
-while true; do
-    # Always copy user.ini from the host if it exists to pick up potential updates
-    if [ -f /mkv-auto/config/user.ini ]; then
+sync_config() {
+    # Only copy when changed, as mkv-auto restarts itself when user.ini is modified
+    if [ -f /mkv-auto/config/user.ini ] && ! cmp -s /mkv-auto/config/user.ini /mkv-auto/user.ini; then
         cp /mkv-auto/config/user.ini /mkv-auto/user.ini
     fi
-    if [ -f /mkv-auto/config/subliminal.toml ]; then
+    if [ -f /mkv-auto/config/subliminal.toml ] && ! cmp -s /mkv-auto/config/subliminal.toml /mkv-auto/subliminal.toml; then
         cp /mkv-auto/config/subliminal.toml /mkv-auto/subliminal.toml
     fi
-    # Check if the script is already running
-    if ! pgrep -f 'python3 -u mkv-auto.py' > /dev/null; then
-        # Check for new files in the input directory
-        if [ $(ls /mkv-auto/files/input | wc -l) -gt 0 ]; then
-            cd /mkv-auto
-            . /pre/venv/bin/activate
-            # Run the Python script, ensure we capture real-time updates in user.ini
-            python3 -u mkv-auto.py --service --move --silent --temp_folder /mkv-auto/files/tmp --log_file $log_file --input_folder /mkv-auto/files/input --output_folder /mkv-auto/files/output $DEBUG_FLAG
-        fi
-    fi
+}
 
+# Keep picking up config updates from the host in the background
+(
+    while true; do
+        sleep 5
+        sync_config
+    done
+) &
+
+# Main loop, mkv-auto watches the input directory itself and
+# is only restarted here if it were to exit unexpectedly
+while true; do
+    sync_config
+    cd /mkv-auto
+    . /pre/venv/bin/activate
+    python3 -u mkv-auto.py --service --watch --move --silent --temp_folder /mkv-auto/files/tmp --log_file $log_file --input_folder /mkv-auto/files/input --output_folder /mkv-auto/files/output $DEBUG_FLAG
     sleep 5
 done
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules are imported as 'modules.<name>' from the repository root
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
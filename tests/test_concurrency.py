@@ -0,0 +1,94 @@
+import logging
+
+import pytest
+
+import modules.concurrency as concurrency
+from modules.concurrency import AdaptiveLimiter
+from modules.misc import config
+
+
+# PSI values returned by read_pressure
+pressure = {}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+class InlineExecutor:
+    # Runs each job when it is submitted
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(concurrency, 'time', clock)
+    monkeypatch.setattr(concurrency, 'read_pressure', lambda resource: pressure.get(resource))
+    monkeypatch.setattr(concurrency, 'get_cpu_usage', lambda: 10.0)
+    monkeypatch.setitem(config['general'], 'adaptive_concurrency', True)
+    monkeypatch.setitem(config['general'], 'max_cpu_usage', '80')
+    pressure.clear()
+    return clock
+
+
+def make_limiter(initial, maximum=8):
+    return AdaptiveLimiter(logging.getLogger('test'), 'TEST', initial, maximum)
+
+
+def run_job(limiter, clock, seconds, work):
+    def job():
+        clock.now += seconds
+    limiter.submit(InlineExecutor(), job, work=work)
+
+
+def test_window_starts_at_first_submit(clock):
+    limiter = make_limiter(1)
+    # Setup time before the first job is not part of the window
+    clock.now = 100.0
+    run_job(limiter, clock, 2.0, work=20.0)
+    assert limiter._last_throughput == pytest.approx(10.0)
+
+
+def test_zero_work_jobs_are_not_sampled(clock):
+    limiter = make_limiter(1)
+    run_job(limiter, clock, 5.0, work=0.0)
+    assert limiter._window_jobs == 0
+    assert limiter._last_throughput is None
+    assert limiter.limit == 1
+
+
+def test_increases_while_saturated(clock):
+    limiter = make_limiter(1)
+    run_job(limiter, clock, 1.0, work=10.0)
+    assert limiter.limit == 2
+
+
+def test_decreases_under_cpu_pressure(clock):
+    limiter = make_limiter(4)
+    pressure['cpu'] = 90.0
+    for _ in range(4):
+        run_job(limiter, clock, 1.0, work=10.0)
+    assert limiter.limit == 3
+
+
+def test_decreases_when_throughput_drops_after_increase(clock):
+    limiter = make_limiter(1)
+    run_job(limiter, clock, 1.0, work=10.0)
+    assert limiter.limit == 2
+    # The next window is much slower than the last one
+    run_job(limiter, clock, 4.0, work=10.0)
+    run_job(limiter, clock, 4.0, work=10.0)
+    assert limiter.limit == 1
+
+
+def test_never_exceeds_maximum(clock):
+    limiter = make_limiter(2, maximum=2)
+    for _ in range(4):
+        run_job(limiter, clock, 1.0, work=10.0)
+    assert limiter.limit == 2
@@ -0,0 +1,54 @@
+import os
+
+from modules.content_cache import ContentCache
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return str(path)
+
+
+def test_store_and_fetch(tmp_path):
+    cache = ContentCache(str(tmp_path / 'cache'), 1000)
+    source = write_file(tmp_path / 'track.srt', 10)
+    cache.store('abcdef', 'srt', source)
+    assert os.path.isfile(tmp_path / 'cache' / 'ab' / 'abcdef.srt')
+
+    destination = str(tmp_path / 'fetched.srt')
+    assert cache.fetch('abcdef', 'srt', destination)
+    # Copied, so that the fetched file can be changed without changing the cache
+    assert not os.path.samefile(destination, cache.get_path('abcdef', 'srt'))
+    assert not cache.fetch('123456', 'srt', str(tmp_path / 'missing.srt'))
+    assert cache.get_stats() == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_linked_entries(tmp_path):
+    cache = ContentCache(str(tmp_path / 'cache'), 1000, link=True)
+    source = write_file(tmp_path / 'track.ac3', 10)
+    cache.store('abcdef', 'ac3', source)
+    assert os.path.samefile(source, cache.get_path('abcdef', 'ac3'))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ContentCache(str(tmp_path / 'cache'), 300)
+    for index, key in enumerate(('aa1', 'bb2', 'cc3')):
+        cache.store(key, 'srt', write_file(tmp_path / f'{key}.srt', 100))
+        os.utime(cache.get_path(key, 'srt'), (index, index))
+    # Using the oldest entry makes it the newest
+    assert cache.fetch('aa1', 'srt', str(tmp_path / 'fetched.srt'))
+    cache.store('dd4', 'srt', write_file(tmp_path / 'dd4.srt', 100))
+
+    assert [os.path.isfile(cache.get_path(key, 'srt')) for key in ('aa1', 'bb2', 'cc3', 'dd4')] == \
+        [True, False, True, True]
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_reserve(tmp_path):
+    cache = ContentCache(str(tmp_path / 'cache'), 1000)
+    os.makedirs(cache.cache_dir)
+    write_file(tmp_path / 'cache' / 'partial.srt.1.tmp', 300)
+    cache.store('abcdef', 'srt', write_file(tmp_path / 'track.srt', 400))
+    # Unfinished entries are not counted
+    assert cache.get_reserve(str(tmp_path)) == 600
+    assert cache.get_reserve(str(tmp_path / 'missing')) == 0
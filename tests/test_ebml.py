@@ -0,0 +1,234 @@
+import struct
+
+import pytest
+
+from modules.ebml import *
+
+
+def encode_id(element_id):
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+
+def encode_size(size):
+    length = 1
+    while size >= (1 << (7 * length)) - 1:
+        length += 1
+    return ((1 << (7 * length)) | size).to_bytes(length, 'big')
+
+
+def element(element_id, *children):
+    payload = b''.join(children)
+    return encode_id(element_id) + encode_size(len(payload)) + payload
+
+
+def uint(element_id, value):
+    return element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big'))
+
+
+def string(element_id, value):
+    return element(element_id, value.encode('utf-8'))
+
+
+def double(element_id, value):
+    return element(element_id, struct.pack('>d', value))
+
+
+def ebml_header(doc_type='matroska'):
+    return element(EBML_HEADER, string(EBML_DOCTYPE, doc_type))
+
+
+def info():
+    return element(INFO, uint(INFO_TIMESTAMP_SCALE, 1000000), double(INFO_DURATION, 5000.0),
+                   string(INFO_TITLE, 'Test title'))
+
+
+def video_track():
+    return element(TRACK_ENTRY, uint(TRACK_NUMBER, 1), uint(TRACK_UID, 1111), uint(TRACK_TYPE, 1),
+                   string(TRACK_CODEC_ID, 'V_MPEGH/ISO/HEVC'), string(TRACK_LANGUAGE, 'und'),
+                   uint(TRACK_DEFAULT_DURATION, 41708333),
+                   element(TRACK_VIDEO, uint(VIDEO_PIXEL_WIDTH, 1920), uint(VIDEO_PIXEL_HEIGHT, 1080)))
+
+
+def audio_track(language=True, codec_id='A_EAC3'):
+    children = [uint(TRACK_NUMBER, 2), uint(TRACK_UID, 2222), uint(TRACK_TYPE, 2),
+                string(TRACK_CODEC_ID, codec_id), string(TRACK_NAME, 'Surround 5.1'),
+                uint(TRACK_FLAG_DEFAULT, 0), string(TRACK_LANGUAGE_BCP47, 'en-US'),
+                element(TRACK_AUDIO, double(AUDIO_SAMPLING_FREQUENCY, 48000.0), uint(AUDIO_CHANNELS, 6))]
+    if language:
+        children.append(string(TRACK_LANGUAGE, 'eng'))
+    return element(TRACK_ENTRY, *children)
+
+
+def subtitle_track():
+    return element(TRACK_ENTRY, uint(TRACK_NUMBER, 3), uint(TRACK_UID, 3333), uint(TRACK_TYPE, 17),
+                   string(TRACK_CODEC_ID, 'S_HDMV/PGS'), string(TRACK_LANGUAGE, 'nor'),
+                   uint(TRACK_FLAG_FORCED, 1), uint(TRACK_FLAG_HEARING_IMPAIRED, 0))
+
+
+def tracks(*entries):
+    return element(TRACKS, *entries)
+
+
+def cluster():
+    return element(CLUSTER, uint(0xE7, 0))
+
+
+def mkv_file(*segment_children):
+    return ebml_header() + element(SEGMENT, *segment_children)
+
+
+# Output of mkvmerge -J for the tracks above (limited to the keys the reader produces)
+EXPECTED_TRACKS = [
+    {
+        'codec': 'HEVC/H.265/MPEG-H',
+        'id': 0,
+        'properties': {
+            'codec_id': 'V_MPEGH/ISO/HEVC',
+            'default_duration': 41708333,
+            'default_track': True,
+            'display_dimensions': '1920x1080',
+            'enabled_track': True,
+            'forced_track': False,
+            'language': 'und',
+            'number': 1,
+            'pixel_dimensions': '1920x1080',
+            'uid': 1111,
+        },
+        'type': 'video',
+    },
+    {
+        'codec': 'E-AC-3',
+        'id': 1,
+        'properties': {
+            'audio_channels': 6,
+            'audio_sampling_frequency': 48000,
+            'codec_id': 'A_EAC3',
+            'default_track': False,
+            'enabled_track': True,
+            'forced_track': False,
+            'language': 'eng',
+            'language_ietf': 'en-US',
+            'number': 2,
+            'track_name': 'Surround 5.1',
+            'uid': 2222,
+        },
+        'type': 'audio',
+    },
+    {
+        'codec': 'HDMV PGS',
+        'id': 2,
+        'properties': {
+            'codec_id': 'S_HDMV/PGS',
+            'default_track': True,
+            'enabled_track': True,
+            'flag_hearing_impaired': False,
+            'forced_track': True,
+            'language': 'nor',
+            'number': 3,
+            'uid': 3333,
+        },
+        'type': 'subtitles',
+    },
+]
+
+
+@pytest.fixture
+def write_mkv(tmp_path):
+    def write(data, name='test.mkv'):
+        filename = tmp_path / name
+        filename.write_bytes(data)
+        return str(filename)
+    return write
+
+
+def test_tracks_and_container(write_mkv):
+    filename = write_mkv(mkv_file(info(), tracks(video_track(), audio_track(), subtitle_track()), cluster()))
+    result = read_mkv_header_info(filename)
+
+    assert result == {
+        'container': {
+            'properties': {'title': 'Test title', 'duration': 5000000000},
+            'recognized': True,
+            'supported': True,
+            'type': 'Matroska',
+        },
+        'file_name': filename,
+        'tracks': EXPECTED_TRACKS,
+    }
+    # mkvmerge -J lists the properties sorted by key
+    for track in result['tracks']:
+        assert list(track['properties']) == sorted(track['properties'])
+
+
+def test_tracks_after_clusters_are_found_through_seekhead(write_mkv):
+    info_element = info()
+    tracks_element = tracks(video_track(), audio_track(), subtitle_track())
+    cluster_element = cluster()
+
+    def seek_head(info_position, tracks_position):
+        return element(SEEK_HEAD,
+                       element(SEEK, uint(SEEK_ID, INFO), element(SEEK_POSITION, info_position.to_bytes(2, 'big'))),
+                       element(SEEK, uint(SEEK_ID, TRACKS), element(SEEK_POSITION, tracks_position.to_bytes(2, 'big'))))
+
+    # Positions are relative to the start of the Segment data
+    head_size = len(seek_head(0, 0))
+    info_position = head_size + len(cluster_element)
+    tracks_position = info_position + len(info_element)
+    head = seek_head(info_position, tracks_position)
+
+    result = read_mkv_header_info(write_mkv(mkv_file(head, cluster_element, info_element, tracks_element)))
+
+    assert result['tracks'] == EXPECTED_TRACKS
+    assert result['container']['properties']['title'] == 'Test title'
+
+
+def test_webm_doc_type(write_mkv):
+    data = ebml_header('webm') + element(SEGMENT, tracks(video_track()))
+    assert read_mkv_header_info(write_mkv(data))['container']['type'] == 'WebM'
+
+
+@pytest.mark.parametrize('codec_id, codec', [
+    ('V_MPEG4/ISO/AVC', 'AVC/H.264/MPEG-4p10'),
+    ('V_MPEG4/ISO/ASP', 'MPEG-4p2'),
+    ('A_AAC/MPEG4/LC', 'AAC'),
+    ('A_PCM/INT/LIT', 'PCM'),
+    ('S_TEXT/UTF8', 'SubRip/SRT'),
+    ('S_VOBSUB', 'VobSub'),
+])
+def test_codec_names(codec_id, codec):
+    assert get_codec_name(codec_id) == codec
+
+
+def test_bcp47_only_language_is_left_to_mkvmerge(write_mkv):
+    filename = write_mkv(mkv_file(info(), tracks(video_track(), audio_track(language=False))))
+    assert read_mkv_header_info(filename) is None
+
+
+def test_unknown_codec_is_left_to_mkvmerge(write_mkv):
+    filename = write_mkv(mkv_file(info(), tracks(video_track(), audio_track(codec_id='A_UNKNOWN'))))
+    assert read_mkv_header_info(filename) is None
+
+
+@pytest.mark.parametrize('codec_id', ['A_DTS', 'A_TRUEHD'])
+def test_dts_and_truehd_are_left_to_mkvmerge(write_mkv, codec_id):
+    # mkvmerge names these after the extensions in the audio frames
+    filename = write_mkv(mkv_file(info(), tracks(video_track(), audio_track(codec_id=codec_id))))
+    assert read_mkv_header_info(filename) is None
+
+
+def test_incomplete_file_is_left_to_mkvmerge(write_mkv):
+    # Complete headers, but the clusters are still being copied
+    data = mkv_file(info(), tracks(video_track(), audio_track(), subtitle_track()), cluster(), cluster())
+    assert read_mkv_header_info(write_mkv(data[:len(data) - 5])) is None
+    assert read_mkv_header_info(write_mkv(data)) is not None
+
+
+def test_truncated_header_is_left_to_mkvmerge(write_mkv):
+    data = mkv_file(info(), tracks(video_track(), audio_track(), subtitle_track()))
+    filename = write_mkv(data[:len(data) - 20])
+    assert read_mkv_header_info(filename) is None
+
+
+def test_not_matroska(write_mkv):
+    assert read_mkv_header_info(write_mkv(b'RIFF\x00\x00\x00\x00AVI ', 'test.avi')) is None
+    assert read_mkv_header_info(write_mkv(b'', 'empty.mkv')) is None
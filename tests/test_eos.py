@@ -0,0 +1,193 @@
+import math
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from modules.audio import get_encode_options
+from modules.compand import parse_compand_filter
+from modules.eos import EosEngine, COMPAND_DEFAULT_POINTS, parse_compand_options, is_numpy_eos_supported
+
+
+SAMPLE_RATE = 48000
+# Short decay, so that the decay filter is computed in more than one chunk per block
+FAST_COMPAND = 'compand=attacks=0:decays=0.0005:soft-knee=6:points=-80/-80|-40/-20|-20/-12|0/-6:gain=2'
+
+
+def get_eos_compand():
+    ffmpeg_final_opts, audio_filter, channel_opts, track_name = get_encode_options('EOS', 'AAC', 2, 'stereo', '')
+    return audio_filter.split(',')[0]
+
+
+def divide(a, b):
+    # Division by zero does not raise in C, these segments are never used
+    return a / b if b else math.nan
+
+
+class ReferenceCompand:
+    # Per-sample port of the ffmpeg compand filter without delay (af_compand.c)
+
+    def __init__(self, compand_str, channels, sample_rate):
+        options = parse_compand_options(compand_str)
+        points = parse_compand_filter(compand_str) or parse_compand_filter(f"points={COMPAND_DEFAULT_POINTS}")
+        nb_segments = (len(points) + 4) * 2
+        seg = [{'x': 0.0, 'y': 0.0, 'a': 0.0, 'b': 0.0} for _ in range(nb_segments)]
+
+        for i, (x, y) in enumerate(points):
+            seg[2 * (i + 1)]['x'] = x
+            seg[2 * (i + 1)]['y'] = y - x
+        num = len(points)
+        if num == 0 or seg[2 * num]['x']:
+            num += 1
+        seg[0]['x'] = seg[2]['x'] - 2 * options['soft-knee']
+        seg[0]['y'] = seg[2]['y']
+        num += 1
+
+        i = 2
+        while i < num:
+            g1 = (seg[2 * (i - 1)]['y'] - seg[2 * (i - 2)]['y']) * (seg[2 * i]['x'] - seg[2 * (i - 1)]['x'])
+            g2 = (seg[2 * i]['y'] - seg[2 * (i - 1)]['y']) * (seg[2 * (i - 1)]['x'] - seg[2 * (i - 2)]['x'])
+            if abs(g1 - g2):
+                i += 1
+                continue
+            num -= 1
+            i -= 1
+            for j in range(i, num):
+                seg[2 * j] = dict(seg[2 * (j + 1)])
+            i += 1
+
+        for i in range(0, nb_segments, 2):
+            seg[i]['y'] += options['gain']
+            seg[i]['x'] *= math.log(10) / 20
+            seg[i]['y'] *= math.log(10) / 20
+
+        radius = options['soft-knee'] * math.log(10) / 20
+        for i in range(4, nb_segments, 2):
+            L = lambda k: seg[i - k]
+            L(4)['a'] = 0
+            L(4)['b'] = divide(L(2)['y'] - L(4)['y'], L(2)['x'] - L(4)['x'])
+            L(2)['a'] = 0
+            L(2)['b'] = divide(L(0)['y'] - L(2)['y'], L(0)['x'] - L(2)['x'])
+
+            theta = math.atan2(L(2)['y'] - L(4)['y'], L(2)['x'] - L(4)['x'])
+            r = min(radius, math.hypot(L(2)['x'] - L(4)['x'], L(2)['y'] - L(4)['y']))
+            L(3)['x'] = L(2)['x'] - r * math.cos(theta)
+            L(3)['y'] = L(2)['y'] - r * math.sin(theta)
+
+            theta = math.atan2(L(0)['y'] - L(2)['y'], L(0)['x'] - L(2)['x'])
+            r = min(radius, math.hypot(L(0)['x'] - L(2)['x'], L(0)['y'] - L(2)['y']) / 2)
+            x = L(2)['x'] + r * math.cos(theta)
+            y = L(2)['y'] + r * math.sin(theta)
+            cx = (L(3)['x'] + L(2)['x'] + x) / 3
+            cy = (L(3)['y'] + L(2)['y'] + y) / 3
+            L(2)['x'] = x
+            L(2)['y'] = y
+
+            in1 = cx - L(3)['x']
+            out1 = cy - L(3)['y']
+            in2 = L(2)['x'] - L(3)['x']
+            out2 = L(2)['y'] - L(3)['y']
+            L(3)['a'] = divide(divide(out2, in2) - divide(out1, in1), in2 - in1)
+            L(3)['b'] = divide(out1, in1) - L(3)['a'] * in1
+        seg[nb_segments - 3]['x'] = 0
+        seg[nb_segments - 3]['y'] = seg[nb_segments - 2]['y']
+
+        self.segments = seg
+        self.in_min_lin = math.exp(seg[1]['x'])
+        self.out_min_lin = math.exp(seg[1]['y'])
+        decays = options['decays']
+        self.attack = 1.0
+        self.decay = 1.0 - math.exp(-1.0 / (sample_rate * decays)) if decays > 1.0 / sample_rate else 1.0
+        self.volume = [10 ** (options['volume'] / 20)] * channels
+
+    def get_volume(self, in_lin):
+        if in_lin < self.in_min_lin:
+            return self.out_min_lin
+        in_log = math.log(in_lin)
+        for i in range(1, len(self.segments)):
+            if in_log <= self.segments[i]['x']:
+                break
+        else:
+            i = len(self.segments)
+        cs = self.segments[i - 1]
+        in_log -= cs['x']
+        return math.exp(cs['y'] + in_log * (cs['a'] * in_log + cs['b']))
+
+    def process(self, samples):
+        envelope = np.empty_like(samples, dtype=np.float64)
+        output = np.empty_like(samples, dtype=np.float64)
+        for channel in range(samples.shape[1]):
+            for n in range(samples.shape[0]):
+                level = abs(float(samples[n, channel]))
+                delta = level - self.volume[channel]
+                self.volume[channel] += delta * (self.attack if delta > 0 else self.decay)
+                envelope[n, channel] = self.volume[channel]
+                output[n, channel] = samples[n, channel] * self.get_volume(self.volume[channel])
+        return envelope, output
+
+
+def get_test_signal(frames=4000, channels=2):
+    # Noise in bursts of very different levels, with silent gaps
+    rng = np.random.default_rng(1)
+    samples = rng.uniform(-1, 1, (frames, channels))
+    levels = np.repeat([0.9, 0.001, 0.0, 0.2, 1e-5, 0.5, 0.05, 0.0], frames // 8)[:, None]
+    return (samples * levels).astype(np.float32)
+
+
+def process_in_blocks(engine, samples, method):
+    outputs = []
+    for start, end in ((0, 1500), (1500, 1501), (1501, 3999), (3999, 4000)):
+        outputs.append(method(samples[start:end]))
+    return np.vstack(outputs)
+
+
+def test_points_are_parsed_by_the_tweaker_parser():
+    compand = get_eos_compand()
+    engine = EosEngine(compand, 2, 'stereo', SAMPLE_RATE)
+    assert engine.points == parse_compand_filter(compand)
+    assert engine.points[0] == (-110.0, -110.0)
+    assert engine.points[-1] == (20.17, -4.29)
+
+
+def test_compand_options():
+    options = parse_compand_options(get_eos_compand())
+    assert options['attacks'] == 0
+    assert options['decays'] == 0.3
+    assert options['soft-knee'] == 6
+    assert options['gain'] == 0
+    assert is_numpy_eos_supported(get_eos_compand(), 2, 'stereo')
+    assert not is_numpy_eos_supported('compand=attacks=0.1:decays=0.3:points=-70/-70', 2, 'stereo')
+
+
+@pytest.mark.parametrize('compand', [get_eos_compand(), FAST_COMPAND, 'compand=attacks=0:decays=0.1'])
+def test_transfer_curve_matches_reference(compand):
+    engine = EosEngine(compand, 1, 'mono', SAMPLE_RATE)
+    reference = ReferenceCompand(compand, 1, SAMPLE_RATE)
+    levels = np.concatenate([[0.0], np.logspace(-7, 0.1, 2000)])
+    expected = np.array([reference.get_volume(level) for level in levels])
+    np.testing.assert_allclose(engine.get_gain(levels), expected, rtol=1e-9)
+
+
+def test_soft_knee_rounds_the_curve():
+    sharp = EosEngine(FAST_COMPAND.replace('soft-knee=6', 'soft-knee=0.01'), 1, 'mono', SAMPLE_RATE)
+    soft = EosEngine(FAST_COMPAND, 1, 'mono', SAMPLE_RATE)
+    # At the -40/-20 point, the soft knee stays below the corner
+    corner = np.array([10 ** (-40 / 20)])
+    assert 20 * math.log10(sharp.get_gain(corner)[0]) == pytest.approx(20 + 2, abs=0.01)
+    assert 20 * math.log10(soft.get_gain(corner)[0]) < 20 + 2 - 1
+
+
+@pytest.mark.parametrize('compand', [get_eos_compand(), FAST_COMPAND])
+def test_envelope_and_output_match_reference(compand):
+    samples = get_test_signal()
+    engine = EosEngine(compand, 2, 'stereo', SAMPLE_RATE)
+    reference = ReferenceCompand(compand, 2, SAMPLE_RATE)
+    expected_envelope, expected_output = reference.process(samples)
+
+    envelope = process_in_blocks(engine, samples, lambda block: engine.get_envelope(
+        np.abs(block.astype(np.float64))))
+    np.testing.assert_allclose(envelope, expected_envelope, rtol=1e-7, atol=1e-12)
+
+    engine = EosEngine(compand, 2, 'stereo', SAMPLE_RATE)
+    output = process_in_blocks(engine, samples, engine.process)
+    np.testing.assert_allclose(output, expected_output, rtol=1e-5, atol=1e-7)
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from modules.misc import config
+from modules.file_operations import *
+
+
+@pytest.fixture(autouse=True)
+def hardlinks(monkeypatch):
+    monkeypatch.setitem(config['general'], 'ingest_hardlinks', True)
+
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return str(path)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_ingesting_twice_keeps_the_original(tmp_path):
+    src = write_file(tmp_path / 'movie.mkv', 100000)
+    data = read_file(src)
+    os.makedirs(tmp_path / 'temp')
+    dst = str(tmp_path / 'temp' / 'movie.mkv')
+
+    assert ingest_file(src, dst) == ('hardlink', 0)
+    assert ingest_file(src, dst) == ('existing', 0)
+    assert read_file(src) == data
+    assert read_file(dst) == data
+
+
+def test_existing_copy_is_replaced_without_writing_to_it(tmp_path):
+    src = write_file(tmp_path / 'movie.mkv', 1000)
+    other = write_file(tmp_path / 'other.mkv', 500)
+    other_data = read_file(other)
+    dst = str(tmp_path / 'temp.mkv')
+    # dst shares its data with another file
+    os.link(other, dst)
+
+    method, bytes_copied = ingest_file(src, dst, allow_link=False)
+    assert method != 'hardlink'
+    assert read_file(dst) == read_file(src)
+    assert read_file(other) == other_data
+    assert not os.path.exists(f"{dst}.ingest.tmp")
+
+
+def test_break_hardlink_keeps_the_original(tmp_path):
+    src = write_file(tmp_path / 'movie.mkv', 1000)
+    dst = str(tmp_path / 'temp.mkv')
+    ingest_file(src, dst)
+    break_hardlink(dst)
+    assert not os.path.samefile(src, dst)
+    assert read_file(src) == read_file(dst)
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+import modules.ledger as ledger
+from modules.ledger import *
+
+
+@pytest.fixture
+def temp_dir(tmp_path):
+    init_job_ledger(str(tmp_path))
+    yield tmp_path
+    ledger.job_ledger.close()
+    ledger.job_ledger = None
+
+
+def test_variant_keeps_flags_and_ignores_resources():
+    names = ['needs_processing_audio', 'internal_threads']
+    assert get_stage_variant(names, [True, 4]) == get_stage_variant(names, [True, 8])
+    assert get_stage_variant(names, [True, 4]) != get_stage_variant(names, [False, 4])
+
+
+def test_stage_result_depends_on_flags(temp_dir):
+    calls = []
+
+    @ledger_stage('demux')
+    def worker(debug, input_file, dirpath, needs_processing_audio, internal_threads):
+        calls.append(needs_processing_audio)
+        return needs_processing_audio
+
+    (temp_dir / 'movie.mkv').write_bytes(b'mkv')
+    assert worker(False, 'movie.mkv', str(temp_dir), True, 4) is True
+    # Reused with another thread count, run again when a flag changes
+    assert worker(False, 'movie.mkv', str(temp_dir), True, 8) is True
+    assert worker(False, 'movie.mkv', str(temp_dir), False, 4) is False
+    assert calls == [True, False]
+
+
+def mux(temp_dir, content=b'muxed mkv'):
+    @ledger_stage('remux', muxes=True)
+    def worker(debug, input_file, dirpath):
+        (temp_dir / input_file).write_bytes(content)
+        return input_file
+
+    filename = temp_dir / 'movie.mkv'
+    filename.write_bytes(b'original mkv')
+    worker(False, 'movie.mkv', str(temp_dir))
+    return filename
+
+
+def test_edited_muxed_file_resumes_with_final_steps(temp_dir):
+    filename = mux(temp_dir)
+    assert get_job_resume_state(str(filename)) == 'muxed'
+    assert has_unfinished_jobs(str(temp_dir))
+
+    # Interrupted after an edit of the clean-up, which stored the new fingerprint
+    filename.write_bytes(b'muxed mkv, no tags')
+    update_job_fingerprint(str(filename))
+    assert get_job_resume_state(str(filename)) == 'muxed'
+
+    # Interrupted during an in-place header edit, which keeps the size
+    filename.write_bytes(b'muxed mkv, no tag ')
+    os.utime(filename, ns=(1, 1))
+    assert get_job_resume_state(str(filename)) == 'muxed'
+
+    # Cleaned up and renamed, only needs to be moved
+    renamed = temp_dir / 'movie-TAG.mkv'
+    os.rename(filename, renamed)
+    mark_job_cleaned(str(filename), str(renamed))
+    assert get_job_resume_state(str(renamed)) == 'cleaned'
+    assert get_job_resume_state(str(filename)) is None
+    # Nothing left to process, and the original is not ingested again
+    assert not has_unfinished_jobs(str(temp_dir))
+    assert is_job_resumable(str(filename))
+
+
+def test_recopied_original_is_processed_again(temp_dir):
+    filename = mux(temp_dir)
+    assert is_job_resumable(str(filename))
+
+    # The original copied into TEMP again, over the muxed file
+    filename.write_bytes(b'original mkv')
+    assert get_job_resume_state(str(filename)) is None
+    assert not has_unfinished_jobs(str(temp_dir))
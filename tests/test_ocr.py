@@ -0,0 +1,244 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from modules.ocr import *
+
+
+# Palette entries: 0 transparent, 1 white text, 2 black outline
+TEXT = 1
+OUTLINE = 2
+
+
+def get_image(width, height):
+    # Text in the middle, with an outline around it and runs of every length class
+    image = np.zeros((height, width), dtype=np.uint8)
+    image[1:height - 1, 2:width - 2] = OUTLINE
+    image[2:height - 2, 3:width - 3] = TEXT
+    image[2, 5:7] = OUTLINE
+    image[height // 2, width // 2] = 0
+    return image
+
+
+def get_runs(row):
+    runs = []
+    start = 0
+    for x in range(1, len(row) + 1):
+        if x == len(row) or row[x] != row[start]:
+            runs.append((int(row[start]), x - start))
+            start = x
+    return runs
+
+
+# PGS
+
+def encode_pgs_rle(image):
+    data = bytearray()
+    for row in image:
+        for color, length in get_runs(row):
+            if color and length == 1:
+                data.append(color)
+                continue
+            flags = 0x80 if color else 0
+            if length < 64:
+                data += bytes([0, flags | length])
+            else:
+                data += bytes([0, flags | 0x40 | (length >> 8), length & 0xFF])
+            if color:
+                data.append(color)
+        data += b'\x00\x00'
+    return bytes(data)
+
+
+def pgs_segment(ms, segment_type, payload):
+    pts = (ms * 90).to_bytes(4, 'big')
+    return b'PG' + pts + b'\x00' * 4 + bytes([segment_type]) + len(payload).to_bytes(2, 'big') + payload
+
+
+def pgs_composition(ms, objects, epoch_start=True):
+    payload = bytearray((1920).to_bytes(2, 'big') + (1080).to_bytes(2, 'big') + b'\x10\x00\x01')
+    payload += bytes([0x80 if epoch_start else 0, 0, 0, len(objects)])
+    for object_id, x, y, crop in objects:
+        payload += object_id.to_bytes(2, 'big') + bytes([0, 0x80 if crop else 0])
+        payload += x.to_bytes(2, 'big') + y.to_bytes(2, 'big')
+        if crop:
+            payload += b''.join(value.to_bytes(2, 'big') for value in crop)
+    return pgs_segment(ms, PGS_COMPOSITION, bytes(payload))
+
+
+def pgs_palette(ms):
+    entries = [(TEXT, 235, 128, 128, 255), (OUTLINE, 16, 128, 128, 255)]
+    return pgs_segment(ms, PGS_PALETTE, b'\x00\x00' + b''.join(bytes(entry) for entry in entries))
+
+
+def pgs_objects(ms, object_id, image, fragments=1):
+    rle = encode_pgs_rle(image)
+    header = (len(rle) + 4).to_bytes(3, 'big') + image.shape[1].to_bytes(2, 'big') + image.shape[0].to_bytes(2, 'big')
+    size = -(-len(rle) // fragments)
+    segments = b''
+    for index in range(fragments):
+        flags = (0x80 if index == 0 else 0) | (0x40 if index == fragments - 1 else 0)
+        payload = object_id.to_bytes(2, 'big') + bytes([0, flags])
+        if index == 0:
+            payload += header
+        segments += pgs_segment(ms, PGS_OBJECT, payload + rle[index * size:(index + 1) * size])
+    return segments
+
+
+def write_sup(tmp_path, data):
+    filename = tmp_path / 'subtitle.sup'
+    filename.write_bytes(data)
+    return str(filename)
+
+
+def test_pgs_rle_roundtrip():
+    image = get_image(150, 8)
+    np.testing.assert_array_equal(decode_pgs_rle(encode_pgs_rle(image), 150, 8), image)
+
+
+def test_decode_pgs(tmp_path):
+    image = get_image(100, 10)
+    data = (pgs_composition(1000, [(0, 200, 900, None)]) + pgs_palette(1000) + pgs_objects(1000, 0, image, 3) +
+            pgs_segment(1000, PGS_END, b'') +
+            # An empty display set clears the screen
+            pgs_composition(3000, [], epoch_start=False) + pgs_segment(3000, PGS_END, b''))
+    events = list(decode_pgs(write_sup(tmp_path, data)))
+
+    assert len(events) == 1
+    start, end, bitmap = events[0]
+    assert (start, end) == (1000, 3000)
+    # Only the bright text pixels are ink, not the outline
+    np.testing.assert_array_equal(bitmap, image == TEXT)
+
+
+def test_decode_pgs_cropped_objects(tmp_path):
+    first = get_image(40, 10)
+    second = get_image(80, 10)
+    data = (pgs_composition(1000, [(0, 100, 900, (3, 2, 20, 6)), (1, 200, 920, None)]) + pgs_palette(1000) +
+            pgs_objects(1000, 0, first) + pgs_objects(1000, 1, second) + pgs_segment(1000, PGS_END, b''))
+    events = list(decode_pgs(write_sup(tmp_path, data)))
+
+    # Shown until the next display set, or at most MAX_EVENT_DURATION
+    start, end, bitmap = events[0]
+    assert (start, end) == (1000, 1000 + MAX_EVENT_DURATION)
+    # Both objects on one canvas, from the left edge of the first to the right edge of the second
+    assert bitmap.shape == (30, 180)
+    np.testing.assert_array_equal(bitmap[0:6, 0:20], first[2:8, 3:23] == TEXT)
+    np.testing.assert_array_equal(bitmap[20:30, 100:180], second == TEXT)
+    assert not bitmap[6:20].any()
+
+
+def test_invalid_pgs(tmp_path):
+    with pytest.raises(ValueError):
+        list(decode_pgs(write_sup(tmp_path, b'XX' + b'\x00' * 20)))
+
+
+# VobSub
+
+def encode_vobsub_line(row):
+    nibbles = []
+    runs = get_runs(row)
+    for index, (color, length) in enumerate(runs):
+        if index == len(runs) - 1 and length > 3:
+            # The last run fills the rest of the line
+            nibbles += [0, 0, 0, color]
+            continue
+        value = (length << 2) | color
+        if length < 4:
+            count = 1
+        elif length < 16:
+            count = 2
+        elif length < 64:
+            count = 3
+        else:
+            count = 4
+        nibbles += [(value >> (4 * shift)) & 0xF for shift in range(count - 1, -1, -1)]
+    if len(nibbles) % 2:
+        nibbles.append(0)
+    return bytes((nibbles[i] << 4) | nibbles[i + 1] for i in range(0, len(nibbles), 2))
+
+
+def encode_vobsub_spu(image, x, y, stop_value):
+    height, width = image.shape
+    top = b''.join(encode_vobsub_line(row) for row in image[0::2])
+    bottom = b''.join(encode_vobsub_line(row) for row in image[1::2])
+    top_offset = 4
+    bottom_offset = top_offset + len(top)
+    control_offset = bottom_offset + len(bottom)
+
+    x2 = x + width - 1
+    y2 = y + height - 1
+    first = (b'\x03\x32\x10' + b'\x04\xFF\xF0' +
+             bytes([0x05, x >> 4, ((x & 0xF) << 4) | (x2 >> 8), x2 & 0xFF,
+                    y >> 4, ((y & 0xF) << 4) | (y2 >> 8), y2 & 0xFF]) +
+             b'\x06' + top_offset.to_bytes(2, 'big') + bottom_offset.to_bytes(2, 'big') + b'\x01\xFF')
+    second_offset = control_offset + 4 + len(first)
+    if stop_value is None:
+        # The last sequence points to itself
+        control = b'\x00\x00' + control_offset.to_bytes(2, 'big') + first
+    else:
+        control = (b'\x00\x00' + second_offset.to_bytes(2, 'big') + first +
+                   stop_value.to_bytes(2, 'big') + second_offset.to_bytes(2, 'big') + b'\x02\xFF')
+    body = control_offset.to_bytes(2, 'big') + top + bottom + control
+    return (len(body) + 2).to_bytes(2, 'big') + body
+
+
+def vobsub_packets(spu, packet_size=40):
+    # Split over several PES packets, each in its own MPEG-2 pack
+    data = b''
+    for start in range(0, len(spu), packet_size):
+        payload = b'\x20' + spu[start:start + packet_size]
+        pack = b'\x00\x00\x01\xba\x44' + b'\x00' * 8 + b'\xf8'
+        pes_header = b'\x81\x80\x05' + b'\x21\x00\x01\x00\x01'
+        data += pack + b'\x00\x00\x01\xbd' + (len(pes_header) + len(payload)).to_bytes(2, 'big') + pes_header + payload
+    return data
+
+
+def write_vobsub(tmp_path, events):
+    # events: (timestamp, spu) pairs
+    data = b''
+    timestamps = []
+    for timestamp, spu in events:
+        seconds, millis = divmod(timestamp, 1000)
+        timestamps.append(f"timestamp: 00:00:{seconds:02}:{millis:03}, filepos: {len(data):09x}")
+        data += vobsub_packets(spu)
+    palette = ', '.join(['000000', 'ffffff', '101010', '808080'] + ['000000'] * 12)
+    (tmp_path / 'subtitle.idx').write_text('\n'.join(['# VobSub index file, v7', 'size: 720x480',
+                                                      f'palette: {palette}', 'id: en, index: 0'] + timestamps) + '\n')
+    (tmp_path / 'subtitle.sub').write_bytes(data)
+    return str(tmp_path / 'subtitle.sub')
+
+
+def test_vobsub_spu():
+    image = get_image(90, 9)
+    start_delay, stop_delay, bitmap = decode_vobsub_spu(encode_vobsub_spu(image, 100, 400, 176),
+                                                        [0, 255, 16, 128] + [0] * 12)
+    assert start_delay == 0
+    assert stop_delay == 176 * 1024 // 90
+    np.testing.assert_array_equal(bitmap, image == TEXT)
+
+
+def test_decode_vobsub(tmp_path):
+    first = get_image(90, 9)
+    second = get_image(30, 6)
+    filename = write_vobsub(tmp_path, [(1500, encode_vobsub_spu(first, 100, 400, 176)),
+                                       (5000, encode_vobsub_spu(second, 50, 420, None))])
+    assert read_vobsub_idx(filename[:-len('.sub')] + '.idx')[:2] == (720, 480)
+
+    events = list(decode_vobsub(filename))
+    assert [(start, end) for start, end, bitmap in events] == [(1500, 1500 + 176 * 1024 // 90),
+                                                               (5000, 5000 + MAX_EVENT_DURATION)]
+    np.testing.assert_array_equal(events[0][2], first == TEXT)
+    np.testing.assert_array_equal(events[1][2], second == TEXT)
+
+
+def test_truncated_vobsub():
+    spu = encode_vobsub_spu(get_image(30, 6), 0, 0, None)
+    with pytest.raises(ValueError):
+        read_vobsub_packet(vobsub_packets(spu)[:-10], 0)
+
+
+def test_merge_ocr_events():
+    events = [(0, 1000, 'Hello'), (1050, 2000, 'Hello'), (2000, 2500, ''), (3000, 4000, 'Hello')]
+    assert merge_ocr_events(events) == [(0, 2000, 'Hello'), (3000, 4000, 'Hello')]
+    assert format_srt_time(3723004) == '01:02:03,004'
@@ -0,0 +1,60 @@
+import copy
+
+import pytest
+
+from modules.remux import *
+
+
+@pytest.fixture(autouse=True)
+def clear_plans():
+    remux_plans.clear()
+    yield
+    remux_plans.clear()
+
+
+PARSED_JSON = {
+    'tracks': [
+        {'id': 0, 'type': 'video', 'properties': {'default_track': True}},
+        {'id': 1, 'type': 'audio', 'properties': {'default_track': True, 'language': 'eng'}},
+        {'id': 2, 'type': 'audio', 'properties': {'default_track': False, 'language': 'nor'}},
+        {'id': 3, 'type': 'audio', 'properties': {'default_track': False, 'language': 'ger'}},
+        {'id': 4, 'type': 'subtitles', 'properties': {'default_track': False}},
+    ]
+}
+
+
+def test_no_plan_keeps_all_tracks():
+    plan = RemuxPlan('movie.mkv')
+    assert not plan.needs_remux()
+    assert plan.get_source_options(False) == []
+    assert plan.apply_to_info(copy.deepcopy(PARSED_JSON)) == PARSED_JSON
+
+
+def test_empty_selection_is_not_planned():
+    plan_audio_tracks('movie.mkv', [], None)
+    assert get_remux_plan('movie.mkv') is None
+    assert not has_pending_remux('movie.mkv')
+
+
+def test_planned_audio_tracks():
+    plan_audio_tracks('movie.mkv', [3, 2], 2)
+    plan = get_remux_plan(os.path.abspath('movie.mkv'))
+    assert has_pending_remux('movie.mkv')
+    assert plan.get_source_options(False) == ['--atracks', '3,2', '--default-track', '2:yes']
+    # Audio tracks that are replaced by encoded tracks are not taken from the source
+    assert plan.get_source_options(True) == ['--no-audio']
+
+    info = plan.apply_to_info(copy.deepcopy(PARSED_JSON))
+    assert [track['id'] for track in info['tracks']] == [0, 2, 3, 4]
+    assert info['tracks'][1]['properties']['default_track'] is True
+
+
+def test_plan_without_default_track():
+    plan_audio_tracks('movie.mkv', [1], None)
+    assert get_remux_plan('movie.mkv').get_source_options(False) == ['--atracks', '1']
+
+
+def test_clear_remux_plan():
+    plan_audio_tracks('movie.mkv', [1], 1)
+    clear_remux_plan('movie.mkv')
+    assert not has_pending_remux('movie.mkv')
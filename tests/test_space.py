@@ -0,0 +1,133 @@
+import pytest
+
+import modules.space
+from modules.misc import config
+from modules.space import *
+
+
+DURATION = 100.0
+FILE_SIZE = 10_000_000
+
+
+class FakeProbe:
+    intact = True
+    tracks = []
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def is_intact(self):
+        return self.intact
+
+    def get_duration(self):
+        return DURATION
+
+    def get_tracks(self, track_type):
+        return [track for track in self.tracks if track['type'] == track_type]
+
+
+def audio_track(language='eng', channels=6, **properties):
+    properties.update({'language': language, 'audio_channels': channels, 'audio_sampling_frequency': 48000})
+    return {'type': 'audio', 'properties': properties}
+
+
+SUBTITLE_TRACK = {'type': 'subtitles', 'properties': {'tag_number_of_bytes': '50000'}}
+
+
+@pytest.fixture(autouse=True)
+def audio_config(monkeypatch):
+    monkeypatch.setattr(modules.space, 'MediaProbe', FakeProbe)
+    monkeypatch.setattr(FakeProbe, 'intact', True)
+    monkeypatch.setattr(FakeProbe, 'tracks', [])
+    monkeypatch.setitem(config['audio'], 'pref_audio_langs', ['eng'])
+    monkeypatch.setitem(config['audio'], 'pref_audio_formats', 'AC3')
+    monkeypatch.setitem(config['audio'], 'keep_temp_wav', False)
+
+
+def make_file(tmp_path, name, size=FILE_SIZE):
+    path = tmp_path / name
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    return str(path)
+
+
+def test_other_containers_use_the_fallback_factor(tmp_path):
+    assert estimate_temp_space(make_file(tmp_path, 'movie.mp4')) == FILE_SIZE * FALLBACK_SPACE_FACTOR
+
+
+def test_other_files_only_need_their_own_size(tmp_path):
+    filename = make_file(tmp_path, 'movie.en.srt', 1000)
+    assert estimate_temp_space(filename) == 1000
+    assert estimate_temp_space(filename, ingest_is_free=True) == 0
+
+
+def test_damaged_mkv_uses_the_fallback_factor(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeProbe, 'intact', False)
+    assert estimate_temp_space(make_file(tmp_path, 'movie.mkv')) == FILE_SIZE * FALLBACK_SPACE_FACTOR
+
+
+def test_peak_at_the_remux(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeProbe, 'tracks', [audio_track(tag_number_of_bytes='2000000'), SUBTITLE_TRACK])
+    filename = make_file(tmp_path, 'movie.mkv')
+
+    # The source, the extracted audio and subtitles, the AC3 track, and the new file
+    # (the source without its audio track, plus the AC3 track)
+    encoded = 640 * 1000 / 8 * DURATION
+    expected = FILE_SIZE + 2_050_000 + encoded + (FILE_SIZE - 2_000_000 + encoded)
+    assert estimate_temp_space(filename) == pytest.approx(expected * SPACE_MARGIN)
+    # A move within the same filesystem does not need space for the source
+    assert estimate_temp_space(filename, ingest_is_free=True) == pytest.approx((expected - FILE_SIZE) * SPACE_MARGIN)
+
+
+def test_unwanted_languages_are_only_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeProbe, 'tracks', [audio_track(tag_number_of_bytes='2000000'),
+                                              audio_track('ger', tag_number_of_bytes='3000000')])
+    filename = make_file(tmp_path, 'movie.mkv')
+
+    encoded = 640 * 1000 / 8 * DURATION
+    expected = FILE_SIZE + 2_000_000 + encoded + (FILE_SIZE - 5_000_000 + encoded)
+    assert estimate_temp_space(filename) == pytest.approx(expected * SPACE_MARGIN)
+
+
+def test_copy_preference_does_not_extract_audio(tmp_path, monkeypatch):
+    monkeypatch.setitem(config['audio'], 'pref_audio_formats', 'COPY')
+    monkeypatch.setattr(FakeProbe, 'tracks', [audio_track(tag_number_of_bytes='2000000')])
+    filename = make_file(tmp_path, 'movie.mkv')
+    expected = FILE_SIZE + (FILE_SIZE - 2_000_000)
+    assert estimate_temp_space(filename) == pytest.approx(expected * SPACE_MARGIN)
+
+
+def test_kept_temp_wav_adds_the_largest_track(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeProbe, 'tracks', [audio_track(tag_number_of_bytes='2000000')])
+    filename = make_file(tmp_path, 'movie.mkv')
+    without_wav = estimate_temp_space(filename)
+
+    monkeypatch.setitem(config['audio'], 'keep_temp_wav', True)
+    pcm_size = 6 * 48000 * 2 * DURATION
+    assert estimate_temp_space(filename) == pytest.approx(without_wav + pcm_size * SPACE_MARGIN)
+
+
+def test_track_size_fallbacks():
+    assert get_track_size(audio_track(tag_number_of_bytes='1234'), DURATION) == 1234
+    assert get_track_size(audio_track(tag_bps='640000'), DURATION) == 640000 / 8 * DURATION
+    # Audio without statistics tags is estimated as PCM
+    assert get_track_size(audio_track(channels=2), DURATION) == 2 * 48000 * 2 * DURATION
+    assert get_track_size({'type': 'subtitles', 'properties': {}}, DURATION) == 0
+
+
+def test_track_duration_from_tags():
+    assert get_track_duration(audio_track(tag_duration='00:01:40.500000000'), 0) == pytest.approx(100.5)
+    assert get_track_duration(audio_track(tag_duration='invalid'), DURATION) == DURATION
+    assert get_track_duration(audio_track(), DURATION) == DURATION
+
+
+def test_encoded_sizes():
+    track = audio_track(channels=8, tag_number_of_bytes='5000000')
+    # AC3 is limited to 5.1, its bitrate does not depend on the channels
+    assert get_encoded_size(track, DURATION, None, 'AC3', None) == 640 * 1000 / 8 * DURATION
+    assert get_encoded_size(track, DURATION, None, 'AAC', '2.0') == 96 * 2 * 1000 / 8 * DURATION
+    assert get_encoded_size(track, DURATION, None, 'OPUS', None) == 96 * 8 * 1000 / 8 * DURATION
+    pcm_size = 8 * 48000 * 2 * DURATION
+    assert get_encoded_size(track, DURATION, None, 'FLAC', '2.0') == pytest.approx(0.6 * pcm_size * 2 / 8)
+    assert get_encoded_size(track, DURATION, None, 'ORIG', None) == 5_000_000
+    assert get_encoded_size(track, DURATION, 'EOS', 'ORIG', None) == 5_000_000
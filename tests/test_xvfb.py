@@ -0,0 +1,125 @@
+import os
+import socket
+import threading
+
+import pytest
+
+import modules.subs
+from modules.subs import XvfbDisplay, XvfbPool
+
+
+class RunningProcess:
+    def poll(self):
+        return None
+
+
+class FakeXServer:
+    # Listens on the abstract socket of a display, and answers the connection setup with reply
+    def __init__(self, number, reply):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(f"\0/tmp/.X11-unix/X{number}")
+        self.server.listen(1)
+        self.reply = reply
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        connection, _ = self.server.accept()
+        with connection:
+            connection.recv(12)
+            if self.reply:
+                connection.sendall(self.reply)
+
+    def close(self):
+        self.server.close()
+
+
+def make_display(number):
+    display = XvfbDisplay.__new__(XvfbDisplay)
+    display.process = RunningProcess()
+    display.number = number
+    return display
+
+
+def get_free_display_number():
+    # A display number well above the ones used by real servers
+    return 5000 + os.getpid() % 10000
+
+
+def test_display_accepting_connections_is_alive():
+    number = get_free_display_number()
+    server = FakeXServer(number, b'\x01\x00\x0b\x00\x00\x00\x00\x00')
+    try:
+        assert make_display(number).is_alive()
+    finally:
+        server.close()
+
+
+def test_display_refusing_connections_is_not_alive(monkeypatch):
+    monkeypatch.setattr(modules.subs, 'XVFB_PROBE_TIMEOUT', 0.2)
+    number = get_free_display_number()
+    # Nothing is listening
+    assert not make_display(number).is_alive()
+    # Listening, but does not answer
+    server = FakeXServer(number, None)
+    try:
+        assert not make_display(number).is_alive()
+    finally:
+        server.close()
+
+
+class FakeDisplay:
+    started = 0
+
+    def __init__(self):
+        FakeDisplay.started += 1
+        self.alive = True
+        self.restart_fails = False
+        self.stopped = False
+        self.jobs = 0
+        self.busy_seconds = 0.0
+
+    def is_alive(self):
+        return self.alive
+
+    def restart(self):
+        if self.restart_fails:
+            raise RuntimeError("Xvfb did not start")
+        self.alive = True
+
+    def stop(self):
+        self.stopped = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(modules.subs, 'XvfbDisplay', FakeDisplay)
+    monkeypatch.setattr(FakeDisplay, 'started', 0)
+    return XvfbPool()
+
+
+def test_checkout_reuses_idle_displays(pool):
+    display = pool.checkout()
+    pool.checkin(display, 1.0)
+    assert pool.checkout() is display
+    assert FakeDisplay.started == 1
+
+
+def test_checkout_restarts_dead_displays(pool):
+    display = pool.checkout()
+    pool.checkin(display, 1.0)
+    display.alive = False
+    assert pool.checkout() is display
+    assert display.alive
+
+
+def test_failed_restart_replaces_the_display(pool):
+    display = pool.checkout()
+    pool.checkin(display, 1.0)
+    display.alive = False
+    display.restart_fails = True
+
+    replacement = pool.checkout()
+    assert replacement is not display
+    assert display.stopped
+    assert pool.displays == [replacement]